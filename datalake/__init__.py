@@ -1,4 +1,5 @@
 from .searcher import Searcher
+from .async_searcher import AsyncSearcher
 from .credentials import load_credentials, save_credentials
 from .dataset import Dataset
 from .data_request import DataRequest
@@ -0,0 +1,631 @@
+import asyncio
+import json
+import math
+from time import time
+from typing import List, Union, Optional
+from PIL import Image
+import numpy as np
+from imantics import Annotation
+
+from .errors import UnsupportedEndpoint, OPTIONAL_ENDPOINTS, UNKNOWN_ENDPOINT_STATUS, is_unknown_endpoint
+from .limits import Limits
+from .annotations import AnnotationSearch, ImageWithAnnotations
+from .settings import FEATURE_DIMENSION, FREEMIUM_SEARCH_LIMIT, PAGE_SIZE, PROXY_URL, PROJECT_ID, RETRY_STATUS_CODES
+from .utils import to_base64, from_url, encode_embeddings
+
+
+async def run_blocking(fn, *args):
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(None, fn, *args)
+
+
+class AsyncSearcher(object):
+    def __init__(self, email, api_key,
+                 max_retries=3,
+                 max_concurrency=100,
+                 backoff_factor=1):
+        super(AsyncSearcher, self).__init__()
+        self.email = email
+        self.api_key = api_key
+        self.max_retries = max_retries
+        self.max_concurrency = max_concurrency
+        self.backoff_factor = backoff_factor
+
+        self.session = None
+        self.semaphore = None
+        # Server capabilities, unknown until first used
+        self.endpoint_support = {}
+        self.retrieve_offset = None
+
+    def get_session(self):
+        if self.session is None or self.session.closed:
+            try:
+                import aiohttp
+            except ImportError:
+                raise RuntimeError("AsyncSearcher requires aiohttp: pip install aiohttp")
+            self.session = aiohttp.ClientSession(connector=aiohttp.TCPConnector(limit=self.max_concurrency))
+            self.semaphore = asyncio.Semaphore(self.max_concurrency)
+        return self.session
+
+    async def close(self):
+        if self.session is not None and not self.session.closed:
+            await self.session.close()
+        self.session = None
+
+    async def __aenter__(self):
+        self.get_session()
+        return self
+
+    async def __aexit__(self, exc_type, exc, tb):
+        await self.close()
+
+    def make_form(self, endpoint, data):
+        import aiohttp
+        form = aiohttp.MultipartWriter("form-data")
+        fields = {
+            "piedemo__proxy": {
+                "project_id": PROJECT_ID,
+                "direct": endpoint,
+                "method": "post",
+            },
+            "__pie_json_data": {
+                "email": self.email,
+                "api_key": self.api_key,
+                **data
+            },
+        }
+        for name, value in fields.items():
+            part = form.append(json.dumps(value))
+            part.set_content_disposition("form-data", name=name)
+        return form
+
+    async def pierequest(self, endpoint, **data):
+        import aiohttp
+        session = self.get_session()
+        async with self.semaphore:
+            attempt = 0
+            while True:
+                try:
+                    async with session.post(PROXY_URL,
+                                            data=self.make_form(endpoint, data)) as response:
+                        if response.status in UNKNOWN_ENDPOINT_STATUS:
+                            try:
+                                result = await response.json(content_type=None)
+                            except ValueError as e:
+                                if endpoint not in OPTIONAL_ENDPOINTS:
+                                    raise
+                                self.endpoint_support[endpoint] = False
+                                raise UnsupportedEndpoint(f"{endpoint} is not supported by the server "
+                                                          f"(HTTP {response.status})") from e
+                            if not isinstance(result, dict):
+                                raise RuntimeError(f"{endpoint} failed (HTTP {response.status})")
+                            return result
+                        if response.status not in RETRY_STATUS_CODES or attempt >= self.max_retries:
+                            return await response.json(content_type=None)
+                except (aiohttp.ClientConnectionError, asyncio.TimeoutError):
+                    if attempt >= self.max_retries:
+                        raise
+                await asyncio.sleep(self.backoff_factor * (2 ** attempt))
+                attempt += 1
+
+    def check_response(self, endpoint, response):
+        # RuntimeError for a failed call; for OPTIONAL_ENDPOINTS, UnsupportedEndpoint
+        # when the server says it doesn't know the endpoint
+        optional = endpoint in OPTIONAL_ENDPOINTS
+        if response.get("status") == "ok":
+            if optional:
+                self.endpoint_support[endpoint] = True
+            return response
+        if optional and is_unknown_endpoint(response):
+            self.endpoint_support[endpoint] = False
+            raise UnsupportedEndpoint(response.get("message"))
+        raise RuntimeError(response.get("message"))
+
+    def supports(self, endpoint):
+        return self.endpoint_support.get(endpoint)
+
+    async def limits(self):
+        response = await self.pierequest("/limits")
+        if response.get("status") != "ok":
+            raise RuntimeError(response.get("message"))
+
+        return Limits(response.get("limits", {}))
+
+    async def recent_searches(self):
+        response = await self.pierequest("/recent_searches")
+        if response.get("status") != "ok":
+            raise RuntimeError(response.get("message"))
+
+        return response.get("recent_searches", [])
+
+    async def view_search(self, request_id):
+        response = await self.pierequest("/view_search",
+                                         request_id=request_id)
+        if response.get("status") != "ok":
+            raise RuntimeError(response.get("message"))
+
+        response.pop('status')
+        return {
+            "query": response.get('query'),
+            "images": await asyncio.gather(*[run_blocking(from_url, image_url)
+                                             for image_url in response.get("images")]),
+            "annotations": [AnnotationSearch.from_dict(ann)
+                            for ann in response.get('annotations', [])]
+        }
+
+    async def retrieve_page(self, request_id, offset=0):
+        # (results from offset on, whether the server reports the search finished)
+        if offset and self.retrieve_offset is None:
+            return await self.probe_retrieve_offset(request_id, offset)
+        response = await self.pierequest("/retrieve",
+                                         request_id=request_id,
+                                         **(dict(offset=offset) if offset and self.retrieve_offset else {}))
+        if response.get("status") != "ok":
+            raise RuntimeError(response.get("message"))
+        data = response.get("data", [])
+        if offset and not self.retrieve_offset:
+            data = data[offset:]
+        return data, bool(response.get("finished", response.get("done", False)))
+
+    async def probe_retrieve_offset(self, request_id, offset):
+        # Same probe as Searcher.probe_retrieve_offset
+        response = await self.pierequest("/retrieve",
+                                         request_id=request_id,
+                                         offset=offset)
+        if response.get("status") != "ok":
+            raise RuntimeError(response.get("message"))
+        data = response.get("data", [])
+        if response.get("offset") == offset:
+            supported = True
+        else:
+            head = await self.pierequest("/retrieve",
+                                         request_id=request_id)
+            if head.get("status") != "ok":
+                raise RuntimeError(head.get("message"))
+            head = head.get("data", [])[:offset]
+            supported = data[:len(head)] != head
+        self.retrieve_offset = supported
+        if not supported:
+            data = data[offset:]
+        return data, bool(response.get("finished", response.get("done", False)))
+
+    async def retrieve_data(self, request_id, offset=0):
+        return (await self.retrieve_page(request_id, offset=offset))[0]
+
+    async def search(self, query,
+                     images: List[Image.Image] = None,
+                     annotations: List[AnnotationSearch] = None,
+                     search_limit=FREEMIUM_SEARCH_LIMIT,
+                     dataset_id=None) -> 'AsyncDataRequest':
+        if images is None:
+            images = []
+        if annotations is None:
+            annotations = []
+
+        if dataset_id is None and search_limit > FREEMIUM_SEARCH_LIMIT:
+            raise NotImplementedError(f"Now free search limit is {FREEMIUM_SEARCH_LIMIT} photos")
+
+        extra = {} if dataset_id is None else dict(dataset_id=dataset_id)
+        response = await self.pierequest("/search",
+                                         query=query,
+                                         images=await asyncio.gather(*[run_blocking(to_base64, im)
+                                                                       for im in images
+                                                                       if isinstance(im, Image.Image)]),
+                                         image_urls=[im
+                                                     for im in images
+                                                     if isinstance(im, str)],
+                                         annotations=[ann.to_dict()
+                                                      for ann in annotations],
+                                         knum=search_limit,
+                                         **extra)
+        if response.get("status") != "ok":
+            raise RuntimeError(response.get("message"))
+
+        return AsyncDataRequest(self, response.get("request_id"))
+
+    async def search_similar(self,
+                             request_id,
+                             data_ids: List[int] = None,
+                             dataset_id=None,
+                             search_limit=FREEMIUM_SEARCH_LIMIT) -> 'AsyncDataRequest':
+
+        if data_ids is None:
+            data_ids = []
+
+        if dataset_id is None and search_limit > FREEMIUM_SEARCH_LIMIT:
+            raise NotImplementedError(f"Now free search limit is {FREEMIUM_SEARCH_LIMIT} photos")
+
+        response = await self.pierequest("/search_similar",
+                                         request_id=request_id,
+                                         data_ids=data_ids,
+                                         dataset_id=dataset_id,
+                                         knum=search_limit)
+        if response.get("status") != "ok":
+            raise RuntimeError(response.get("message"))
+
+        return AsyncDataRequest(self, response.get("request_id"))
+
+    async def deepsearch(self, embedding: np.ndarray,
+                         annotations: List[AnnotationSearch] = None,
+                         search_limit=FREEMIUM_SEARCH_LIMIT,
+                         dataset_id=None) -> 'AsyncDataRequest':
+
+        if annotations is None:
+            annotations = []
+
+        if embedding.shape != (FEATURE_DIMENSION, ):
+            raise RuntimeError("Bad embedding shape")
+
+        if dataset_id is None and search_limit > FREEMIUM_SEARCH_LIMIT:
+            raise NotImplementedError(f"Now free search limit is {FREEMIUM_SEARCH_LIMIT} photos")
+
+        extra = {} if dataset_id is None else dict(dataset_id=dataset_id)
+        response = await self.pierequest("/deepsearch",
+                                         embedding=embedding.tolist(),
+                                         annotations=[ann.to_dict()
+                                                      for ann in annotations],
+                                         knum=search_limit,
+                                         **extra)
+        if response.get("status") != "ok":
+            raise RuntimeError(response.get("message"))
+
+        return AsyncDataRequest(self, response.get("request_id"))
+
+    async def deepsearch_batch(self, embeddings: np.ndarray,
+                               annotations: List[AnnotationSearch] = None,
+                               search_limit=FREEMIUM_SEARCH_LIMIT,
+                               dataset_id=None,
+                               dtype="float16",
+                               batch_size=64) -> List['AsyncDataRequest']:
+        if annotations is None:
+            annotations = []
+
+        embeddings = np.asarray(embeddings)
+        if embeddings.ndim != 2 or embeddings.shape[1] != FEATURE_DIMENSION:
+            raise RuntimeError("Bad embeddings shape")
+
+        if dataset_id is None and search_limit > FREEMIUM_SEARCH_LIMIT:
+            raise NotImplementedError(f"Now free search limit is {FREEMIUM_SEARCH_LIMIT} photos")
+
+        extra = {} if dataset_id is None else dict(dataset_id=dataset_id)
+
+        async def submit_batch(batch):
+            response = self.check_response("/deepsearch_batch",
+                                           await self.pierequest("/deepsearch_batch",
+                                                                 embeddings=encode_embeddings(batch, dtype=dtype),
+                                                                 dtype=dtype,
+                                                                 shape=list(batch.shape),
+                                                                 annotations=[ann.to_dict()
+                                                                              for ann in annotations],
+                                                                 knum=search_limit,
+                                                                 **extra))
+            request_ids = response.get("request_ids")
+            if request_ids is None or len(request_ids) != len(batch):
+                raise RuntimeError("Bad /deepsearch_batch response")
+            return [AsyncDataRequest(self, request_id) for request_id in request_ids]
+
+        async def submit_one(embedding):
+            return [await self.deepsearch(embedding,
+                                          annotations=annotations,
+                                          search_limit=search_limit,
+                                          dataset_id=dataset_id)]
+
+        batches = [embeddings[start:start + batch_size]
+                   for start in range(0, len(embeddings), batch_size)]
+        results = [None] * len(batches)
+        if batches and self.supports("/deepsearch_batch") is None:
+            # Probe with the first batch before sending the rest
+            try:
+                results[0] = await submit_batch(batches[0])
+            except UnsupportedEndpoint as e:
+                results[0] = e
+        pending = [i for i, result in enumerate(results) if result is None]
+        if self.supports("/deepsearch_batch") is not False:
+            for i, result in zip(pending, await asyncio.gather(*[submit_batch(batches[i]) for i in pending],
+                                                               return_exceptions=True)):
+                results[i] = result
+        # Only batches the server rejected as an unknown endpoint go one
+        # query per request; batches that went through are not resubmitted
+        for result in results:
+            if isinstance(result, BaseException) and not isinstance(result, UnsupportedEndpoint):
+                raise result
+        fallback = [i for i, result in enumerate(results)
+                    if result is None or isinstance(result, UnsupportedEndpoint)]
+        singles = await asyncio.gather(*[submit_one(embedding)
+                                         for i in fallback
+                                         for embedding in batches[i]])
+        start = 0
+        for i in fallback:
+            results[i] = [request for single in singles[start:start + len(batches[i])] for request in single]
+            start += len(batches[i])
+        return [request for result in results for request in result]
+
+    async def dataset_list(self, prefix=""):
+        response = await self.pierequest("/dataset_list",
+                                         prefix=prefix)
+        if response.get("status") != "ok":
+            raise RuntimeError(response.get("message"))
+
+        return [AsyncDataset(self, dataset_id)
+                for dataset_id in response.get("datasets", [])]
+
+    async def dataset_shared_list(self, prefix=""):
+        response = await self.pierequest("/dataset_shared_list",
+                                         prefix=prefix)
+        if response.get("status") != "ok":
+            raise RuntimeError(response.get("message"))
+
+        return [AsyncDataset(self, dataset_id)
+                for dataset_id in response.get("datasets", [])]
+
+    async def dataset_info(self, dataset_id):
+        response = await self.pierequest("/dataset_info",
+                                         dataset_id=dataset_id)
+        if response.get("status") != "ok":
+            raise RuntimeError(response.get("message"))
+
+        return response
+
+    async def dataset_add(self, dataset_id: str,
+                          request_id: str,
+                          data_ids: List[int]):
+        response = await self.pierequest("/add_to_dataset",
+                                         dataset_id=dataset_id,
+                                         request_id=request_id,
+                                         data_ids=data_ids)
+
+        if response.get("status") != "ok":
+            raise RuntimeError(response.get("message"))
+
+        return response
+
+    async def dataset_new(self, name=None):
+        response = await self.pierequest("/new_dataset",
+                                         name=name)
+
+        if response.get("status") != "ok":
+            raise RuntimeError(response.get("message"))
+
+        return response
+
+    async def dataset_drop(self, dataset_id: str):
+        response = await self.pierequest("/drop_dataset",
+                                         dataset_id=dataset_id)
+
+        if response.get("status") != "ok":
+            raise RuntimeError(response.get("message"))
+
+        return response
+
+    async def dataset_make_public(self, dataset_id: str):
+        response = await self.pierequest("/make_public",
+                                         dataset_id=dataset_id)
+
+        if response.get("status") != "ok":
+            raise RuntimeError(response.get("message"))
+
+        return response
+
+    async def dataset_make_private(self, dataset_id: str):
+        response = await self.pierequest("/make_private",
+                                         dataset_id=dataset_id)
+
+        if response.get("status") != "ok":
+            raise RuntimeError(response.get("message"))
+
+        return response
+
+    async def dataset_remove(self, dataset_id: str,
+                             request_id: str,
+                             data_ids: List[int]):
+        response = await self.pierequest("/remove_from_dataset",
+                                         dataset_id=dataset_id,
+                                         request_id=request_id,
+                                         data_ids=data_ids)
+
+        if response.get("status") != "ok":
+            raise RuntimeError(response.get("message"))
+
+        return response
+
+
+class AsyncDataRequest(object):
+    def __init__(self, searcher: AsyncSearcher,
+                 request_id: str):
+        super(AsyncDataRequest, self).__init__()
+        self.searcher = searcher
+        self.request_id = request_id
+        # Set once the server reports the search has no more results
+        self.finished = False
+
+    def __repr__(self):
+        return f"AsyncDataRequest({self.request_id})"
+
+    async def retrieve_page(self, offset=0):
+        data, finished = await self.searcher.retrieve_page(self.request_id,
+                                                           offset=offset)
+        if finished:
+            self.finished = True
+        return data, finished
+
+    async def retrieve(self):
+        return (await self.retrieve_page())[0]
+
+    async def wait(self, n=1,
+                   timeout=None,
+                   min_interval=0.005,
+                   max_interval=1.,
+                   backoff=1.5):
+        # Same schedule as DataRequest.stream: fetch only new results, poll
+        # faster while they arrive and back off while they don't
+        deadline = None if timeout is None else time() + timeout
+        interval = min_interval
+        results = []
+        while len(results) < n:
+            data, finished = await self.retrieve_page(offset=len(results))
+            if data:
+                results.extend(data)
+                interval = max(interval / backoff, min_interval)
+                if len(results) >= n:
+                    break
+            if finished:
+                break
+
+            now = time()
+            if deadline is not None and now >= deadline:
+                raise TimeoutError(f"{self} got {len(results)} of {n} results in {timeout}s")
+            await asyncio.sleep(interval if deadline is None else min(interval, deadline - now))
+            if not data:
+                interval = min(interval * backoff, max_interval)
+        return results
+
+    async def similar(self, data_ids,
+                      dataset: Optional['AsyncDataset'] = None,
+                      search_limit=FREEMIUM_SEARCH_LIMIT) -> 'AsyncDataRequest':
+        return await self.searcher.search_similar(self.request_id,
+                                                  data_ids,
+                                                  dataset_id=None if dataset is None else dataset.dataset_id,
+                                                  search_limit=search_limit)
+
+
+class AsyncDataset(object):
+    def __init__(self, searcher: AsyncSearcher,
+                 dataset_id: str):
+        super(AsyncDataset, self).__init__()
+        self.searcher = searcher
+        self.dataset_id = dataset_id
+
+    def __repr__(self):
+        return f"AsyncDataset({self.dataset_id})"
+
+    @staticmethod
+    async def new(searcher: AsyncSearcher,
+                  name=None) -> 'AsyncDataset':
+        dataset_id = (await searcher.dataset_new(name=name))["dataset_id"]
+        return AsyncDataset(searcher,
+                            dataset_id=dataset_id)
+
+    async def drop(self):
+        await self.searcher.dataset_drop(self.dataset_id)
+
+    async def add(self,
+                  data_request: AsyncDataRequest,
+                  ids: List[int] = None,
+                  exclude_ids: List[int] = None):
+        if ids is None:
+            ids = list(range(len(await data_request.retrieve())))
+        if exclude_ids is None:
+            exclude_ids = []
+        ids = list(set(ids) - set(exclude_ids))
+        await self.searcher.dataset_add(self.dataset_id,
+                                        data_request.request_id,
+                                        data_ids=ids)
+        return self
+
+    async def remove(self,
+                     data_request: AsyncDataRequest,
+                     ids: List[int] = None,
+                     exclude_ids: List[int] = None):
+        if ids is None:
+            ids = list(range(len(await data_request.retrieve())))
+        if exclude_ids is None:
+            exclude_ids = []
+        ids = list(set(ids) - set(exclude_ids))
+        await self.searcher.dataset_remove(self.dataset_id,
+                                           data_request.request_id,
+                                           data_ids=ids)
+        return self
+
+    async def info(self):
+        return await self.searcher.dataset_info(self.dataset_id)
+
+    async def count(self):
+        return (await self.info()).get("images_count", 0)
+
+    async def count_annotations(self):
+        return (await self.info()).get("annotations_count", 0)
+
+    async def add_image(self,
+                        image_or_image_url: Union[str, Image.Image],
+                        annotations=None):
+
+        if annotations is None:
+            annotations = []
+        annotations = [ImageWithAnnotations.annotation_to_dict(ann)
+                       if isinstance(ann, Annotation) else ann
+                       for ann in annotations]
+
+        if isinstance(image_or_image_url, Image.Image):
+            image = dict(image=await run_blocking(to_base64, image_or_image_url))
+        else:
+            image = dict(image_url=image_or_image_url)
+
+        response = await self.searcher.pierequest("/add_image_to_dataset",
+                                                  dataset_id=self.dataset_id,
+                                                  **image,
+                                                  annotations=annotations)
+        if response.get("status") != "ok":
+            raise RuntimeError(response.get("message"))
+
+    async def remove_image(self, image_url):
+        response = await self.searcher.pierequest("/remove_image_from_dataset",
+                                                  dataset_id=self.dataset_id,
+                                                  image_url=image_url)
+        if response.get("status") != "ok":
+            raise RuntimeError(response.get("message"))
+
+    async def retrieve(self, page=0):
+        response = await self.searcher.pierequest("/retrieve_from_dataset",
+                                                  dataset_id=self.dataset_id,
+                                                  page=page)
+        if response.get("status") != "ok":
+            raise RuntimeError(response.get("message"))
+        return response.get("data", [])
+
+    async def iter(self, prefetch=1):
+        n_pages = math.ceil(await self.count() / PAGE_SIZE)
+        pending = []
+        next_page = 0
+        try:
+            while next_page < n_pages or pending:
+                while next_page < n_pages and len(pending) < max(prefetch, 1):
+                    pending.append(asyncio.ensure_future(self.retrieve(next_page)))
+                    next_page += 1
+                for obj in await pending.pop(0):
+                    yield obj
+        finally:
+            for future in pending:
+                future.cancel()
+
+    def __aiter__(self):
+        return self.iter()
+
+    async def search(self, query,
+                     images: List[Image.Image] = None,
+                     annotations: List[AnnotationSearch] = None,
+                     search_limit=FREEMIUM_SEARCH_LIMIT) -> AsyncDataRequest:
+        return await self.searcher.search(query,
+                                          images=images,
+                                          annotations=annotations,
+                                          search_limit=search_limit,
+                                          dataset_id=self.dataset_id)
+
+    async def deepsearch(self, embedding: np.ndarray,
+                         annotations: List[AnnotationSearch] = None,
+                         search_limit=FREEMIUM_SEARCH_LIMIT) -> AsyncDataRequest:
+        return await self.searcher.deepsearch(embedding,
+                                              annotations=annotations,
+                                              search_limit=search_limit,
+                                              dataset_id=self.dataset_id)
+
+    async def deepsearch_batch(self, embeddings: np.ndarray,
+                               annotations: List[AnnotationSearch] = None,
+                               search_limit=FREEMIUM_SEARCH_LIMIT,
+                               dtype="float16",
+                               batch_size=64) -> List[AsyncDataRequest]:
+        return await self.searcher.deepsearch_batch(embeddings,
+                                                    annotations=annotations,
+                                                    search_limit=search_limit,
+                                                    dataset_id=self.dataset_id,
+                                                    dtype=dtype,
+                                                    batch_size=batch_size)
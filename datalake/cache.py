@@ -0,0 +1,220 @@
+import os
+import json
+import sqlite3
+import threading
+from collections import OrderedDict
+from concurrent.futures import Future
+from pathlib import Path
+from time import monotonic, time
+from typing import Optional
+
+
+class LRUCache(object):
+    def __init__(self, maxsize=128,
+                 ttl=None):
+        super(LRUCache, self).__init__()
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.data = OrderedDict()
+        self.lock = threading.RLock()
+        self.inflight = {}
+        self.generation = 0
+
+    def get(self, key, default=None):
+        with self.lock:
+            if key not in self.data:
+                return default
+            value, expires = self.data[key]
+            if expires is not None and expires < monotonic():
+                del self.data[key]
+                return default
+            self.data.move_to_end(key)
+            return value
+
+    def put(self, key, value):
+        if self.maxsize <= 0:
+            return
+        with self.lock:
+            expires = None if self.ttl is None else monotonic() + self.ttl
+            self.data[key] = (value, expires)
+            self.data.move_to_end(key)
+            while len(self.data) > self.maxsize:
+                self.data.popitem(last=False)
+
+    def get_or_load(self, key, loader):
+        # Single-flight: concurrent misses on the same key share one loader call
+        sentinel = object()
+        with self.lock:
+            value = self.get(key, sentinel)
+            if value is not sentinel:
+                return value
+            flight = self.inflight.get(key)
+            leader = flight is None
+            if leader:
+                flight = self.inflight[key] = Future()
+                generation = self.generation
+        if not leader:
+            return flight.result()
+
+        try:
+            value = loader()
+        except BaseException as e:
+            with self.lock:
+                if self.inflight.get(key) is flight:
+                    self.inflight.pop(key)
+            flight.set_exception(e)
+            raise
+        with self.lock:
+            if self.inflight.get(key) is flight:
+                self.inflight.pop(key)
+            if generation == self.generation:
+                self.put(key, value)
+        flight.set_result(value)
+        return value
+
+    def invalidate(self, key=None):
+        with self.lock:
+            self.generation += 1
+            if key is None:
+                self.data.clear()
+                self.inflight.clear()
+            else:
+                self.data.pop(key, None)
+                self.inflight.pop(key, None)
+
+    def __contains__(self, key):
+        sentinel = object()
+        return self.get(key, sentinel) is not sentinel
+
+    def __len__(self):
+        return len(self.data)
+
+
+class DiskCache(object):
+    # Keys are prefixed with namespace, e.g. so accounts sharing cache_dir
+    # don't see each other's entries
+    def __init__(self, path,
+                 max_bytes=1 << 30,
+                 namespace="",
+                 touch_batch=64,
+                 touch_interval=5.):
+        super(DiskCache, self).__init__()
+        self.path = Path(path)
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        self.max_bytes = max_bytes
+        self.namespace = namespace
+        self.local = threading.local()
+        # Access times are only an eviction hint: reads queue them and they
+        # are written in batches, so readers don't take the write lock
+        self.touch_batch = touch_batch
+        self.touch_interval = touch_interval
+        self.touched = {}
+        self.touch_lock = threading.Lock()
+        self.last_touch_flush = monotonic()
+        self.connect().execute("CREATE TABLE IF NOT EXISTS entries ("
+                               "key TEXT PRIMARY KEY, "
+                               "value BLOB NOT NULL, "
+                               "size INTEGER NOT NULL, "
+                               "accessed REAL NOT NULL)")
+        self.connect().execute("CREATE INDEX IF NOT EXISTS entries_accessed ON entries (accessed)")
+
+    def connect(self) -> sqlite3.Connection:
+        # sqlite connections are neither thread- nor fork-safe: one per thread per process
+        conn = getattr(self.local, "conn", None)
+        if conn is None or self.local.pid != os.getpid():
+            conn = sqlite3.connect(str(self.path),
+                                   timeout=30,
+                                   isolation_level=None)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            self.local.conn = conn
+            self.local.pid = os.getpid()
+        return conn
+
+    def get(self, key: str, default=None) -> Optional[bytes]:
+        key = self.namespace + key
+        row = self.connect().execute("SELECT value FROM entries WHERE key = ?", (key, )).fetchone()
+        if row is None:
+            return default
+        with self.touch_lock:
+            self.touched[key] = time()
+            due = (len(self.touched) >= self.touch_batch or
+                   monotonic() - self.last_touch_flush >= self.touch_interval)
+        if due:
+            self.flush_touched()
+        return bytes(row[0])
+
+    def take_touched(self):
+        with self.touch_lock:
+            touched, self.touched = self.touched, {}
+            self.last_touch_flush = monotonic()
+        return [(accessed, key) for key, accessed in touched.items()]
+
+    def flush_touched(self):
+        touched = self.take_touched()
+        if not touched:
+            return
+        conn = self.connect()
+        # Don't wait for a busy writer: drop the batch, it only affects eviction order
+        conn.execute("PRAGMA busy_timeout = 0")
+        try:
+            conn.execute("BEGIN IMMEDIATE")
+        except sqlite3.OperationalError:
+            return
+        finally:
+            conn.execute("PRAGMA busy_timeout = 30000")
+        try:
+            conn.executemany("UPDATE entries SET accessed = MAX(accessed, ?) WHERE key = ?", touched)
+            conn.execute("COMMIT")
+        except BaseException:
+            conn.execute("ROLLBACK")
+            raise
+
+    def put(self, key: str, value: bytes):
+        if len(value) > self.max_bytes:
+            return
+        key = self.namespace + key
+        conn = self.connect()
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            conn.executemany("UPDATE entries SET accessed = MAX(accessed, ?) WHERE key = ?", self.take_touched())
+            conn.execute("INSERT OR REPLACE INTO entries (key, value, size, accessed) VALUES (?, ?, ?, ?)",
+                         (key, sqlite3.Binary(value), len(value), time()))
+            total = conn.execute("SELECT COALESCE(SUM(size), 0) FROM entries").fetchone()[0]
+            if total > self.max_bytes:
+                evict = []
+                for old_key, size in conn.execute("SELECT key, size FROM entries WHERE key != ? ORDER BY accessed",
+                                                  (key, )):
+                    if total <= self.max_bytes:
+                        break
+                    evict.append((old_key, ))
+                    total -= size
+                conn.executemany("DELETE FROM entries WHERE key = ?", evict)
+            conn.execute("COMMIT")
+        except BaseException:
+            conn.execute("ROLLBACK")
+            raise
+
+    def get_json(self, key: str, default=None):
+        value = self.get(key)
+        if value is None:
+            return default
+        return json.loads(value.decode('utf-8'))
+
+    def put_json(self, key: str, value):
+        self.put(key, json.dumps(value).encode('utf-8'))
+
+    def invalidate(self, key=None):
+        if key is None:
+            self.connect().execute("DELETE FROM entries WHERE substr(key, 1, ?) = ?",
+                                   (len(self.namespace), self.namespace))
+        else:
+            self.connect().execute("DELETE FROM entries WHERE key = ?", (self.namespace + key, ))
+
+    def __contains__(self, key):
+        return self.connect().execute("SELECT 1 FROM entries WHERE key = ?",
+                                      (self.namespace + key, )).fetchone() is not None
+
+    def __len__(self):
+        return self.connect().execute("SELECT COUNT(*) FROM entries WHERE substr(key, 1, ?) = ?",
+                                      (len(self.namespace), self.namespace)).fetchone()[0]
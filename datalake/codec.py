@@ -0,0 +1,151 @@
+import gzip
+import json
+import threading
+from time import perf_counter
+from typing import Any, Dict, Optional, Tuple
+
+from .metrics import Metrics
+
+
+def load_json_backend(name="auto"):
+    # (dumps -> bytes, loads(bytes)); orjson when available, stdlib otherwise
+    if name in ("auto", "orjson"):
+        try:
+            import orjson
+        except ImportError:
+            if name == "orjson":
+                raise RuntimeError("Codec(json='orjson') requires orjson: pip install orjson")
+        else:
+            def dumps(obj):
+                return orjson.dumps(obj, option=orjson.OPT_SERIALIZE_NUMPY)
+
+            return dumps, orjson.loads
+    if name not in ("auto", "json"):
+        raise NotImplementedError(f"Unknown json backend {name}")
+
+    def dumps(obj):
+        return json.dumps(obj, separators=(",", ":")).encode('utf-8')
+
+    return dumps, json.loads
+
+
+class Codec(object):
+    # Wire format of pierequest payloads. The default is plain JSON in the
+    # __pie_json_data form field, as the server has always accepted.
+    # compression="gzip" / "zstd" compresses payloads of at least
+    # min_compress_bytes and marks the part with Content-Encoding;
+    # format="msgpack" sends and accepts application/msgpack. Both need server
+    # support, so they are opt-in. Responses are parsed by the same backend.
+    def __init__(self, json="auto",
+                 compression: Optional[str] = None,
+                 format="json",
+                 level=None,
+                 min_compress_bytes=1024):
+        super(Codec, self).__init__()
+        self.json_dumps, self.json_loads = load_json_backend(json)
+        if compression not in (None, "gzip", "zstd"):
+            raise NotImplementedError(f"Unknown compression {compression}")
+        if format not in ("json", "msgpack"):
+            raise NotImplementedError(f"Unknown format {format}")
+        self.compression = compression
+        self.format = format
+        self.level = level
+        self.min_compress_bytes = min_compress_bytes
+        self.msgpack = None
+        if format == "msgpack":
+            try:
+                import msgpack
+            except ImportError:
+                raise RuntimeError("Codec(format='msgpack') requires msgpack: pip install msgpack")
+            self.msgpack = msgpack
+        self.zstd = None
+        if compression == "zstd":
+            try:
+                import zstandard
+            except ImportError:
+                raise RuntimeError("Codec(compression='zstd') requires zstandard: pip install zstandard")
+            self.zstd = zstandard
+        self.local = threading.local()
+
+    @property
+    def content_type(self) -> str:
+        return "application/msgpack" if self.format == "msgpack" else "application/json"
+
+    def dumps(self, obj) -> bytes:
+        if self.msgpack is not None:
+            return self.msgpack.packb(obj, use_bin_type=True)
+        return self.json_dumps(obj)
+
+    def loads(self, content: bytes, content_type: Optional[str] = None) -> Any:
+        if self.msgpack is not None and content_type and "msgpack" in content_type:
+            return self.msgpack.unpackb(content, raw=False)
+        return self.json_loads(content)
+
+    def compress(self, data: bytes) -> Tuple[bytes, Optional[str]]:
+        if self.compression is None or len(data) < self.min_compress_bytes:
+            return data, None
+        if self.compression == "gzip":
+            return gzip.compress(data, compresslevel=6 if self.level is None else self.level), "gzip"
+        # zstd contexts are not thread-safe: one per thread
+        compressor = getattr(self.local, "compressor", None)
+        if compressor is None:
+            compressor = self.local.compressor = self.zstd.ZstdCompressor(level=3 if self.level is None else self.level)
+        return compressor.compress(data), "zstd"
+
+    def encode_field(self, obj) -> Tuple[Tuple[Any, ...], int]:
+        # A requests `files` entry for the payload form field, and the
+        # payload size before compression
+        data = self.dumps(obj)
+        size = len(data)
+        if self.format == "json" and self.compression is None:
+            return (None, data), size
+        data, encoding = self.compress(data)
+        headers = {} if encoding is None else {"Content-Encoding": encoding}
+        return (None, data, self.content_type, headers), size
+
+    def request_headers(self) -> Dict[str, str]:
+        headers = {}
+        if self.msgpack is not None:
+            headers["Accept"] = "application/msgpack, application/json;q=0.9"
+        if self.zstd is not None:
+            # urllib3 decodes zstd responses when zstandard is installed
+            headers["Accept-Encoding"] = "zstd, gzip, deflate"
+        return headers
+
+    def decode_response(self, response) -> Any:
+        return self.loads(response.content, response.headers.get("Content-Type"))
+
+
+class WireStats(object):
+    # Per-endpoint request counts, payload/body bytes and codec CPU time: a
+    # view over the byte and codec counters of a Metrics
+    FIELDS = ("requests", "payload_bytes", "request_bytes", "response_bytes", "encode_time", "decode_time")
+
+    def __init__(self, metrics: Optional[Metrics] = None):
+        super(WireStats, self).__init__()
+        self.metrics = Metrics() if metrics is None else metrics
+
+    def snapshot(self) -> Dict[str, Dict[str, float]]:
+        return {endpoint: {field: stats["counters"][field] for field in self.FIELDS}
+                for endpoint, stats in self.metrics.snapshot()["endpoints"].items()}
+
+    def reset(self):
+        self.metrics.reset()
+
+    def summary(self) -> str:
+        lines = []
+        for endpoint, stats in sorted(self.snapshot().items(), key=lambda item: -item[1]["request_bytes"]):
+            line = (f"{endpoint}: {stats['requests']} requests, "
+                    f"sent {stats['request_bytes'] / 1024:.1f}KB")
+            if stats["payload_bytes"] > stats["request_bytes"]:
+                line += f" ({stats['payload_bytes'] / 1024:.1f}KB before compression)"
+            line += (f", received {stats['response_bytes'] / 1024:.1f}KB, "
+                     f"codec {1000 * (stats['encode_time'] + stats['decode_time']):.1f}ms")
+            lines.append(line)
+        return "\n".join(lines)
+
+
+def timed(fn, *args) -> Tuple[Any, float]:
+    t_start = perf_counter()
+    result = fn(*args)
+    return result, perf_counter() - t_start
@@ -1,6 +1,9 @@
 import os
-from time import sleep
-from typing import Optional, Union, TYPE_CHECKING
+import heapq
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from time import sleep, time
+from typing import Optional, Union, Iterator, Iterable, List, Tuple, Dict, Any, TYPE_CHECKING
 if TYPE_CHECKING:
     from .dataset import Dataset
 from .settings import FREEMIUM_SEARCH_LIMIT
@@ -8,26 +11,186 @@ from .settings import FREEMIUM_SEARCH_LIMIT
 
 class DataRequest(object):
     def __init__(self, searcher,
-                 request_id: str):
+                 request_id: str,
+                 search_limit: Optional[int] = None):
         super(DataRequest, self).__init__()
         self.searcher = searcher
         self.request_id = request_id
+        self.search_limit = search_limit
+        self.created_at = time()
+        self.time_to_first_result = None
+        self.time_to_complete = None
+        # Set once the server reports the search has no more results
+        self.finished = False
+        self.cancelled = threading.Event()
 
     def __repr__(self):
         return f"DataRequest({self.request_id})"
 
+    def retrieve_data(self, offset=0):
+        return self.retrieve_page(offset=offset)[0]
+
+    def retrieve_page(self, offset=0):
+        data, finished = self.searcher.retrieve_page(self.request_id,
+                                                     offset=offset)
+        if finished:
+            self.finished = True
+        return data, finished
+
     def retrieve(self):
-        return self.searcher.retrieve_data(self.request_id)
+        data = self.retrieve_data()
+        self.store_if_complete(data)
+        return data
+
+    def store_if_complete(self, data):
+        # Once a search has all its results they never change
+        if self.finished or (self.search_limit is not None and len(data) >= self.search_limit):
+            self.searcher.store_results(self.request_id, data)
+
+    def mark_progress(self, data, n):
+        # Timings of the first result and of reaching n results, also
+        # recorded in the searcher's metrics
+        now = time()
+        metrics = getattr(self.searcher, "metrics", None)
+        if data and self.time_to_first_result is None:
+            self.time_to_first_result = now - self.created_at
+            if metrics is not None:
+                metrics.observe("time_to_first_result", self.time_to_first_result,
+                                request_id=self.request_id)
+        if len(data) >= n and self.time_to_complete is None:
+            self.time_to_complete = now - self.created_at
+            if metrics is not None:
+                metrics.observe("time_to_complete", self.time_to_complete,
+                                request_id=self.request_id)
+
+    def cancel(self):
+        self.cancelled.set()
+
+    def stream(self, n=None,
+               timeout=None,
+               min_interval=0.005,
+               max_interval=1.,
+               backoff=1.5) -> Iterator[Dict[str, Any]]:
+        # Searches may end with fewer than search_limit matches; the server
+        # may not say so, so waiting for all of them needs a timeout
+        if n is None:
+            if timeout is None and self.search_limit is not None and not self.finished:
+                raise RuntimeError(f"{self}: pass n or a timeout to wait for up to search_limit results")
+            n = self.search_limit if self.search_limit is not None else 1
+        deadline = None if timeout is None else time() + timeout
+        interval = min_interval
+        results = []
+        while len(results) < n and not self.cancelled.is_set():
+            data, finished = self.retrieve_page(offset=len(results))
+            if data:
+                results.extend(data)
+                self.mark_progress(results, n)
+                self.store_if_complete(results)
+                for obj in data:
+                    yield obj
+                interval = max(interval / backoff, min_interval)
+                if len(results) >= n:
+                    return
+            if finished:
+                self.mark_progress(results, len(results))
+                return
+
+            now = time()
+            if deadline is not None and now >= deadline:
+                raise TimeoutError(f"{self} got {len(results)} of {n} results in {timeout}s")
+            self.cancelled.wait(interval if deadline is None else min(interval, deadline - now))
+            if not data:
+                interval = min(interval * backoff, max_interval)
 
     def wait(self, n=1,
              timeout=None):
-        wait_time = 1
-        while True:
-            data = self.retrieve()
-            if len(data) >= n:
-                return data
-            wait_time *= 1.01
-            sleep(wait_time)
+        return list(self.stream(n, timeout=timeout))
+
+    @staticmethod
+    def poll_scheduler(requests: List['DataRequest'],
+                       n=None,
+                       timeout=None,
+                       workers=8,
+                       max_polls=None,
+                       min_interval=0.005,
+                       max_interval=1.,
+                       backoff=1.5) -> Iterator[Tuple[int, List[Dict[str, Any]]]]:
+        # One heap of next-poll times shared by all requests. Each round polls
+        # at most max_polls due requests; completed ones leave the heap.
+        if max_polls is None:
+            max_polls = workers
+        if n is None and timeout is None and any(request.search_limit is not None and not request.finished
+                                                 for request in requests):
+            raise RuntimeError("Pass n or a timeout to wait for up to search_limit results")
+        deadline = None if timeout is None else time() + timeout
+        targets = [n if n is not None else (request.search_limit or 1)
+                   for request in requests]
+        results = [[] for _ in requests]
+        intervals = [min_interval] * len(requests)
+        heap = [(0., i) for i in range(len(requests))]
+
+        def poll(i):
+            return requests[i].retrieve_page(offset=len(results[i]))
+
+        with ThreadPoolExecutor(max_workers=max(workers, 1)) as executor:
+            while heap:
+                now = time()
+                if deadline is not None and now >= deadline:
+                    raise TimeoutError(f"{len(heap)} of {len(requests)} requests not completed in {timeout}s")
+                due = []
+                while heap and heap[0][0] <= now and len(due) < max_polls:
+                    due.append(heapq.heappop(heap)[1])
+                if not due:
+                    wake = heap[0][0] if deadline is None else min(heap[0][0], deadline)
+                    sleep(max(wake - now, 0))
+                    continue
+
+                for i, (data, finished) in zip(due, list(executor.map(poll, due))):
+                    request = requests[i]
+                    if data:
+                        results[i].extend(data)
+                        request.mark_progress(results[i], targets[i])
+                        request.store_if_complete(results[i])
+                        intervals[i] = max(intervals[i] / backoff, min_interval)
+                    else:
+                        intervals[i] = min(intervals[i] * backoff, max_interval)
+                    if finished:
+                        request.mark_progress(results[i], len(results[i]))
+
+                    if len(results[i]) >= targets[i] or finished or request.cancelled.is_set():
+                        yield i, results[i]
+                    else:
+                        heapq.heappush(heap, (time() + intervals[i], i))
+
+    @staticmethod
+    def as_completed(requests: Iterable['DataRequest'],
+                     n=None,
+                     timeout=None,
+                     workers=8,
+                     max_polls=None) -> Iterator[Tuple['DataRequest', List[Dict[str, Any]]]]:
+        requests = list(requests)
+        for i, data in DataRequest.poll_scheduler(requests,
+                                                  n=n,
+                                                  timeout=timeout,
+                                                  workers=workers,
+                                                  max_polls=max_polls):
+            yield requests[i], data
+
+    @staticmethod
+    def gather(requests: Iterable['DataRequest'],
+               n=None,
+               timeout=None,
+               workers=8,
+               max_polls=None) -> List[List[Dict[str, Any]]]:
+        requests = list(requests)
+        results = [None] * len(requests)
+        for i, data in DataRequest.poll_scheduler(requests,
+                                                  n=n,
+                                                  timeout=timeout,
+                                                  workers=workers,
+                                                  max_polls=max_polls):
+            results[i] = data
+        return results
 
     def similar(self, data_ids,
                 dataset: Optional['Dataset'] = None,
@@ -42,3 +205,35 @@ class DataRequest(object):
         data = self.retrieve()
         return ipyplot.plot_images([obj['image_url'] for obj in data],
                                    img_width=150)
+
+
+class LocalDataRequest(DataRequest):
+    # Results answered from a local index: complete on creation, no polling
+    def __init__(self, searcher,
+                 data: List[Dict[str, Any]],
+                 search_limit: Optional[int] = None):
+        super(LocalDataRequest, self).__init__(searcher, None,
+                                               search_limit=search_limit)
+        self.data = data
+        self.time_to_first_result = 0.
+        self.time_to_complete = 0.
+        self.finished = True
+
+    def __repr__(self):
+        return f"LocalDataRequest({len(self.data)} results)"
+
+    def retrieve_page(self, offset=0):
+        return self.data[offset:], True
+
+    def store_if_complete(self, data):
+        pass
+
+    def stream(self, n=None, timeout=None, **kwargs) -> Iterator[Dict[str, Any]]:
+        if n is None:
+            n = self.search_limit if self.search_limit is not None else len(self.data)
+        return iter(self.data[:n])
+
+    def similar(self, data_ids,
+                dataset: Optional['Dataset'] = None,
+                search_limit=FREEMIUM_SEARCH_LIMIT) -> 'DataRequest':
+        raise NotImplementedError("Local results have no server-side request")
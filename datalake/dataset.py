@@ -1,10 +1,16 @@
 import os
+import io
+import json
 import subprocess
+from time import sleep, time
 from multiprocessing import cpu_count
-from typing import List, Union, Callable, Dict, Any
+from typing import List, Union, Callable, Dict, Any, Iterable
 import math
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+from functools import partial
+from itertools import islice
 import urllib.parse
-from imantics.color import Color
 from PIL import Image
 from pathlib import Path
 from tqdm import tqdm
@@ -14,20 +20,58 @@ from imantics import Annotation
 from imageio import get_reader
 from imageio.core.format import Format
 
-from .data_request import DataRequest
+from .data_request import DataRequest, LocalDataRequest
 from .annotations import AnnotationSearch, ImageWithAnnotations
 from .integrations.segmentation_masks import SegmentationMasks
 from .settings import FEATURE_DIMENSION, FREEMIUM_SEARCH_LIMIT, PAGE_SIZE
-from .utils import to_base64, from_url
+from .cache import LRUCache
+from .export.engine import ExportEngine
+from .export.masks import rasterize, encode_class_mask, encode_instance_mask, encode_labelmap, read_class_ids, rle_encode, MAX_CLASS_ID
+from .export.geometry import assign_class_ids
+from .export.shards import ShardWriter, write_shards
+from .export.coco import CocoWriter
+from .export.yolo import YoloWriter, read_class_names
+from .pipeline import Pipeline, Stage
+from .duplicates import find_duplicates
+from .errors import UnsupportedEndpoint
+from .index import LocalIndex
+from .utils import to_base64, from_url, imap_bounded, is_jpeg
 from .integrations.cvat import CVATForImages
 
 
+IMPORT_READER = None
+
+
+def init_import_reader(reader):
+    global IMPORT_READER
+    IMPORT_READER = reader
+
+
+def read_import_item(index, max_size=2048):
+    image, annotations = IMPORT_READER[index]
+    # Annotations are stored relative to the image size, so convert them
+    # before the image is downscaled
+    annotations = [ImageWithAnnotations.annotation_to_dict(ann)
+                   if isinstance(ann, Annotation) else ann
+                   for ann in annotations]
+    if max(image.size) > max_size:
+        image.thumbnail((max_size, max_size))
+    buf = io.BytesIO()
+    image.convert("RGB").save(buf, "JPEG")
+    return buf.getvalue(), annotations
+
+
 class Dataset(object):
     def __init__(self, searcher,
-                 dataset_id: str):
+                 dataset_id: str,
+                 page_cache_size=16,
+                 page_cache_ttl=None):
         super(Dataset, self).__init__()
         self.searcher = searcher
         self.dataset_id = dataset_id
+        self.page_cache = LRUCache(maxsize=page_cache_size,
+                                   ttl=page_cache_ttl)
+        self.local_index = None
 
     @staticmethod
     def new(searcher,
@@ -37,17 +81,24 @@ class Dataset(object):
                        dataset_id=dataset_id)
 
     @staticmethod
-    def from_cvat(searcher, cvat_url, credentials, name=None):
+    def from_cvat(searcher, cvat_url, credentials, name=None, **kwargs):
         ds = Dataset.new(searcher, name=name)
         try:
-            ds.add_from_cvat(cvat_url, credentials=credentials)
+            report = ds.add_from_cvat(cvat_url, credentials=credentials, **kwargs)
+            ds.check_report(report)
         except:
             ds.drop()
             raise
         return ds
 
     def add_from_cvat(self, cvat_url,
-                      credentials):
+                      credentials,
+                      download_workers=8,
+                      decode_workers=2,
+                      upload_workers=8,
+                      queue_size=32,
+                      max_retries=3,
+                      progress=True) -> List[Dict[str, Any]]:
         # TODO: add annotations from cvat
         from cvat_sdk import make_client
 
@@ -74,22 +125,47 @@ class Dataset(object):
 
         if job_id is not None:
             cvat_container = client.jobs.retrieve(int(job_id))
+            frames = range(cvat_container.start_frame, cvat_container.stop_frame + 1)
         elif task_id is not None:
             cvat_container = client.tasks.retrieve(int(task_id))
+            frames = range(cvat_container.get_meta().size)
         else:
             raise RuntimeError("Can't retrieve data by url")
 
-        i = 0
-        pbar = tqdm()
-        while True:
-            try:
-                frame = Image.open(cvat_container.get_frame(i, quality="original"))
-            except:
-                break
-            self.add_image(frame)
-            i += 1
-            pbar.update(1)
+        def download(i):
+            for attempt in range(max_retries + 1):
+                try:
+                    return cvat_container.get_frame(i, quality="original").read()
+                except Exception:
+                    if attempt == max_retries:
+                        raise
+                    sleep(2 ** attempt)
+
+        def decode(content):
+            # Original JPEG frames are uploaded without a re-encode
+            if is_jpeg(content):
+                return content
+            return Image.open(io.BytesIO(content)).convert("RGB")
+
+        pipeline = Pipeline([Stage("download", download, download_workers),
+                             Stage("decode", decode, decode_workers),
+                             Stage("upload", self.add_image, upload_workers)],
+                            queue_size=queue_size)
+        t_start = time()
+        report = []
+        pbar = tqdm(total=len(frames), disable=not progress)
+        for index, _, error in pipeline.run(frames, progress=pbar):
+            report.append({
+                "index": index,
+                "frame": frames[index],
+                "status": "ok" if error is None else "error",
+                "message": None if error is None else str(error),
+            })
         pbar.close()
+        if progress:
+            print(pipeline.summary(elapsed=time() - t_start))
+        report.sort(key=lambda r: r["index"])
+        return report
 
     def drop(self):
         self.searcher.dataset_drop(self.dataset_id)
@@ -106,6 +182,7 @@ class Dataset(object):
         self.searcher.dataset_add(self.dataset_id,
                                   data_request.request_id,
                                   data_ids=ids)
+        self.invalidate_cache()
         return self
 
     def remove(self,
@@ -120,6 +197,7 @@ class Dataset(object):
         self.searcher.dataset_remove(self.dataset_id,
                                      data_request.request_id,
                                      data_ids=ids)
+        self.invalidate_cache()
         return self
 
     def count(self):
@@ -140,7 +218,7 @@ class Dataset(object):
         return self.searcher.dataset_info(self.dataset_id)["keyname"]
 
     def add_image(self,
-                  image_or_image_url: Union[str, Image.Image],
+                  image_or_image_url: Union[str, Image.Image, bytes],
                   annotations=None):
 
         if annotations is None:
@@ -151,25 +229,114 @@ class Dataset(object):
 
         response = self.searcher.pierequest("/add_image_to_dataset",
                                             dataset_id=self.dataset_id,
-                                            **(dict(image=to_base64(image_or_image_url)) if isinstance(image_or_image_url, Image.Image) else dict(image_url=image_or_image_url)),
+                                            **(dict(image=to_base64(image_or_image_url)) if isinstance(image_or_image_url, (Image.Image, bytes)) else dict(image_url=image_or_image_url)),
                                             annotations=annotations)
+        self.invalidate_cache()
         if response.get("status") != "ok":
             raise RuntimeError(response.get("message"))
 
+    @staticmethod
+    def unpack_image_item(item):
+        if isinstance(item, (str, Image.Image, bytes)):
+            return item, None
+        if isinstance(item, dict):
+            return item.get("image", item.get("image_url")), item.get("annotations")
+        if isinstance(item, (tuple, list)) and len(item) == 2:
+            return item[0], item[1]
+        raise RuntimeError(f"Expected image, image_url, (image, annotations) or dict, found: {type(item)}")
+
+    @staticmethod
+    def run_bulk(fn: Callable[[Any], Any],
+                 items: Iterable,
+                 workers=8,
+                 max_in_flight=None,
+                 progress=True,
+                 total=None) -> List[Dict[str, Any]]:
+        if total is None and hasattr(items, "__len__"):
+            total = len(items)
+        report = []
+        pbar = tqdm(total=total, disable=not progress)
+        try:
+            for index, _, error in imap_bounded(fn, items,
+                                                workers=workers,
+                                                max_in_flight=max_in_flight):
+                report.append({
+                    "index": index,
+                    "status": "ok" if error is None else "error",
+                    "message": None if error is None else str(error),
+                })
+                pbar.update(1)
+        finally:
+            pbar.close()
+        report.sort(key=lambda r: r["index"])
+        return report
+
+    def add_images(self,
+                   images: Iterable,
+                   workers=8,
+                   max_in_flight=None,
+                   progress=True) -> List[Dict[str, Any]]:
+        def upload(item):
+            image, annotations = self.unpack_image_item(item)
+            self.add_image(image, annotations=annotations)
+
+        return self.run_bulk(upload, images,
+                             workers=workers,
+                             max_in_flight=max_in_flight,
+                             progress=progress)
+
+    @staticmethod
+    def check_report(report: List[Dict[str, Any]]):
+        failed = [r for r in report if r["status"] != "ok"]
+        if failed:
+            raise RuntimeError(f"{len(failed)} of {len(report)} images failed, first error: {failed[0]['message']}")
+
     def remove_image(self, image_url):
         response = self.searcher.pierequest("/remove_image_from_dataset",
                                             dataset_id=self.dataset_id,
                                             image_url=image_url)
+        self.invalidate_cache()
         if response.get("status") != "ok":
             raise RuntimeError(response.get("message"))
 
-    def clear(self):
-        nPages = math.ceil(self.count() / 10)
-        for page in tqdm(range(nPages)):
-            page = nPages - page - 1
-            data = self.retrieve(page)
-            for obj in data:
-                self.remove_image(obj['image_url'])
+    def remove_images(self,
+                      image_urls: Iterable[str],
+                      workers=16,
+                      max_in_flight=None,
+                      progress=True,
+                      total=None) -> List[Dict[str, Any]]:
+        return self.run_bulk(self.remove_image, image_urls,
+                             workers=workers,
+                             max_in_flight=max_in_flight,
+                             progress=progress,
+                             total=total)
+
+    def clear(self, workers=16,
+              prefetch=4,
+              progress=True,
+              max_passes=3):
+        # Every pass starts from the current server state, so an interrupted
+        # clear() is resumed by calling it again.
+        for _ in range(max_passes):
+            self.invalidate_cache()
+            n_images = self.count()
+            if n_images == 0:
+                return
+            # Pages are read back to front: removing images from page k
+            # does not shift the pages before it.
+            n_pages = math.ceil(n_images / PAGE_SIZE)
+            pages = self.iter_pages(reversed(range(n_pages)),
+                                    prefetch=prefetch)
+            self.remove_images((obj['image_url']
+                                for data in pages
+                                for obj in data),
+                               workers=workers,
+                               progress=progress,
+                               total=n_images)
+        self.invalidate_cache()
+        n_images = self.count()
+        if n_images > 0:
+            raise RuntimeError(f"{n_images} images left in dataset after {max_passes} passes")
 
     def retrieve(self, page=0):
         response = self.searcher.pierequest("/retrieve_from_dataset",
@@ -179,79 +346,194 @@ class Dataset(object):
             raise RuntimeError(response.get("message"))
         return response.get("data", [])
 
+    def get_page(self, page):
+        data = self.page_cache.get(page)
+        if data is None:
+            data = self.retrieve(page)
+            self.page_cache.put(page, data)
+        return data
+
+    def get_pages(self, pages: Iterable[int],
+                  workers=8):
+        pages = list(dict.fromkeys(pages))
+        pages_data = {}
+        for page in pages:
+            data = self.page_cache.get(page)
+            if data is not None:
+                pages_data[page] = data
+        missing = [page for page in pages
+                   if page not in pages_data]
+        if not missing:
+            return pages_data
+        with ThreadPoolExecutor(max_workers=max(min(workers, len(missing)), 1)) as executor:
+            for page, data in zip(missing, executor.map(self.retrieve, missing)):
+                self.page_cache.put(page, data)
+                pages_data[page] = data
+        return pages_data
+
+    def invalidate_cache(self, page=None):
+        self.page_cache.invalidate(page)
+        if page is None:
+            self.searcher.invalidate_dataset_info(self.dataset_id)
+
     def export(self, output_path: Path,
-               format='csv'):
+               format='csv',
+               classes: List[str] = None,
+               rle=False,
+               segments=False,
+               shard_count=10000,
+               shard_bytes=1 << 30,
+               workers=16,
+               progress=True):
         output_path = Path(output_path)
         output_path.mkdir(parents=True, exist_ok=True)
+        engine = ExportEngine(output_path,
+                              workers=workers,
+                              progress=progress,
+                              manifest_name=f"manifest.{format}.jsonl")
 
         if format == 'csv':
-            csv_path = output_path / f"{self.keyname}.csv"
-            with csv_path.open("w") as f:
-                f.write('\n'.join([obj['image_url']
-                                   for obj in self.iter(progress=True)]))
-            return csv_path
+            csv_name = f"{self.keyname}.csv"
+            engine.write_atomic(csv_name, '\n'.join([obj['image_url']
+                                                     for obj in self.iter(progress=progress)]).encode('utf-8'))
+            return output_path / csv_name
         elif format == "images":
-            csv_path = self.export(output_path, format='csv')
-            os.system(f"cd {output_path} && cat {csv_path.name} | xargs -P{cpu_count()} -IIMAGE_URL wget 'IMAGE_URL'")
-            os.system(f"rm {csv_path}")
+            def handle(obj, stem, content):
+                return [(stem + engine.extension(obj['image_url']), content)], {}
+
+            engine.run(self.iter(progress=False), handle,
+                       total=self.count())
+            return output_path
+        elif format == "shards":
+            # WebDataset tar shards of {key}.jpg + {key}.json samples
+            write_shards(engine,
+                         ShardWriter(output_path, max_count=shard_count, max_size=shard_bytes),
+                         self.iter(progress=False),
+                         total=self.count())
+            return output_path
+        elif format == "coco":
+            class_ids = {}
+            for label in classes or []:
+                class_ids.setdefault(label, len(class_ids) + 1)
+            writer = CocoWriter(engine, class_ids)
+            engine.run(assign_class_ids(self.iter(progress=False), class_ids), writer.handle,
+                       total=self.count(),
+                       on_entry=writer.on_entry)
+            writer.close()
+            return output_path / writer.json_name
+        elif format == "yolo":
+            class_ids = read_class_names(output_path / "classes.txt")
+            for label in classes or []:
+                class_ids.setdefault(label, len(class_ids))
+            writer = YoloWriter(engine, class_ids, segments=segments)
+            engine.run(assign_class_ids(self.iter(progress=False), class_ids, start=0), writer.handle,
+                       total=self.count())
+            writer.close()
             return output_path
         elif format == "segmentation_masks":
-            classes = {}
-            for i, obj in enumerate(self.iter(progress=True)):
-                image_save_path = output_path / f"{i}.jpg"
-                mask_save_path = output_path / f"{i}_mask.png"
-
-                image_url = obj['image_url']
-                image = from_url(image_url)
-                if image is None:
-                    continue
-                image.save(image_save_path)
-                annotations = [ImageWithAnnotations.annotation_from_dict(ann, image,
-                                                                         annotation_id=i)
-                               for i, ann in enumerate(obj['annotations'])
+            # Pascal VOC layout, readable by import_from(format="segmentation_masks")
+            class_ids = read_class_ids(output_path / "labelmap.txt")
+            for label in classes or []:
+                class_ids.setdefault(label, len(class_ids) + 1)
+
+            def handle(obj, stem, content):
+                if not is_jpeg(content):
+                    buf = io.BytesIO()
+                    Image.open(io.BytesIO(content)).convert("RGB").save(buf, "JPEG")
+                    content = buf.getvalue()
+                size = Image.open(io.BytesIO(content)).size
+                annotations = [ann for ann in obj['annotations']
                                if ann['type'] == "Polygon"]
-                mask = np.zeros((image.size[1], image.size[0], 3), dtype=np.uint8)
-                for ann in annotations:
-                    label = ann.category.name
-                    if label not in classes:
-                        classes[label] = (len(classes), Color.random().rgb)
-                    idx, color = classes[label]
-                    mask[ann.polygons.mask(*image.size).array] = color
-                mask = Image.fromarray(mask)
-                mask.save(mask_save_path)
+                class_mask, instance_mask = rasterize(annotations, size[0], size[1], class_ids)
+                files = [(f"JPEGImages/{stem}.jpg", content),
+                         (f"SegmentationClass/{stem}.png", encode_class_mask(class_mask)),
+                         (f"SegmentationObject/{stem}.png", encode_instance_mask(instance_mask))]
+                if rle:
+                    files.append((f"SegmentationRLE/{stem}.json",
+                                  json.dumps([{"name": ann['name'],
+                                               "segmentation": rle_encode(instance_mask == instance_id)}
+                                              for instance_id, ann in enumerate(annotations, start=1)]).encode('utf-8')))
+                return files, {}
+
+            engine.run(assign_class_ids(self.iter(progress=False), class_ids,
+                                        types=("Polygon", ),
+                                        max_id=MAX_CLASS_ID), handle,
+                       total=self.count())
+            engine.write_atomic("labelmap.txt", encode_labelmap(class_ids))
+            engine.write_atomic("ImageSets/Segmentation/default.txt",
+                                "".join(f"{engine.stem(image_url)}\n"
+                                        for image_url in engine.manifest).encode('utf-8'))
+            return output_path
         else:
             raise NotImplementedError()
 
     def import_from(self,
                     path: Path,
-                    format="cvat_for_images"):
-        if format == "cvat_for_images":
-            reader = CVATForImages(path)
-            for i in tqdm(range(len(reader))):
-                image, annotations = reader[i]
-                if max(image.size) > 2048:
-                    print(f"Image {i} larger than 2048")
-                    continue
-                self.add_image(image,
-                               annotations=annotations)
-        elif format == "segmentation_masks":
-            reader = SegmentationMasks(path)
-            for i in tqdm(range(len(reader))):
-                image, annotations = reader[i]
-                if max(image.size) > 2048:
-                    print(f"Image {i} larger than 2048")
-                    continue
-                self.add_image(image,
-                               annotations=annotations)
+                    format="cvat_for_images",
+                    workers=8,
+                    processes=None,
+                    max_in_flight=None,
+                    max_size=2048,
+                    progress=True):
+        if format == "cvat_for_images" or format == "segmentation_masks":
+            if format == "cvat_for_images":
+                reader = CVATForImages(path)
+            else:
+                reader = SegmentationMasks(path)
+            if processes is None:
+                processes = cpu_count()
+
+            def upload(item):
+                index, payload, error = item
+                if error is None:
+                    try:
+                        self.add_image(payload[0], annotations=payload[1])
+                    except Exception as e:
+                        error = e
+                return index, error
+
+            t_start = time()
+            report = []
+            pbar = tqdm(total=len(reader), disable=not progress)
+            # Decoding and annotation conversion run in processes, uploads in
+            # threads; both stages hold at most max_in_flight items.
+            with ProcessPoolExecutor(max_workers=processes,
+                                     initializer=init_import_reader,
+                                     initargs=(reader, )) as executor:
+                decoded = imap_bounded(partial(read_import_item, max_size=max_size),
+                                       range(len(reader)),
+                                       workers=processes,
+                                       max_in_flight=max_in_flight,
+                                       executor=executor)
+                for _, (index, error), _ in imap_bounded(upload, decoded,
+                                                         workers=workers,
+                                                         max_in_flight=max_in_flight):
+                    report.append({
+                        "index": index,
+                        "status": "ok" if error is None else "error",
+                        "message": None if error is None else str(error),
+                    })
+                    pbar.update(1)
+            pbar.close()
+
+            elapsed = time() - t_start
+            n_ok = sum(r["status"] == "ok" for r in report)
+            if progress:
+                print(f"Imported {n_ok} of {len(report)} images in {elapsed:.1f}s "
+                      f"({n_ok / max(elapsed, 1e-9):.1f} images/s), {len(report) - n_ok} failed")
+            report.sort(key=lambda r: r["index"])
+            return report
         elif format == "video":
             reader: Format.Reader = get_reader(path)
             meta = reader.get_meta_data()
             fps = int(meta['fps'])
-            num_frames = int(meta['duration'] * meta['fps'])
-            for i, frame in enumerate(tqdm(reader, total=num_frames)):
-                frame = Image.fromarray(frame)
-                if i % fps == 0:
-                    self.add_image(frame)
+
+            def read():
+                for i, frame in enumerate(reader):
+                    if i % fps == 0:
+                        yield Image.fromarray(frame)
+
+            return self.add_images(read(), workers=workers)
         else:
             raise NotImplementedError("This format does not supported")
 
@@ -267,22 +549,21 @@ class Dataset(object):
         if self.dataset_id is None and search_limit > FREEMIUM_SEARCH_LIMIT:
             raise NotImplementedError(f"Now free search limit is {FREEMIUM_SEARCH_LIMIT} photos")
 
-        response = self.searcher.pierequest("/search",
-                                            query=query,
-                                            images=[to_base64(im)
-                                                    for im in images
-                                                    if isinstance(im, Image.Image)],
-                                            image_urls=[im
-                                                        for im in images
-                                                        if isinstance(im, str)],
-                                            annotations=[ann.to_dict()
-                                                         for ann in annotations],
-                                            knum=search_limit,
-                                            dataset_id=self.dataset_id)
-        if response.get("status") != "ok":
-            raise RuntimeError(response.get("message"))
-
-        return DataRequest(self.searcher, response.get("request_id"))
+        request_id = self.searcher.submit_search("/search",
+                                                 query=query,
+                                                 images=[to_base64(im)
+                                                         for im in images
+                                                         if isinstance(im, Image.Image)],
+                                                 image_urls=[im
+                                                             for im in images
+                                                             if isinstance(im, str)],
+                                                 annotations=[ann.to_dict()
+                                                              for ann in annotations],
+                                                 knum=search_limit,
+                                                 dataset_id=self.dataset_id)
+
+        return DataRequest(self.searcher, request_id,
+                           search_limit=search_limit)
 
     def deepsearch(self, embedding: np.ndarray,
                    annotations: List[AnnotationSearch] = None,
@@ -297,30 +578,82 @@ class Dataset(object):
         if self.dataset_id is None and search_limit > FREEMIUM_SEARCH_LIMIT:
             raise NotImplementedError(f"Now free search limit is {FREEMIUM_SEARCH_LIMIT} photos")
 
-        response = self.searcher.pierequest("/deepsearch",
-                                            embedding=embedding.tolist(),
-                                            annotations=[ann.to_dict()
-                                                         for ann in annotations],
-                                            knum=search_limit,
-                                            dataset_id=self.dataset_id)
-        if response.get("status") != "ok":
-            raise RuntimeError(response.get("message"))
-
-        return DataRequest(self.searcher, response.get("request_id"))
-
-    def iter(self, progress=True):
+        if self.local_index is not None and not annotations:
+            return LocalDataRequest(self.searcher,
+                                    self.local_index.neighbours(embedding, n=search_limit)[0],
+                                    search_limit=search_limit)
+
+        request_id = self.searcher.submit_search("/deepsearch",
+                                                 embedding=embedding.tolist(),
+                                                 annotations=[ann.to_dict()
+                                                              for ann in annotations],
+                                                 knum=search_limit,
+                                                 dataset_id=self.dataset_id)
+
+        return DataRequest(self.searcher, request_id,
+                           search_limit=search_limit)
+
+    def deepsearch_batch(self, embeddings: np.ndarray,
+                         annotations: List[AnnotationSearch] = None,
+                         search_limit=FREEMIUM_SEARCH_LIMIT,
+                         dtype="float16",
+                         batch_size=64,
+                         workers=8) -> List[DataRequest]:
+        if self.local_index is not None and not annotations:
+            return [LocalDataRequest(self.searcher, data,
+                                     search_limit=search_limit)
+                    for data in self.local_index.neighbours(embeddings, n=search_limit)]
+
+        return self.searcher.deepsearch_batch(embeddings,
+                                              annotations=annotations,
+                                              search_limit=search_limit,
+                                              dataset_id=self.dataset_id,
+                                              dtype=dtype,
+                                              batch_size=batch_size,
+                                              workers=workers)
+
+    def iter_pages(self, pages: Iterable[int],
+                   prefetch=4,
+                   workers=None):
+        pages = iter(pages)
+        if prefetch <= 0:
+            for page in pages:
+                yield self.retrieve(page)
+            return
+
+        if workers is None:
+            workers = prefetch
+        queue = deque()
+        executor = ThreadPoolExecutor(max_workers=max(min(workers, prefetch), 1))
+        try:
+            for page in islice(pages, prefetch):
+                queue.append(executor.submit(self.retrieve, page))
+            while queue:
+                data = queue.popleft().result()
+                for page in islice(pages, 1):
+                    queue.append(executor.submit(self.retrieve, page))
+                yield data
+        finally:
+            for future in queue:
+                future.cancel()
+            executor.shutdown(wait=True)
+
+    def iter(self, progress=True,
+             prefetch=4,
+             workers=None):
         n_images = self.count()
         n_pages = math.ceil(n_images / PAGE_SIZE)
 
-        if progress:
-            pbar = iter(tqdm(range(n_images)))
-        else:
-            pbar = iter(range(n_images))
-
-        for page in range(n_pages):
-            for obj in self.retrieve(page):
-                next(pbar)
-                yield obj
+        pbar = tqdm(total=n_images, disable=not progress)
+        try:
+            for data in self.iter_pages(range(n_pages),
+                                        prefetch=prefetch,
+                                        workers=workers):
+                for obj in data:
+                    pbar.update(1)
+                    yield obj
+        finally:
+            pbar.close()
 
     def __iter__(self):
         return self.iter()
@@ -329,45 +662,64 @@ class Dataset(object):
         return self.count()
 
     def __getitem__(self, index):
-        if isinstance(index, int):
+        if isinstance(index, (int, np.integer)):
+            if index < 0:
+                index += len(self)
             page = index // PAGE_SIZE
             page_index = index - PAGE_SIZE * page
-            return self.retrieve(page)[page_index]
+            return self.get_page(page)[page_index]
         if isinstance(index, list):
-            pages = set(map(lambda idx: idx // PAGE_SIZE, index))
-            pages_data = {page: self.retrieve(page)
-                          for page in pages}
+            if any(idx < 0 for idx in index):
+                n_images = len(self)
+                index = [idx + n_images if idx < 0 else idx
+                         for idx in index]
+            pages_data = self.get_pages(idx // PAGE_SIZE
+                                        for idx in index)
             return [pages_data[idx // PAGE_SIZE][idx - PAGE_SIZE * (idx // PAGE_SIZE)]
                     for idx in index]
         if isinstance(index, slice):
-            return self[list(range(index.start, index.stop, index.step))]
+            return self[list(range(*index.indices(len(self))))]
         raise NotImplementedError("index must be only slice, list or int")
 
     def filter(self, fn: Callable[[Dict[str, Any]], bool],
                suffix: str = "filtered",
-               progress=True):
+               progress=True,
+               workers=8):
         info = self.searcher.dataset_info(self.dataset_id)
         name = info["name"] + "/" + suffix
         new_ds = Dataset.new(self.searcher, name)
-        for obj in self.iter(progress=progress):
-            if fn(obj):
-                new_ds.add_image(obj['image_url'],
-                                 annotations=obj["annotations"])
+        report = new_ds.add_images(({"image_url": obj['image_url'],
+                                     "annotations": obj["annotations"]}
+                                    for obj in self.iter(progress=progress)
+                                    if fn(obj)),
+                                   workers=workers,
+                                   progress=False)
+        self.check_report(report)
         return new_ds
 
     def map(self, fn: Callable[[Dict[str, Any]], Dict[str, Any]],
             suffix: str = "mapped",
-            progress=True):
+            progress=True,
+            workers=8):
         info = self.searcher.dataset_info(self.dataset_id)
         name = info["name"] + "/" + suffix
         new_ds = Dataset.new(self.searcher, name)
-        for obj in self.iter(progress=progress):
-            new_obj = fn(obj)
-            new_ds.add_image(new_obj['image_url'], new_obj["annotations"])
+        report = new_ds.add_images(({"image_url": new_obj['image_url'],
+                                     "annotations": new_obj["annotations"]}
+                                    for new_obj in map(fn, self.iter(progress=progress))),
+                                   workers=workers,
+                                   progress=False)
+        self.check_report(report)
         return new_ds
 
     def nearest_n(self, image_or_image_url: Union[str, Image.Image],
                   n=5):
+        if self.local_index is not None and isinstance(image_or_image_url, str):
+            embedding = self.local_index.vector(image_or_image_url)
+            if embedding is None:
+                embedding = self.searcher.get_embedding(image_or_image_url)
+            return self.local_index.neighbours(embedding, n=n)[0]
+
         request = self.search("",
                               images=[image_or_image_url],
                               annotations=[],
@@ -380,11 +732,128 @@ class Dataset(object):
     def nearest(self, image_or_image_url: Union[str, Image.Image]):
         return self.nearest_n(image_or_image_url, 1)[0]
 
+    def get_embeddings(self, batch_size=100,
+                       workers=8,
+                       path: Path = None,
+                       dtype=np.float16,
+                       progress=True):
+        # (image_urls, embeddings) for the whole dataset, one bulk pass.
+        # With path the matrix is an .npy memmap, so it need not fit in RAM.
+        n_images = self.count()
+        shape = (n_images, FEATURE_DIMENSION)
+        if path is None:
+            embeddings = np.empty(shape, dtype=dtype)
+        else:
+            embeddings = np.lib.format.open_memmap(str(path), mode="w+", dtype=dtype, shape=shape)
+        image_urls = []
+        offsets = []
+
+        def batches():
+            batch = []
+            for obj in islice(self.iter(progress=progress), n_images):
+                batch.append(obj['image_url'])
+                if len(batch) == batch_size:
+                    offsets.append(len(image_urls))
+                    image_urls.extend(batch)
+                    yield batch
+                    batch = []
+            if batch:
+                offsets.append(len(image_urls))
+                image_urls.extend(batch)
+                yield batch
+
+        def load(batch):
+            # One request per call; concurrency comes from imap_bounded
+            return self.searcher.get_embeddings(batch, batch_size=batch_size, workers=1)
+
+        for index, batch_embeddings, error in imap_bounded(load, batches(), workers=workers):
+            if error is not None:
+                raise error
+            offset = offsets[index]
+            embeddings[offset:offset + len(batch_embeddings)] = batch_embeddings
+        return image_urls, embeddings[:len(image_urls)]
+
+    def build_local_index(self, path: Path = None,
+                          kind="exact",
+                          storage="float16",
+                          nlist=None,
+                          nprobe=8,
+                          pq_m=64,
+                          workers=8,
+                          progress=True) -> LocalIndex:
+        # Once built (or loaded), nearest_n, nearest and deepsearch without
+        # annotations are answered locally instead of by remote searches.
+        # Needs the server's /get_embeddings: raises UnsupportedEndpoint
+        # without it, and load_local_index still works.
+        try:
+            image_urls, embeddings = self.get_embeddings(workers=workers,
+                                                         dtype=np.float32 if storage == "float32" else np.float16,
+                                                         progress=progress)
+        except UnsupportedEndpoint as e:
+            raise UnsupportedEndpoint("A local index is built from the server's embeddings, and this server "
+                                      "does not support /get_embeddings; nearest_n and deepsearch keep "
+                                      "using remote search") from e
+        valid = np.flatnonzero(~np.isnan(embeddings).any(axis=1))
+        if len(valid) < len(image_urls):
+            image_urls = [image_urls[i] for i in valid]
+            embeddings = embeddings[valid]
+        self.local_index = LocalIndex.build(image_urls, embeddings,
+                                            kind=kind,
+                                            storage=storage,
+                                            nlist=nlist,
+                                            nprobe=nprobe,
+                                            pq_m=pq_m)
+        if path is not None:
+            self.local_index.save(path)
+        return self.local_index
+
+    def load_local_index(self, path: Path,
+                         mmap=True) -> LocalIndex:
+        self.local_index = LocalIndex.load(path, mmap=mmap)
+        return self.local_index
+
+    def drop_local_index(self):
+        self.local_index = None
+
     def duplicates(self, th=0.9,
                    progress=True,
-                   batch_size=10):
+                   batch_size=10,
+                   workers=8,
+                   block_size=4096,
+                   exact=None,
+                   path: Path = None):
+        # Groups of image urls whose embeddings have cosine similarity > th;
+        # batch_size is the number of neighbours kept per image. Compared
+        # locally from bulk-fetched embeddings when the server has
+        # /get_embeddings, otherwise with one nearest_n search per image.
         if batch_size <= 1:
             raise RuntimeError("If batch_size == 1, nearest=self")
+        if self.searcher.supports("/get_embeddings") is not False:
+            try:
+                image_urls, embeddings = self.get_embeddings(workers=workers,
+                                                             path=path,
+                                                             progress=progress)
+            except UnsupportedEndpoint:
+                pass
+            else:
+                valid = np.flatnonzero(~np.isnan(embeddings).any(axis=1))
+                if len(valid) < len(image_urls):
+                    embeddings = embeddings[valid]
+                groups = find_duplicates(embeddings,
+                                         th=th,
+                                         k=batch_size - 1,
+                                         block_size=block_size,
+                                         exact=exact,
+                                         progress=progress)
+                return set(frozenset(image_urls[valid[i]] for i in group)
+                           for group in groups)
+        return self.remote_duplicates(th=th,
+                                      progress=progress,
+                                      batch_size=batch_size)
+
+    def remote_duplicates(self, th=0.9,
+                          progress=True,
+                          batch_size=10):
         groups = {}
 
         def connect(i, j):
@@ -0,0 +1,125 @@
+from typing import List, Iterator, Tuple, Optional
+import numpy as np
+from tqdm import tqdm
+
+from .vectors import blocked_topk, kmeans, assign
+
+
+EXACT_LIMIT = 200000
+
+
+class UnionFind(object):
+    def __init__(self, n: int):
+        super(UnionFind, self).__init__()
+        self.parent = np.arange(n, dtype=np.int64)
+        self.size = np.ones(n, dtype=np.int64)
+
+    def find(self, i: int) -> int:
+        parent = self.parent
+        while parent[i] != i:
+            # Path halving
+            parent[i] = parent[parent[i]]
+            i = parent[i]
+        return int(i)
+
+    def union(self, i: int, j: int) -> int:
+        i, j = self.find(i), self.find(j)
+        if i == j:
+            return i
+        if self.size[i] < self.size[j]:
+            i, j = j, i
+        self.parent[j] = i
+        self.size[i] += self.size[j]
+        return i
+
+    def groups(self, min_size=2) -> List[List[int]]:
+        # Pointer jumping until every node points at its root
+        roots = self.parent.copy()
+        while True:
+            next_roots = roots[roots]
+            if np.array_equal(next_roots, roots):
+                break
+            roots = next_roots
+        order = np.argsort(roots, kind="stable")
+        bounds = np.flatnonzero(np.diff(roots[order])) + 1
+        return [group.tolist() for group in np.split(order, bounds)
+                if len(group) >= min_size]
+
+
+def similar_pairs(embeddings: np.ndarray,
+                  th=0.9,
+                  k=10,
+                  block_size=4096,
+                  progress=False) -> Iterator[Tuple[np.ndarray, np.ndarray, np.ndarray]]:
+    # Exact: for every row i, up to k rows j > i with cosine similarity > th.
+    # Yields (i, j, score) arrays per row block; memory is O(block_size^2).
+    n = len(embeddings)
+    pbar = tqdm(total=n, disable=not progress)
+    try:
+        for start in range(0, n, block_size):
+            queries = embeddings[start:start + block_size]
+            scores, indices = blocked_topk(queries, embeddings, k,
+                                           block_size=block_size,
+                                           upper=True,
+                                           offset=start,
+                                           threshold=th)
+            rows, cols = np.nonzero(indices >= 0)
+            yield rows + start, indices[rows, cols], scores[rows, cols]
+            pbar.update(len(queries))
+    finally:
+        pbar.close()
+
+
+def clustered_pairs(embeddings: np.ndarray,
+                    th=0.9,
+                    k=10,
+                    nlist=None,
+                    nprobe=2,
+                    block_size=4096,
+                    progress=False) -> Iterator[Tuple[np.ndarray, np.ndarray, np.ndarray]]:
+    # Approximate: k-means partitions with every row in its nprobe nearest
+    # lists; only rows sharing a list are compared. Near-duplicates sit close
+    # together, so recall stays high while work drops to ~N * nprobe * N / nlist.
+    n = len(embeddings)
+    if nlist is None:
+        nlist = max(int(np.sqrt(n)), 1)
+    centroids = kmeans(embeddings, nlist)
+    lists = assign(embeddings, centroids, nprobe=nprobe)
+    members = np.repeat(np.arange(n), lists.shape[1])
+    order = np.argsort(lists.ravel(), kind="stable")
+    bounds = np.flatnonzero(np.diff(lists.ravel()[order])) + 1
+    pbar = tqdm(total=len(order), disable=not progress)
+    try:
+        for group in np.split(members[order], bounds):
+            # Ascending global order, so "j > i" holds within and across lists
+            group = np.sort(group)
+            vectors = np.asarray(embeddings[group])
+            for rows, cols, scores in similar_pairs(vectors, th=th, k=k, block_size=block_size):
+                yield group[rows], group[cols], scores
+            pbar.update(len(group))
+    finally:
+        pbar.close()
+
+
+def find_duplicates(embeddings: np.ndarray,
+                    th=0.9,
+                    k=10,
+                    block_size=4096,
+                    exact: Optional[bool] = None,
+                    nlist: Optional[int] = None,
+                    nprobe=2,
+                    progress=False) -> List[List[int]]:
+    # Groups of row indices connected by similarity > th. Exact blocked
+    # search up to EXACT_LIMIT rows, k-means partitioned above that.
+    uf = UnionFind(len(embeddings))
+    if exact is None:
+        exact = nlist is None and len(embeddings) <= EXACT_LIMIT
+    if exact:
+        pairs = similar_pairs(embeddings, th=th, k=k, block_size=block_size, progress=progress)
+    else:
+        pairs = clustered_pairs(embeddings, th=th, k=k, nlist=nlist, nprobe=nprobe,
+                                block_size=block_size, progress=progress)
+    for rows, cols, _ in pairs:
+        for i, j in zip(rows.tolist(), cols.tolist()):
+            uf.union(i, j)
+    return uf.groups()
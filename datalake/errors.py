@@ -0,0 +1,24 @@
+import re
+
+
+# Endpoints newer than the original API: only these are probed, and
+# fall back when the server doesn't have them
+OPTIONAL_ENDPOINTS = ("/deepsearch_batch", "/get_embeddings")
+# HTTP statuses a server or proxy answers for a route it doesn't have
+UNKNOWN_ENDPOINT_STATUS = (404, 405, 501)
+UNKNOWN_ENDPOINT_MESSAGE = re.compile(
+    r"\b(unknown|unsupported|not found|no such|not implemented|does not exist)\b.*"
+    r"\b(endpoint|route|method|direct|path|url)\b"
+    r"|\b(endpoint|route|method|direct|path|url)\b.*"
+    r"\b(unknown|unsupported|not found|not implemented|does not exist)\b",
+    re.IGNORECASE)
+
+
+class UnsupportedEndpoint(RuntimeError):
+    # The server doesn't know the endpoint (as opposed to the call failing)
+    pass
+
+
+def is_unknown_endpoint(response) -> bool:
+    # For a decoded, non-"ok" response
+    return bool(UNKNOWN_ENDPOINT_MESSAGE.search(str(response.get("message") or "")))
@@ -0,0 +1,90 @@
+import io
+import json
+import shutil
+import tempfile
+from datetime import datetime
+from typing import Dict, Any, Tuple, List
+from PIL import Image
+
+from .engine import ExportEngine
+from .geometry import SPATIAL_TYPES, polygons_from_dict, box_from_dict, polygon_area
+
+
+class CocoWriter(object):
+    # COCO instances JSON written incrementally: image and annotation records
+    # are spooled to temporary files as objects complete and joined into
+    # annotations.json at close, so memory does not grow with the dataset.
+    def __init__(self, engine: ExportEngine,
+                 class_ids: Dict[str, int],
+                 json_name="annotations.json"):
+        super(CocoWriter, self).__init__()
+        self.engine = engine
+        self.class_ids = class_ids
+        self.json_name = json_name
+        self.images = tempfile.TemporaryFile(mode="w+")
+        self.annotations = tempfile.TemporaryFile(mode="w+")
+        self.n_images = 0
+        self.n_annotations = 0
+
+    def handle(self, obj: Dict[str, Any], stem: str, content: bytes) -> Tuple[List[Tuple[str, bytes]], Dict[str, Any]]:
+        # Runs on engine workers: write the image, keep its size in the manifest
+        file_name = f"images/{stem}{self.engine.extension(obj['image_url'])}"
+        width, height = Image.open(io.BytesIO(content)).size
+        return [(file_name, content)], {"file_name": file_name, "width": width, "height": height}
+
+    @staticmethod
+    def append(f, n, record):
+        if n:
+            f.write(",\n")
+        f.write(json.dumps(record))
+
+    def on_entry(self, index: int, obj: Dict[str, Any], entry: Dict[str, Any]):
+        meta = entry["meta"]
+        width, height = meta["width"], meta["height"]
+        image_id = index + 1
+        self.append(self.images, self.n_images, {
+            "id": image_id,
+            "file_name": meta["file_name"],
+            "width": width,
+            "height": height,
+            "coco_url": obj['image_url'],
+        })
+        self.n_images += 1
+
+        for ann in obj['annotations']:
+            if ann['type'] not in SPATIAL_TYPES or ann['name'] not in self.class_ids:
+                continue
+            box = box_from_dict(ann, width, height)
+            if box is None:
+                continue
+            xmin, ymin, xmax, ymax = box
+            polygons = polygons_from_dict(ann, width, height)
+            self.n_annotations += 1
+            self.append(self.annotations, self.n_annotations - 1, {
+                "id": self.n_annotations,
+                "image_id": image_id,
+                "category_id": self.class_ids[ann['name']],
+                "bbox": [round(v, 3) for v in (xmin, ymin, xmax - xmin, ymax - ymin)],
+                "area": round(sum(polygon_area(p) for p in polygons)
+                              if polygons else (xmax - xmin) * (ymax - ymin), 3),
+                "segmentation": [p.ravel().tolist() for p in polygons],
+                "iscrowd": 0,
+            })
+
+    def close(self):
+        with self.engine.atomic_writer(self.json_name) as f:
+            out = io.TextIOWrapper(f, encoding='utf-8')
+            out.write(json.dumps({"info": {"description": "datalake export",
+                                           "date_created": datetime.now().isoformat()}})[:-1])
+            for key, spool in (("images", self.images), ("annotations", self.annotations)):
+                out.write(f', "{key}": [\n')
+                spool.seek(0)
+                shutil.copyfileobj(spool, out)
+                out.write("\n]")
+            categories = [{"id": class_id, "name": label, "supercategory": ""}
+                          for label, class_id in sorted(self.class_ids.items(), key=lambda item: item[1])]
+            out.write(f', "categories": {json.dumps(categories)}}}\n')
+            out.flush()
+            out.detach()
+        self.images.close()
+        self.annotations.close()
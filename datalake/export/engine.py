@@ -0,0 +1,179 @@
+import os
+import json
+import hashlib
+import threading
+import posixpath
+import urllib.parse
+from contextlib import contextmanager
+from pathlib import Path
+from time import sleep, time
+from typing import Callable, Iterable, Iterator, Dict, Any, List, Tuple, Optional
+import requests
+from tqdm import tqdm
+
+from ..utils import fetch_bytes, imap_bounded
+
+
+class ExportEngine(object):
+    def __init__(self, output_path: Path,
+                 workers=16,
+                 max_in_flight=None,
+                 max_retries=3,
+                 timeout=60,
+                 progress=True,
+                 manifest_name="manifest.jsonl"):
+        super(ExportEngine, self).__init__()
+        self.output_path = Path(output_path)
+        self.output_path.mkdir(parents=True, exist_ok=True)
+        self.workers = workers
+        self.max_in_flight = max_in_flight
+        self.max_retries = max_retries
+        self.timeout = timeout
+        self.progress = progress
+        self.manifest_path = self.output_path / manifest_name
+        self.lock = threading.Lock()
+        self.manifest = self.load_manifest()
+
+    def load_manifest(self) -> Dict[str, Dict[str, Any]]:
+        manifest = {}
+        if self.manifest_path.exists():
+            with self.manifest_path.open("r") as f:
+                for line in f:
+                    try:
+                        entry = json.loads(line)
+                    except ValueError:
+                        # Last line of an interrupted run
+                        continue
+                    manifest[entry["image_url"]] = entry
+        return manifest
+
+    @staticmethod
+    def stem(image_url: str) -> str:
+        return hashlib.sha1(image_url.encode('utf-8')).hexdigest()[:20]
+
+    @staticmethod
+    def extension(image_url: str, default=".jpg") -> str:
+        ext = posixpath.splitext(urllib.parse.urlparse(image_url).path)[1].lower()
+        if ext in (".jpg", ".jpeg", ".png", ".bmp", ".gif", ".webp", ".tif", ".tiff"):
+            return ext
+        return default
+
+    @contextmanager
+    def atomic_writer(self, relative_path: str):
+        path = self.output_path / relative_path
+        path.parent.mkdir(parents=True, exist_ok=True)
+        tmp_path = path.parent / f".{path.name}.{os.getpid()}.{threading.get_ident()}.tmp"
+        try:
+            with tmp_path.open("wb") as f:
+                yield f
+            os.replace(str(tmp_path), str(path))
+        finally:
+            if tmp_path.exists():
+                tmp_path.unlink()
+
+    def write_atomic(self, relative_path: str, content: bytes) -> str:
+        with self.atomic_writer(relative_path) as f:
+            f.write(content)
+        return hashlib.sha256(content).hexdigest()
+
+    def is_done(self, image_url: str) -> bool:
+        entry = self.manifest.get(image_url)
+        if entry is None:
+            return False
+        return all((self.output_path / relative_path).exists()
+                   for relative_path in entry["files"])
+
+    def download(self, image_url: str) -> bytes:
+        # Connection errors, timeouts, 5xx and 429 are retried; other
+        # responses (e.g. 404, 403) fail at once
+        for attempt in range(self.max_retries + 1):
+            try:
+                content = fetch_bytes(image_url,
+                                      timeout=self.timeout,
+                                      raise_for_status=True)
+            except requests.HTTPError as e:
+                status = e.response.status_code
+                if (status < 500 and status != 429) or attempt == self.max_retries:
+                    raise RuntimeError(f"Can't download {image_url} (HTTP {status})") from e
+            except (requests.ConnectionError, requests.Timeout):
+                if attempt == self.max_retries:
+                    raise
+            else:
+                if content is None:
+                    raise RuntimeError(f"Can't download {image_url}")
+                return content
+            sleep(2 ** attempt)
+
+    def fetch(self, objs: Iterable[Dict[str, Any]]) -> Iterator[Tuple[int, Dict[str, Any], Optional[bytes], Optional[BaseException]]]:
+        # Concurrent downloads only, for formats written sequentially by the
+        # caller; yields (index, obj, content, error) in completion order
+        def load(obj):
+            try:
+                return obj, self.download(obj['image_url']), None
+            except Exception as e:
+                return obj, None, e
+
+        for index, (obj, content, error), _ in imap_bounded(load, objs,
+                                                            workers=self.workers,
+                                                            max_in_flight=self.max_in_flight):
+            yield index, obj, content, error
+
+    def run(self, objs: Iterable[Dict[str, Any]],
+            handler: Callable[[Dict[str, Any], str, bytes], Tuple[List[Tuple[str, bytes]], Dict[str, Any]]],
+            total=None,
+            on_entry: Optional[Callable[[int, Dict[str, Any], Dict[str, Any]], None]] = None) -> List[Dict[str, Any]]:
+        # handler(obj, stem, content) returns the (relative_path, bytes) files
+        # to write for one object plus metadata kept in the manifest. Objects
+        # already in the manifest are skipped, so an interrupted run resumes.
+        # on_entry(index, obj, entry) is called on the caller's thread.
+        def export(obj):
+            image_url = obj['image_url']
+            if self.is_done(image_url):
+                return "skipped", self.manifest[image_url]
+            stem = self.stem(image_url)
+            content = self.download(image_url)
+            files, meta = handler(obj, stem, content)
+            entry = {"image_url": image_url,
+                     "files": {relative_path: self.write_atomic(relative_path, data)
+                               for relative_path, data in files},
+                     "meta": meta}
+            with self.lock:
+                with self.manifest_path.open("a") as f:
+                    f.write(json.dumps(entry) + "\n")
+                self.manifest[image_url] = entry
+            return "ok", entry
+
+        objs_by_index = {}
+
+        def remember(objs):
+            for index, obj in enumerate(objs):
+                objs_by_index[index] = obj
+                yield obj
+
+        t_start = time()
+        report = []
+        pbar = tqdm(total=total, disable=not self.progress)
+        try:
+            for index, result, error in imap_bounded(export, remember(objs),
+                                                     workers=self.workers,
+                                                     max_in_flight=self.max_in_flight):
+                obj = objs_by_index.pop(index)
+                status = "error" if error is not None else result[0]
+                if error is None and on_entry is not None:
+                    on_entry(index, obj, result[1])
+                report.append({
+                    "index": index,
+                    "status": status,
+                    "message": None if error is None else str(error),
+                })
+                pbar.update(1)
+        finally:
+            pbar.close()
+
+        counts = {status: sum(r["status"] == status for r in report)
+                  for status in ("ok", "skipped", "error")}
+        if self.progress:
+            print(f"Exported {counts['ok']}, skipped {counts['skipped']} already exported, "
+                  f"failed {counts['error']} in {time() - t_start:.1f}s")
+        report.sort(key=lambda r: r["index"])
+        return report
@@ -0,0 +1,54 @@
+from typing import List, Dict, Any, Optional, Tuple
+import numpy as np
+
+
+SPATIAL_TYPES = ("Polygon", "Box")
+
+# Inverses of ImageWithAnnotations.annotation_to_dict: polygons are normalised
+# by np.repeat([width, height], n // 2), Box annotations by [width, height] * 2.
+
+def polygons_from_dict(ann: Dict[str, Any], width, height) -> List[np.ndarray]:
+    return [np.int32(np.array(p) * np.repeat([width, height], len(p) // 2)).reshape((-1, 2))
+            for p in ann.get('segmentation', [])
+            if len(p) >= 6]
+
+
+def box_from_dict(ann: Dict[str, Any], width, height) -> Optional[Tuple[float, float, float, float]]:
+    # (xmin, ymin, xmax, ymax) in pixels
+    polygons = polygons_from_dict(ann, width, height)
+    if polygons:
+        points = np.concatenate(polygons)
+        xmin, ymin = points.min(axis=0)
+        xmax, ymax = points.max(axis=0)
+        return float(xmin), float(ymin), float(xmax), float(ymax)
+    box = ann.get('box')
+    if box is None or len(box) != 4:
+        return None
+    xmin, ymin, xmax, ymax = (np.array(box) * np.array([width, height] * 2)).tolist()
+    return min(xmin, xmax), min(ymin, ymax), max(xmin, xmax), max(ymin, ymax)
+
+
+def polygon_area(points: np.ndarray) -> float:
+    x, y = points[:, 0].astype(np.float64), points[:, 1].astype(np.float64)
+    return float(0.5 * abs(np.dot(x, np.roll(y, 1)) - np.dot(y, np.roll(x, 1))))
+
+
+def assign_class_ids(objs, class_ids: Dict[str, int],
+                     types=SPATIAL_TYPES,
+                     start=1,
+                     max_id: Optional[int] = None):
+    # Class ids are assigned on the iterating thread, in dataset order,
+    # so ids stay stable while objects are processed concurrently.
+    # max_id bounds the ids a format can store (e.g. 8-bit palette masks).
+    def check(class_id):
+        if max_id is not None and class_id > max_id:
+            raise RuntimeError(f"This export format supports at most {max_id - start + 1} classes")
+
+    if class_ids:
+        check(max(class_ids.values()))
+    for obj in objs:
+        for ann in obj['annotations']:
+            if ann['type'] in types and ann['name'] not in class_ids:
+                check(len(class_ids) + start)
+                class_ids[ann['name']] = len(class_ids) + start
+        yield obj
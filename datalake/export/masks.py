@@ -0,0 +1,128 @@
+import io
+from pathlib import Path
+from typing import List, Dict, Any, Tuple
+import numpy as np
+import cv2
+from PIL import Image
+from .geometry import polygons_from_dict
+
+
+def make_palette(n=256) -> List[Tuple[int, int, int]]:
+    # PASCAL VOC colormap: fixed colours per class index, index 0 is black
+    palette = []
+    for i in range(n):
+        r = g = b = 0
+        c = i
+        for j in range(8):
+            r |= ((c >> 0) & 1) << (7 - j)
+            g |= ((c >> 1) & 1) << (7 - j)
+            b |= ((c >> 2) & 1) << (7 - j)
+            c >>= 3
+        palette.append((r, g, b))
+    return palette
+
+
+PALETTE = make_palette()
+# Class ids 1..255 in a uint8 palette mask, 0 is background
+MAX_CLASS_ID = 255
+
+
+def rasterize(annotations: List[Dict[str, Any]],
+              width, height,
+              class_ids: Dict[str, int]) -> Tuple[np.ndarray, np.ndarray]:
+    # Class and instance masks for all Polygon annotations of one image.
+    # Later annotations are drawn over earlier ones.
+    class_mask = np.zeros((height, width), dtype=np.uint8)
+    instance_mask = np.zeros((height, width), dtype=np.uint16)
+    for instance_id, ann in enumerate(annotations, start=1):
+        polygons = polygons_from_dict(ann, width, height)
+        if not polygons:
+            continue
+        label = ann['name']
+        if label not in class_ids:
+            if len(class_ids) >= MAX_CLASS_ID:
+                raise RuntimeError(f"Palette class masks support at most {MAX_CLASS_ID} classes")
+            class_ids[label] = len(class_ids) + 1
+        cv2.fillPoly(class_mask, polygons, int(class_ids[label]))
+        cv2.fillPoly(instance_mask, polygons, instance_id)
+    return class_mask, instance_mask
+
+
+def encode_class_mask(class_mask: np.ndarray) -> bytes:
+    image = Image.fromarray(class_mask, mode="P")
+    image.putpalette([c for color in PALETTE for c in color])
+    buf = io.BytesIO()
+    image.save(buf, "PNG", optimize=True)
+    return buf.getvalue()
+
+
+def encode_instance_mask(instance_mask: np.ndarray) -> bytes:
+    buf = io.BytesIO()
+    if instance_mask.max() < 256:
+        Image.fromarray(instance_mask.astype(np.uint8), mode="L").save(buf, "PNG", optimize=True)
+    else:
+        Image.fromarray(instance_mask, mode="I;16").save(buf, "PNG")
+    return buf.getvalue()
+
+
+def rle_counts(mask: np.ndarray) -> np.ndarray:
+    # Run lengths in column-major order, starting with a run of zeros
+    flat = np.asarray(mask, dtype=np.uint8).ravel(order="F")
+    if flat.size == 0:
+        return np.zeros(0, dtype=np.int64)
+    changes = np.flatnonzero(flat[1:] != flat[:-1]) + 1
+    counts = np.diff(np.concatenate([[0], changes, [flat.size]]))
+    if flat[0] == 1:
+        counts = np.concatenate([[0], counts])
+    return counts
+
+
+def rle_to_string(counts: np.ndarray) -> str:
+    # Compressed COCO RLE string, as pycocotools' rleToString
+    chars = []
+    counts = [int(c) for c in counts]
+    for i, x in enumerate(counts):
+        if i > 2:
+            x -= counts[i - 2]
+        more = True
+        while more:
+            c = x & 0x1f
+            x >>= 5
+            more = (x != -1) if (c & 0x10) else (x != 0)
+            if more:
+                c |= 0x20
+            chars.append(chr(c + 48))
+    return "".join(chars)
+
+
+def rle_encode(mask: np.ndarray) -> Dict[str, Any]:
+    return {
+        "size": [int(mask.shape[0]), int(mask.shape[1])],
+        "counts": rle_to_string(rle_counts(mask)),
+    }
+
+
+def encode_labelmap(class_ids: Dict[str, int]) -> bytes:
+    # Format read back by SegmentationMasks.read_labelmap
+    lines = ["# label:color_rgb:parts:actions",
+             "background:0,0,0::"]
+    for label, class_id in sorted(class_ids.items(), key=lambda item: item[1]):
+        r, g, b = PALETTE[class_id]
+        lines.append(f"{label}:{r},{g},{b}::")
+    return ("\n".join(lines) + "\n").encode('utf-8')
+
+
+def read_class_ids(path: Path) -> Dict[str, int]:
+    class_ids = {}
+    path = Path(path)
+    if not path.exists():
+        return class_ids
+    with path.open("r") as f:
+        for line in f:
+            if line.startswith("#") or ":" not in line:
+                continue
+            label = line.rsplit(":", 3)[0]
+            if label == "background":
+                continue
+            class_ids[label] = len(class_ids) + 1
+    return class_ids
@@ -0,0 +1,181 @@
+import io
+import json
+import hashlib
+import tarfile
+from time import time
+from pathlib import Path
+from typing import Dict, Any, Iterable, List, Optional
+from tqdm import tqdm
+
+from .engine import ExportEngine
+
+
+class HashingWriter(object):
+    def __init__(self, f):
+        super(HashingWriter, self).__init__()
+        self.f = f
+        self.sha256 = hashlib.sha256()
+        self.size = 0
+
+    def write(self, data):
+        self.sha256.update(data)
+        self.size += len(data)
+        return self.f.write(data)
+
+    def tell(self):
+        return self.size
+
+
+class ShardWriter(object):
+    # WebDataset layout: fixed-size tar shards where each sample is a group of
+    # members sharing a key, e.g. {key}.jpg and {key}.json. A shard is written
+    # under a temporary name and renamed once complete; completed shards are
+    # appended to shards.jsonl, so an interrupted export resumes after them.
+    def __init__(self, output_path: Path,
+                 pattern="shard-%06d.tar",
+                 max_count=10000,
+                 max_size=1 << 30):
+        super(ShardWriter, self).__init__()
+        self.output_path = Path(output_path)
+        self.output_path.mkdir(parents=True, exist_ok=True)
+        self.pattern = pattern
+        self.max_count = max_count
+        self.max_size = max_size
+        self.index_path = self.output_path / "shards.jsonl"
+        self.done = set()
+        self.shard_id = 0
+        for entry in self.load_index():
+            self.done.update(entry["keys"])
+            self.shard_id = max(self.shard_id, entry["shard_id"] + 1)
+        self.f = None
+        self.writer = None
+        self.tar = None
+        self.keys = []
+
+    def load_index(self) -> List[Dict[str, Any]]:
+        entries = []
+        if self.index_path.exists():
+            with self.index_path.open("r") as f:
+                for line in f:
+                    try:
+                        entry = json.loads(line)
+                    except ValueError:
+                        continue
+                    if (self.output_path / entry["name"]).exists():
+                        entries.append(entry)
+        return entries
+
+    def is_done(self, key: str) -> bool:
+        return key in self.done
+
+    @property
+    def name(self) -> str:
+        return self.pattern % self.shard_id
+
+    @property
+    def tmp_path(self) -> Path:
+        return self.output_path / f".{self.name}.tmp"
+
+    def open(self):
+        self.f = self.tmp_path.open("wb")
+        self.writer = HashingWriter(self.f)
+        self.tar = tarfile.open(fileobj=self.writer, mode="w", format=tarfile.USTAR_FORMAT)
+        self.keys = []
+
+    def finish(self):
+        if self.tar is None:
+            return
+        self.tar.close()
+        self.f.close()
+        self.tmp_path.replace(self.output_path / self.name)
+        entry = {"shard_id": self.shard_id,
+                 "name": self.name,
+                 "count": len(self.keys),
+                 "size": self.writer.size,
+                 "sha256": self.writer.sha256.hexdigest(),
+                 "keys": self.keys}
+        with self.index_path.open("a") as f:
+            f.write(json.dumps(entry) + "\n")
+        self.done.update(self.keys)
+        self.shard_id += 1
+        self.f = self.writer = self.tar = None
+        self.keys = []
+
+    def write(self, key: str, files: Dict[str, bytes]):
+        if "." in key:
+            raise ValueError(f"Sample key can't contain dots: {key}")
+        if self.tar is None:
+            self.open()
+        mtime = int(time())
+        for ext, data in files.items():
+            info = tarfile.TarInfo(f"{key}.{ext}")
+            info.size = len(data)
+            info.mtime = mtime
+            self.tar.addfile(info, io.BytesIO(data))
+        self.keys.append(key)
+        if len(self.keys) >= self.max_count or self.writer.size >= self.max_size:
+            self.finish()
+
+    def close(self):
+        self.finish()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        if exc_type is None:
+            self.close()
+        elif self.tar is not None:
+            # Incomplete shard: keep only completed ones
+            self.tar.close()
+            self.f.close()
+            self.tmp_path.unlink()
+            self.f = self.writer = self.tar = None
+
+
+def write_shards(engine: ExportEngine,
+                 writer: ShardWriter,
+                 objs: Iterable[Dict[str, Any]],
+                 total: Optional[int] = None) -> List[Dict[str, Any]]:
+    # Downloads run concurrently in the engine, tar writes stay on this thread
+    t_start = time()
+    report = []
+    positions = {}
+    pbar = tqdm(total=total, disable=not engine.progress)
+
+    def pending(objs):
+        for index, obj in enumerate(objs):
+            if writer.is_done(engine.stem(obj['image_url'])):
+                report.append({"index": index, "status": "skipped", "message": None})
+                pbar.update(1)
+                continue
+            positions[len(positions)] = index
+            yield obj
+
+    try:
+        with writer:
+            for position, obj, content, error in engine.fetch(pending(objs)):
+                if error is None:
+                    image_url = obj['image_url']
+                    ext = engine.extension(image_url)[1:]
+                    try:
+                        writer.write(engine.stem(image_url), {ext: content,
+                                                              "json": json.dumps(obj).encode('utf-8')})
+                    except Exception as e:
+                        error = e
+                report.append({
+                    "index": positions.pop(position),
+                    "status": "ok" if error is None else "error",
+                    "message": None if error is None else str(error),
+                })
+                pbar.update(1)
+    finally:
+        pbar.close()
+
+    counts = {status: sum(r["status"] == status for r in report)
+              for status in ("ok", "skipped", "error")}
+    if engine.progress:
+        print(f"Exported {counts['ok']}, skipped {counts['skipped']} already exported, "
+              f"failed {counts['error']} in {time() - t_start:.1f}s; {writer.shard_id} shards in {writer.output_path}")
+    report.sort(key=lambda r: r["index"])
+    return report
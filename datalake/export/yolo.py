@@ -0,0 +1,76 @@
+import io
+import json
+from pathlib import Path
+from typing import Dict, Any, Tuple, List
+from PIL import Image
+
+from .engine import ExportEngine
+from .geometry import SPATIAL_TYPES, polygons_from_dict, box_from_dict
+
+
+def read_class_names(path: Path) -> Dict[str, int]:
+    class_ids = {}
+    path = Path(path)
+    if path.exists():
+        with path.open("r") as f:
+            for line in f:
+                label = line.rstrip("\n")
+                if label:
+                    class_ids[label] = len(class_ids)
+    return class_ids
+
+
+class YoloWriter(object):
+    # Ultralytics layout: images/{stem}.jpg with labels/{stem}.txt holding one
+    # "class cx cy w h" line per box (or "class x1 y1 x2 y2 ..." polygons when
+    # segments=True), all normalised to [0, 1]; class ids start at 0.
+    def __init__(self, engine: ExportEngine,
+                 class_ids: Dict[str, int],
+                 segments=False):
+        super(YoloWriter, self).__init__()
+        self.engine = engine
+        self.class_ids = class_ids
+        self.segments = segments
+
+    def label_lines(self, annotations: List[Dict[str, Any]], width, height) -> List[str]:
+        lines = []
+        for ann in annotations:
+            if ann['type'] not in SPATIAL_TYPES or ann['name'] not in self.class_ids:
+                continue
+            class_id = self.class_ids[ann['name']]
+            polygons = polygons_from_dict(ann, width, height) if self.segments else []
+            if polygons:
+                for polygon in polygons:
+                    points = (polygon / [width, height]).clip(0, 1).ravel()
+                    lines.append(" ".join([str(class_id)] + [f"{v:.6f}" for v in points]))
+                continue
+            box = box_from_dict(ann, width, height)
+            if box is None:
+                continue
+            xmin, ymin, xmax, ymax = box
+            xmin, xmax = max(xmin, 0), min(xmax, width)
+            ymin, ymax = max(ymin, 0), min(ymax, height)
+            if xmax <= xmin or ymax <= ymin:
+                continue
+            lines.append(f"{class_id} {(xmin + xmax) / 2 / width:.6f} {(ymin + ymax) / 2 / height:.6f} "
+                         f"{(xmax - xmin) / width:.6f} {(ymax - ymin) / height:.6f}")
+        return lines
+
+    def handle(self, obj: Dict[str, Any], stem: str, content: bytes) -> Tuple[List[Tuple[str, bytes]], Dict[str, Any]]:
+        width, height = Image.open(io.BytesIO(content)).size
+        lines = self.label_lines(obj['annotations'], width, height)
+        return [(f"images/{stem}{self.engine.extension(obj['image_url'])}", content),
+                (f"labels/{stem}.txt", "".join(line + "\n" for line in lines).encode('utf-8'))], \
+            {"width": width, "height": height}
+
+    def close(self):
+        names = [label for label, _ in sorted(self.class_ids.items(), key=lambda item: item[1])]
+        self.engine.write_atomic("classes.txt", "".join(name + "\n" for name in names).encode('utf-8'))
+        # JSON strings are valid YAML scalars
+        self.engine.write_atomic("data.yaml", "\n".join(
+            [f"path: {json.dumps(str(self.engine.output_path.absolute()))}",
+             "train: images",
+             "val: images",
+             "names:"] +
+            [f"  {class_id}: {json.dumps(name)}" for class_id, name in enumerate(names)]
+        ).encode('utf-8') + b"\n")
@@ -0,0 +1,239 @@
+import json
+from pathlib import Path
+from typing import List, Dict, Any, Optional, Tuple
+import numpy as np
+
+from .settings import FEATURE_DIMENSION
+from .vectors import normalize, blocked_topk, merge_topk, sort_topk, kmeans, assign
+
+
+class LocalIndex(object):
+    # Cosine-similarity index over unit-norm embeddings.
+    #   kind="exact": blocked scan over all rows
+    #   kind="ivf":   k-means lists, rows stored list-contiguous; a query
+    #                 scans its nprobe nearest lists
+    #   storage="float32" / "float16": raw vectors
+    #   storage="pq": pq_m uint8 codes per row (product quantisation),
+    #                 scored with per-query lookup tables
+    # save() writes .npy files that load() memory-maps.
+    def __init__(self, image_urls: List[str],
+                 vectors: Optional[np.ndarray] = None,
+                 codes: Optional[np.ndarray] = None,
+                 codebooks: Optional[np.ndarray] = None,
+                 centroids: Optional[np.ndarray] = None,
+                 list_offsets: Optional[np.ndarray] = None,
+                 nprobe=8,
+                 block_size=65536):
+        super(LocalIndex, self).__init__()
+        self.image_urls = image_urls
+        self.vectors = vectors
+        self.codes = codes
+        self.codebooks = codebooks
+        self.centroids = centroids
+        self.list_offsets = list_offsets
+        self.nprobe = nprobe
+        self.block_size = block_size
+        self.rows = None
+
+    @property
+    def kind(self) -> str:
+        return "exact" if self.centroids is None else "ivf"
+
+    @property
+    def storage(self) -> str:
+        return "pq" if self.codes is not None else str(self.vectors.dtype)
+
+    def __len__(self):
+        return len(self.image_urls)
+
+    def __repr__(self):
+        return f"LocalIndex(images={len(self)}, kind={self.kind}, storage={self.storage})"
+
+    @classmethod
+    def build(cls, image_urls: List[str],
+              embeddings: np.ndarray,
+              kind="exact",
+              storage="float16",
+              nlist=None,
+              nprobe=8,
+              pq_m=64,
+              block_size=65536,
+              seed=0) -> 'LocalIndex':
+        if kind not in ("exact", "ivf"):
+            raise NotImplementedError(f"Unknown index kind {kind}")
+        if storage not in ("float32", "float16", "pq"):
+            raise NotImplementedError(f"Unknown index storage {storage}")
+        n = len(embeddings)
+        centroids = list_offsets = None
+        order = np.arange(n)
+        if kind == "ivf":
+            if nlist is None:
+                nlist = max(int(np.sqrt(n)), 1)
+            centroids = kmeans(embeddings, nlist, seed=seed)
+            lists = assign(embeddings, centroids, block_size=block_size)[:, 0]
+            order = np.argsort(lists, kind="stable")
+            list_offsets = np.concatenate([[0], np.cumsum(np.bincount(lists, minlength=len(centroids)))])
+
+        image_urls = [image_urls[i] for i in order]
+        vectors = np.empty((n, embeddings.shape[1]), dtype=np.float16 if storage == "float16" else np.float32)
+        for start in range(0, n, block_size):
+            vectors[start:start + block_size] = normalize(embeddings[order[start:start + block_size]])
+        if storage != "pq":
+            return cls(image_urls, vectors=vectors,
+                       centroids=centroids, list_offsets=list_offsets,
+                       nprobe=nprobe, block_size=block_size)
+
+        codebooks = cls.train_codebooks(vectors, pq_m, seed=seed)
+        codes = cls.encode(vectors, codebooks, block_size=block_size)
+        return cls(image_urls, codes=codes, codebooks=codebooks,
+                   centroids=centroids, list_offsets=list_offsets,
+                   nprobe=nprobe, block_size=block_size)
+
+    @staticmethod
+    def train_codebooks(vectors: np.ndarray, pq_m: int,
+                        n_codes=256,
+                        seed=0) -> np.ndarray:
+        dim = vectors.shape[1]
+        if dim % pq_m:
+            raise RuntimeError(f"pq_m must divide the embedding dimension {dim}")
+        sub = dim // pq_m
+        return np.stack([kmeans(vectors[:, m * sub:(m + 1) * sub], n_codes,
+                                n_iter=8,
+                                sample_size=32 * n_codes,
+                                spherical=False,
+                                seed=seed + m)
+                         for m in range(pq_m)])
+
+    @staticmethod
+    def encode(vectors: np.ndarray, codebooks: np.ndarray,
+               block_size=65536) -> np.ndarray:
+        pq_m, _, sub = codebooks.shape
+        codes = np.empty((len(vectors), pq_m), dtype=np.uint8)
+        for m in range(pq_m):
+            codes[:, m] = assign(vectors[:, m * sub:(m + 1) * sub], codebooks[m],
+                                 block_size=block_size,
+                                 spherical=False)[:, 0]
+        return codes
+
+    def lookup_tables(self, queries: np.ndarray) -> np.ndarray:
+        # [n_queries, pq_m * n_codes]: inner products of each query
+        # sub-vector with every codeword, flattened for one gather per row
+        pq_m, n_codes, sub = self.codebooks.shape
+        tables = np.einsum("qms,mcs->qmc", queries.reshape(len(queries), pq_m, sub), self.codebooks)
+        return tables.reshape(len(queries), pq_m * n_codes)
+
+    def pq_scores(self, tables: np.ndarray, codes: np.ndarray) -> np.ndarray:
+        pq_m, n_codes, _ = self.codebooks.shape
+        flat = np.asarray(codes, dtype=np.int64) + np.arange(pq_m) * n_codes
+        return np.stack([table[flat].sum(axis=1) for table in tables])
+
+    def scan(self, queries: np.ndarray, start: int, stop: int, k: int,
+             tables: Optional[np.ndarray] = None) -> Tuple[np.ndarray, np.ndarray]:
+        # Top-k over rows [start, stop)
+        if self.codes is None:
+            scores, indices = blocked_topk(queries, self.vectors[start:stop], k,
+                                           block_size=self.block_size,
+                                           normalized=True)
+            return scores, np.where(indices >= 0, indices + start, -1)
+        scores = np.full((len(queries), 0), -np.inf, dtype=np.float32)
+        indices = np.full((len(queries), 0), -1, dtype=np.int64)
+        for col in range(start, stop, self.block_size):
+            block = self.codes[col:min(col + self.block_size, stop)]
+            block_scores = self.pq_scores(tables, block)
+            block_indices = np.broadcast_to(np.arange(col, col + len(block)), block_scores.shape)
+            scores, indices = merge_topk(scores, indices, block_scores, block_indices, k)
+        return scores, indices
+
+    def search(self, queries: np.ndarray,
+               k=10,
+               nprobe=None) -> Tuple[np.ndarray, np.ndarray]:
+        # (scores, rows) of shape [n_queries, k], best first; missing
+        # neighbours have score -inf and row -1
+        queries = normalize(np.atleast_2d(queries))
+        if queries.shape[1] != FEATURE_DIMENSION:
+            raise RuntimeError("Bad embedding shape")
+        tables = None if self.codes is None else self.lookup_tables(queries)
+        if self.centroids is None:
+            scores, indices = self.scan(queries, 0, len(self), k, tables=tables)
+        else:
+            nprobe = min(nprobe or self.nprobe, len(self.centroids))
+            probes = assign(queries, self.centroids, nprobe=nprobe)
+            results = []
+            for q, lists in enumerate(probes):
+                scores = np.full((1, 0), -np.inf, dtype=np.float32)
+                indices = np.full((1, 0), -1, dtype=np.int64)
+                for list_id in lists:
+                    start, stop = int(self.list_offsets[list_id]), int(self.list_offsets[list_id + 1])
+                    if start == stop:
+                        continue
+                    list_scores, list_indices = self.scan(queries[q:q + 1], start, stop, k,
+                                                          tables=None if tables is None else tables[q:q + 1])
+                    scores, indices = merge_topk(scores, indices, list_scores, list_indices, k)
+                results.append((scores, indices))
+            scores = np.full((len(queries), k), -np.inf, dtype=np.float32)
+            indices = np.full((len(queries), k), -1, dtype=np.int64)
+            for q, (query_scores, query_indices) in enumerate(results):
+                scores[q, :query_scores.shape[1]] = query_scores[0]
+                indices[q, :query_indices.shape[1]] = query_indices[0]
+        scores, indices = sort_topk(scores[:, :k], indices[:, :k])
+        return scores, np.where(np.isinf(scores), -1, indices)
+
+    def neighbours(self, embeddings: np.ndarray,
+                   n=5,
+                   nprobe=None) -> List[List[Dict[str, Any]]]:
+        scores, rows = self.search(embeddings, k=n, nprobe=nprobe)
+        return [[{"image_url": self.image_urls[row], "score": float(score)}
+                 for score, row in zip(query_scores, query_rows)
+                 if row >= 0]
+                for query_scores, query_rows in zip(scores, rows)]
+
+    def row(self, image_url: str) -> Optional[int]:
+        if self.rows is None:
+            self.rows = {image_url: i for i, image_url in enumerate(self.image_urls)}
+        return self.rows.get(image_url)
+
+    def vector(self, image_url: str) -> Optional[np.ndarray]:
+        row = self.row(image_url)
+        if row is None:
+            return None
+        if self.codes is None:
+            return np.asarray(self.vectors[row], dtype=np.float32)
+        pq_m = self.codebooks.shape[0]
+        return self.codebooks[np.arange(pq_m), self.codes[row]].ravel()
+
+    def save(self, path: Path):
+        path = Path(path)
+        path.mkdir(parents=True, exist_ok=True)
+        arrays = {"vectors": self.vectors,
+                  "codes": self.codes,
+                  "codebooks": self.codebooks,
+                  "centroids": self.centroids,
+                  "list_offsets": self.list_offsets}
+        for name, array in arrays.items():
+            if array is not None:
+                np.save(str(path / f"{name}.npy"), array)
+        with (path / "image_urls.txt").open("w") as f:
+            f.writelines(image_url + "\n" for image_url in self.image_urls)
+        with (path / "meta.json").open("w") as f:
+            json.dump({"kind": self.kind,
+                       "storage": self.storage,
+                       "size": len(self),
+                       "nprobe": self.nprobe,
+                       "arrays": [name for name, array in arrays.items() if array is not None]}, f)
+
+    @classmethod
+    def load(cls, path: Path,
+             mmap=True,
+             block_size=65536) -> 'LocalIndex':
+        path = Path(path)
+        with (path / "meta.json").open("r") as f:
+            meta = json.load(f)
+        with (path / "image_urls.txt").open("r") as f:
+            image_urls = [line.rstrip("\n") for line in f]
+        arrays = {name: np.load(str(path / f"{name}.npy"),
+                                mmap_mode="r" if mmap and name in ("vectors", "codes") else None)
+                  for name in meta["arrays"]}
+        return cls(image_urls,
+                   nprobe=meta["nprobe"],
+                   block_size=block_size,
+                   **arrays)
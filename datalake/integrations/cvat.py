@@ -7,115 +7,240 @@ from pathlib import Path
 from PIL import Image
 import zipfile
 import io
-from tqdm import tqdm
-from xml.etree.ElementTree import parse, ElementTree, SubElement, Element
+import shutil
+import tempfile
+from collections import Counter
+from typing import Union
+from xml.etree.ElementTree import iterparse, SubElement, Element, tostring
 from imantics import Annotation, Category, BBox, Polygons
+from ..utils import is_jpeg
 
 
 class CVATForImages(object):
     def __init__(self, path):
         super(CVATForImages, self).__init__()
         self.path = path
-        with zipfile.ZipFile(path) as zf:
-            annotations_zip_info = list(filter(lambda x: os.path.basename(x.filename) == "annotations.xml",
-                                               zf.filelist))[0]
-            xml_content = zf.read(annotations_zip_info.filename)
-            self.keys = [finfo.filename
-                         for finfo in zf.filelist]
-        tree = parse(io.StringIO(xml_content.decode('utf-8')))
-        root = tree.getroot()
-        self.annotations = {}
-        for child in tqdm(root, total=len(root)):
-            if child.tag == "image":
-                key = os.path.basename(child.attrib["name"])
-                self.annotations[key] = {
-                    "name": child.attrib["name"],
-                    "width": int(child.attrib["width"]),
-                    "height": int(child.attrib["height"]),
-                    "annotations": []
-                }
-                for ann_child in child:
-                    if ann_child.tag == "box":
-                        ann = Annotation(bbox=BBox([
-                            float(ann_child.attrib['xtl']),
-                            float(ann_child.attrib['ytl']),
-                            float(ann_child.attrib['xbr']),
-                            float(ann_child.attrib['ybr'])]),
-                            category=Category(ann_child.attrib['label']),
-                            metadata={"pietype": "Box"},
-                            image=None,
-                            width=int(child.attrib['width']),
-                            height=int(child.attrib['height']))
-
-                    elif ann_child.tag == "polygon" or ann_child.tag == "polyline":
-                        points = [[float(c) for c in xy.split(',')]
-                                  for xy in ann_child.attrib['points'].split(';')]
-                        points = np.array(points)
-                        ann = Annotation(polygons=Polygons([points]),
-                                         category=Category(ann_child.attrib['label']),
-                                         metadata={"pietype": "Polygon"},
-                                         image=None,
-                                         width=int(child.attrib['width']),
-                                         height=int(child.attrib['height']))
-                    else:
-                        print("Missing loader for", ann_child)
-                        continue
-                    self.annotations[key]["annotations"].append(ann)
-        self.keys = list(filter(lambda key: os.path.basename(key) in self.annotations,
-                                self.keys))
+        self.zf = None
+        self.zf_pid = None
+
+        zf = self.zipfile()
+        annotations_name = list(filter(lambda name: os.path.basename(name) == "annotations.xml",
+                                       zf.namelist()))[0]
+        self.index = {}
+        missing = Counter()
+        with zf.open(annotations_name) as f:
+            root = None
+            for event, elem in iterparse(f, events=("start", "end")):
+                if root is None:
+                    root = elem
+                if event != "end" or elem.tag != "image":
+                    continue
+                self.index[os.path.basename(elem.attrib["name"])] = self.read_image_element(elem, missing)
+                # Drop parsed elements so memory stays flat in the number of images
+                root.clear()
+        if missing:
+            print("Missing loader for", dict(missing))
+
+        self.keys = list(filter(lambda key: os.path.basename(key) in self.index,
+                                zf.namelist()))
+
+    @staticmethod
+    def read_image_element(elem, missing: Counter):
+        anns = []
+        for ann_child in elem:
+            if ann_child.tag == "box":
+                anns.append(("box",
+                             ann_child.attrib['label'],
+                             (float(ann_child.attrib['xtl']),
+                              float(ann_child.attrib['ytl']),
+                              float(ann_child.attrib['xbr']),
+                              float(ann_child.attrib['ybr']))))
+            elif ann_child.tag == "polygon" or ann_child.tag == "polyline":
+                points = np.array([[float(c) for c in xy.split(',')]
+                                   for xy in ann_child.attrib['points'].split(';')],
+                                  dtype=np.float32)
+                anns.append(("polygon", ann_child.attrib['label'], points))
+            elif ann_child.tag == "tag":
+                anns.append(("tag", ann_child.attrib['label'], None))
+            else:
+                missing[ann_child.tag] += 1
+        return (elem.attrib["name"],
+                int(elem.attrib["width"]),
+                int(elem.attrib["height"]),
+                tuple(anns))
+
+    @staticmethod
+    def build_annotation(kind, label, data, width, height):
+        if kind == "tag":
+            # imantics needs a geometry, a tag covers the whole image
+            return Annotation(bbox=BBox([0, 0, width, height]),
+                              category=Category(label),
+                              metadata={"pietype": "Tag"},
+                              image=None,
+                              width=width,
+                              height=height)
+        if kind == "box":
+            return Annotation(bbox=BBox(list(data)),
+                              category=Category(label),
+                              metadata={"pietype": "Box"},
+                              image=None,
+                              width=width,
+                              height=height)
+        return Annotation(polygons=Polygons([np.float64(data)]),
+                          category=Category(label),
+                          metadata={"pietype": "Polygon"},
+                          image=None,
+                          width=width,
+                          height=height)
+
+    def zipfile(self) -> zipfile.ZipFile:
+        # One archive handle per process: handles must not cross a fork
+        if self.zf is None or self.zf_pid != os.getpid():
+            self.zf = zipfile.ZipFile(self.path)
+            self.zf_pid = os.getpid()
+        return self.zf
+
+    def close(self):
+        if self.zf is not None and self.zf_pid == os.getpid():
+            self.zf.close()
+        self.zf = None
+        self.zf_pid = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.close()
+
+    def __getstate__(self):
+        state = dict(self.__dict__)
+        state["zf"] = None
+        state["zf_pid"] = None
+        return state
+
+    def annotations_for(self, index):
+        name, width, height, anns = self.index[os.path.basename(self.keys[index])]
+        return [self.build_annotation(kind, label, data, width, height)
+                for kind, label, data in anns]
+
+    def read_bytes(self, index) -> bytes:
+        return self.zipfile().read(self.keys[index])
 
     def __getitem__(self, index):
-        key = self.keys[index]
-        annotations = self.annotations[os.path.basename(key)]["annotations"]
-        with zipfile.ZipFile(self.path) as zf:
-            im = Image.open(io.BytesIO(zf.read(key))).copy()
-        return im, annotations
+        im = Image.open(io.BytesIO(self.read_bytes(index))).copy()
+        return im, self.annotations_for(index)
 
     def __len__(self):
         return len(self.keys)
 
 
 class CVATForImagesWriter(object):
-    def __init__(self, path):
+    # The archive is built next to path and moved into place by close(): use
+    # it as a context manager. A writer dropped unclosed leaves no archive.
+    def __init__(self, path,
+                 overwrite=False):
+        super(CVATForImagesWriter, self).__init__()
         self.path = path
         self.n_images = 0
-        self.root = Element("xml")
+        self.zf = None
+        if os.path.exists(self.path) and not overwrite:
+            raise RuntimeError(f"{self.path} already exists, pass overwrite=True to replace it")
+        path = Path(self.path)
+        self.tmp_path = path.parent / f".{path.name}.{os.getpid()}.tmp"
+        self.zf = zipfile.ZipFile(self.tmp_path, 'w')
+        # <image> elements are serialised as they come and spliced into
+        # annotations.xml once, on close()
+        self.xml_file = tempfile.TemporaryFile()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.close()
+
+    def __del__(self):
+        # Never finalizes: only discards the unfinished archive
+        if getattr(self, "zf", None) is not None:
+            self.zf.close()
+            self.xml_file.close()
+            if self.tmp_path.exists():
+                self.tmp_path.unlink()
 
-    def write(self, image, annotations=None, key=None):
+    @staticmethod
+    def annotation_elements(image_el, ann):
+        pietype = ann.metadata.get("pietype")
+        label = ann.category.name
+        if pietype == "Box":
+            xtl, ytl, xbr, ybr = ann.bbox.bbox()
+            SubElement(image_el,
+                       "box",
+                       {
+                           "label": label,
+                           "xtl": str(xtl),
+                           "ytl": str(ytl),
+                           "xbr": str(xbr),
+                           "ybr": str(ybr),
+                       })
+        elif pietype == "Polygon":
+            for points in ann.polygons.points:
+                points = np.asarray(points).reshape((-1, 2))
+                SubElement(image_el,
+                           "polygon",
+                           {
+                               "label": label,
+                               "points": ";".join(f"{x},{y}" for x, y in points.tolist()),
+                           })
+        elif pietype == "Tag":
+            SubElement(image_el,
+                       "tag",
+                       {"label": label})
+        else:
+            raise NotImplementedError(f"Can't write annotation with pietype {pietype} to cvat_for_images")
+
+    def write(self, image: Union[Image.Image, bytes],
+              annotations=None,
+              key=None):
         if key is None:
             key = str(self.n_images)
         if annotations is None:
             annotations = []
-        buf = io.BytesIO()
-        image.save(buf, "JPEG")
-        buf.seek(0)
-        image_el = SubElement(self.root,
-                         "image",
-                        {"name": f"{self.n_images}.jpg",
-                               "width": str(image.size[0]),
-                               "height": str(image.size[1])})
+        name = f"{key}.jpg"
+
+        if isinstance(image, bytes) and is_jpeg(image):
+            # Pre-encoded JPEG is stored as is; only the header is parsed for the size
+            content = image
+            size = Image.open(io.BytesIO(content)).size
+        else:
+            if isinstance(image, bytes):
+                # Other formats would end up in a .jpg entry: re-encode
+                image = Image.open(io.BytesIO(image))
+            buf = io.BytesIO()
+            image.convert("RGB").save(buf, "JPEG")
+            content = buf.getvalue()
+            size = image.size
+
+        image_el = Element("image",
+                           {"id": str(self.n_images),
+                            "name": name,
+                            "width": str(size[0]),
+                            "height": str(size[1])})
         for ann in annotations:
-            if ann.metadata.get("pietype") == "Box":
-                ann_el = SubElement(image_el,
-                                    "box",
-                                    {
-                                        "xtl": str(ann.bbox.bbox()[0]),
-                                        "ytl": str(ann.bbox.bbox()[1]),
-                                        "xbr": str(ann.bbox.bbox()[2]),
-                                        "ybr": str(ann.bbox.bbox()[3]),
-                                        "label": ann.category.name,
-                                    })
-            else:
-                print(ann.metadata)
-                raise
-
-        with zipfile.ZipFile(self.path, 'a') as zf:
-            zf.writestr(f"{self.n_images}.jpg",
-                        buf.getvalue())
-            xml_content_file = io.BytesIO()
-            ElementTree(self.root).write(xml_content_file)
-            xml_content_file.seek(0)
-            zf.writestr("annotations.xml",
-                        xml_content_file.getvalue())
+            self.annotation_elements(image_el, ann)
 
+        self.zf.writestr(name, content)
+        self.xml_file.write(tostring(image_el))
+        self.xml_file.write(b"\n")
         self.n_images += 1
+
+    def close(self):
+        if self.zf is None:
+            return
+        self.xml_file.seek(0)
+        with self.zf.open("annotations.xml", 'w') as f:
+            f.write(b'<?xml version="1.0" encoding="utf-8"?>\n<annotations>\n<version>1.1</version>\n')
+            shutil.copyfileobj(self.xml_file, f)
+            f.write(b'</annotations>\n')
+        self.xml_file.close()
+        self.zf.close()
+        self.zf = None
+        os.replace(str(self.tmp_path), str(self.path))
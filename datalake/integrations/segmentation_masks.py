@@ -1,9 +1,8 @@
 from pathlib import Path
 import numpy as np
-import cv2
+from skimage.measure import label
 from parse import parse
 from PIL import Image
-from tqdm import tqdm
 from imantics import Annotation, Category, BBox, Polygons, Mask
 
 
@@ -65,16 +64,53 @@ class SegmentationMasks(object):
     def read_image(path):
         return Image.open(path).convert("RGB")
 
+    @staticmethod
+    def pack_rgb(mask: np.ndarray) -> np.ndarray:
+        mask = mask.astype(np.int32)
+        return (mask[..., 0] << 16) | (mask[..., 1] << 8) | mask[..., 2]
+
+    @staticmethod
+    def decode_labels(labelmap, mask: np.ndarray) -> np.ndarray:
+        # One lookup pass for all classes: colours that are not in the
+        # labelmap decode to -1
+        packed = SegmentationMasks.pack_rgb(mask)
+        if len(labelmap) == 0:
+            return np.full(packed.shape, -1, dtype=np.int32)
+        colors = SegmentationMasks.pack_rgb(np.array([color for _, color in labelmap],
+                                                     dtype=np.uint8).reshape((-1, 3)))
+        order = np.argsort(colors, kind="stable")
+        sorted_colors = colors[order]
+        pos = np.minimum(np.searchsorted(sorted_colors, packed), len(colors) - 1)
+        labels = order[pos].astype(np.int32)
+        labels[sorted_colors[pos] != packed] = -1
+        return labels
+
+    @staticmethod
+    def split_labels(labels: np.ndarray, n_labels):
+        # Per-label boolean masks from a single argsort, only for labels present
+        flat = labels.ravel() + 1
+        counts = np.bincount(flat, minlength=n_labels + 1)
+        order = np.argsort(flat, kind="stable")
+        ends = np.cumsum(counts)
+        masks = {}
+        for i in range(n_labels):
+            if counts[i + 1] == 0:
+                continue
+            m = np.zeros(flat.size, dtype=bool)
+            m[order[ends[i + 1] - counts[i + 1]:ends[i + 1]]] = True
+            masks[i] = m.reshape(labels.shape)
+        return masks
+
     @staticmethod
     def read_annotations(labelmap,
                          mask_path,
                          instance_path):
         mask = np.array(Image.open(mask_path).convert("RGB"))
+        labels = SegmentationMasks.decode_labels(labelmap, mask)
         anns = []
-        for i, (name, color) in enumerate(labelmap):
-            color_array = np.array([[color]], dtype=np.uint8)
-            m = Mask(np.all(mask == color_array, axis=-1))
-            ann = Annotation(mask=m,
+        for i, m in SegmentationMasks.split_labels(labels, len(labelmap)).items():
+            name, color = labelmap[i]
+            ann = Annotation(mask=Mask(m),
                              category=Category(name),
                              metadata={"pietype": "Polygon"})
             anns.append(ann)
@@ -83,25 +119,18 @@ class SegmentationMasks(object):
     @staticmethod
     def read_binary_mask(labelmap, path):
         mask = np.array(Image.open(path).convert("RGB"))
-        mask_bin = np.zeros(mask.shape[:2], dtype=np.int32)
-        for i, (name, color) in enumerate(labelmap):
-            mask_bin += i * np.int32(np.all(mask == np.array([[color]], dtype=np.uint8), axis=-1))
+        mask_bin = SegmentationMasks.decode_labels(labelmap, mask)
+        mask_bin[mask_bin < 0] = 0
         return mask_bin
 
     @staticmethod
     def read_instance_mask(path):
         mask = np.array(Image.open(path).convert('RGB'))
-        mask_bin = np.zeros(mask.shape[:2], dtype=np.int32)
-        colors = list(map(tuple, np.unique(mask.reshape((-1, 3)), axis=0).tolist()))
-        colors.remove((0, 0, 0))
-        curnum = 0
-        for color in tqdm(colors):
-            num, labels = cv2.connectedComponents(255 * np.uint8(np.all(mask == np.array([[color]], dtype=np.uint8), axis=-1)),
-                                                  connectivity=8)
-            mask_bin += (labels > 0) * (labels + curnum)
-            curnum += num
-
-        return mask_bin
+        # label() connects equal-valued pixels, so one pass over the packed
+        # colours splits every colour into its 8-connected components
+        return label(SegmentationMasks.pack_rgb(mask),
+                     background=0,
+                     connectivity=2).astype(np.int32)
 
     def __getitem__(self, index):
         key = self.imageset[index]
@@ -0,0 +1,312 @@
+import io
+import json
+import math
+import mmap
+import random
+import tarfile
+import threading
+from collections import OrderedDict
+from pathlib import Path
+from typing import List, Dict, Any, Iterator, Optional, Tuple, Union
+import numpy as np
+import cv2
+from PIL import Image
+
+from .settings import PAGE_SIZE
+from .export.geometry import SPATIAL_TYPES, polygons_from_dict, box_from_dict
+from .utils import fetch_bytes, imap_bounded, is_jpeg
+
+
+IMAGE_EXTENSIONS = ("jpg", "jpeg", "png", "bmp", "webp", "tif", "tiff")
+
+
+class ShardFile(object):
+    # One tar shard, memory-mapped: member offsets are indexed once and
+    # sample bytes are sliced out of the mapping without copying
+    def __init__(self, path: Path):
+        super(ShardFile, self).__init__()
+        self.path = Path(path)
+        self.samples = OrderedDict()
+        with tarfile.open(str(self.path), "r") as tar:
+            for member in tar:
+                if not member.isfile():
+                    continue
+                key, _, ext = member.name.partition(".")
+                self.samples.setdefault(key, {})[ext] = (member.offset_data, member.size)
+        self.mm = None
+        self.lock = threading.Lock()
+
+    def mapping(self) -> mmap.mmap:
+        with self.lock:
+            if self.mm is None:
+                with self.path.open("rb") as f:
+                    self.mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            return self.mm
+
+    def __getstate__(self):
+        # Mappings and locks don't pickle (e.g. into DataLoader workers)
+        state = self.__dict__.copy()
+        state["mm"] = None
+        state["lock"] = None
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self.lock = threading.Lock()
+
+    def read(self, key: str, ext: str) -> memoryview:
+        offset, size = self.samples[key][ext]
+        return memoryview(self.mapping())[offset:offset + size]
+
+    def keys(self) -> List[str]:
+        return list(self.samples)
+
+    def __len__(self):
+        return len(self.samples)
+
+
+class ShardSource(object):
+    # Exported shards (Dataset.export(format="shards")): a unit is a shard
+    def __init__(self, path: Union[Path, List[Path]]):
+        super(ShardSource, self).__init__()
+        if isinstance(path, (list, tuple)):
+            self.paths = [Path(p) for p in path]
+        else:
+            path = Path(path)
+            self.paths = sorted(path.glob("*.tar")) if path.is_dir() else [path]
+        self.shards = {}
+        self.lock = threading.Lock()
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state["lock"] = None
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self.lock = threading.Lock()
+
+    def units(self) -> List[int]:
+        return list(range(len(self.paths)))
+
+    def shard(self, unit: int) -> ShardFile:
+        with self.lock:
+            if unit not in self.shards:
+                self.shards[unit] = ShardFile(self.paths[unit])
+            return self.shards[unit]
+
+    def items(self, unit: int) -> Iterator[Tuple[int, str]]:
+        for key in self.shard(unit).keys():
+            yield unit, key
+
+    def load(self, item: Tuple[int, str]) -> Tuple[Any, Dict[str, Any]]:
+        unit, key = item
+        shard = self.shard(unit)
+        exts = shard.samples[key]
+        obj = json.loads(bytes(shard.read(key, "json"))) if "json" in exts else {}
+        ext = next(ext for ext in exts if ext in IMAGE_EXTENSIONS)
+        return shard.read(key, ext), obj
+
+
+class DatasetSource(object):
+    # A live Dataset: a unit is a page, images are fetched over HTTP
+    # (through the image cache when enabled)
+    def __init__(self, dataset,
+                 timeout=60):
+        super(DatasetSource, self).__init__()
+        self.dataset = dataset
+        self.timeout = timeout
+
+    def units(self) -> List[int]:
+        return list(range(math.ceil(self.dataset.count() / PAGE_SIZE)))
+
+    def items(self, unit: int) -> Iterator[Dict[str, Any]]:
+        return iter(self.dataset.get_page(unit))
+
+    def load(self, obj: Dict[str, Any]) -> Tuple[Any, Dict[str, Any]]:
+        content = fetch_bytes(obj['image_url'], timeout=self.timeout)
+        if content is None:
+            raise RuntimeError(f"Can't download {obj['image_url']}")
+        return content, obj
+
+
+REDUCED_FLAGS = ((8, cv2.IMREAD_REDUCED_COLOR_8),
+                 (4, cv2.IMREAD_REDUCED_COLOR_4),
+                 (2, cv2.IMREAD_REDUCED_COLOR_2))
+
+
+def image_size(content) -> Tuple[int, int]:
+    # Header only, no decoding
+    return Image.open(io.BytesIO(content)).size
+
+
+def decode_image(content,
+                 size: Optional[Tuple[int, int]] = None) -> Tuple[np.ndarray, Tuple[int, int]]:
+    # Returns the RGB image, resized to size if given, and the original (width, height)
+    buf = np.frombuffer(content, dtype=np.uint8)
+    flags = cv2.IMREAD_COLOR
+    original_size = None
+    if size is not None and is_jpeg(content[:4]):
+        # JPEG can be decoded at 1/2, 1/4 or 1/8 scale directly, which is much
+        # cheaper than a full decode followed by a resize
+        original_size = width, height = image_size(content)
+        for factor, reduced in REDUCED_FLAGS:
+            if width // factor >= size[0] and height // factor >= size[1]:
+                flags = reduced
+                break
+    image = cv2.imdecode(buf, flags)
+    if image is None:
+        raise RuntimeError("Can't decode image")
+    if original_size is None:
+        original_size = (image.shape[1], image.shape[0])
+    image = cv2.cvtColor(image, cv2.COLOR_BGR2RGB)
+    if size is not None and (image.shape[1], image.shape[0]) != tuple(size):
+        image = cv2.resize(image, tuple(size), interpolation=cv2.INTER_AREA)
+    return image, original_size
+
+
+def annotations_to_arrays(annotations: List[Dict[str, Any]],
+                          width, height,
+                          class_ids: Optional[Dict[str, int]] = None,
+                          scale=(1., 1.)) -> Dict[str, Any]:
+    boxes, names, polygons = [], [], []
+    for ann in annotations:
+        if ann['type'] not in SPATIAL_TYPES:
+            continue
+        box = box_from_dict(ann, width, height)
+        if box is None:
+            continue
+        boxes.append(box)
+        names.append(ann['name'])
+        polygons.append([np.float32(p * scale) for p in polygons_from_dict(ann, width, height)])
+    boxes = np.array(boxes, dtype=np.float32).reshape((-1, 4)) * np.float32(scale * 2)
+    labels = np.array([-1 if class_ids is None else class_ids.get(name, -1) for name in names],
+                      dtype=np.int64)
+    tags = [ann['name'] for ann in annotations if ann['type'] == "Tag"]
+    return {"boxes": boxes, "labels": labels, "names": names, "polygons": polygons, "tags": tags}
+
+
+def worker_shard(rank: Optional[int], world_size: Optional[int]) -> Tuple[int, int]:
+    # Defaults to the torch DataLoader worker when running inside one
+    if rank is not None and world_size is not None:
+        return rank, world_size
+    try:
+        from torch.utils.data import get_worker_info
+    except ImportError:
+        return 0, 1
+    info = get_worker_info()
+    if info is None:
+        return 0, 1
+    return info.id, info.num_workers
+
+
+class Loader(object):
+    # Shuffled, per-worker sharded iterator over a Dataset or exported shards.
+    # Units (pages or shards) are shuffled and split across workers, samples
+    # pass through a shuffle buffer, and images are fetched and decoded in a
+    # thread pool with at most `prefetch` samples in flight.
+    def __init__(self, source,
+                 batch_size=None,
+                 shuffle=True,
+                 shuffle_buffer=1000,
+                 seed=0,
+                 rank=None,
+                 world_size=None,
+                 workers=8,
+                 prefetch=64,
+                 size: Optional[Tuple[int, int]] = None,
+                 classes: Optional[List[str]] = None,
+                 drop_last=False):
+        super(Loader, self).__init__()
+        if isinstance(source, (str, Path, list, tuple)):
+            source = ShardSource(source)
+        elif not hasattr(source, "units"):
+            source = DatasetSource(source)
+        self.source = source
+        self.batch_size = batch_size
+        self.shuffle = shuffle
+        self.shuffle_buffer = shuffle_buffer
+        self.seed = seed
+        self.rank = rank
+        self.world_size = world_size
+        self.workers = workers
+        self.prefetch = prefetch
+        self.size = size
+        self.class_ids = None if classes is None else {label: i for i, label in enumerate(classes)}
+        self.drop_last = drop_last
+        self.epoch = 0
+        self.errors = 0
+
+    def set_epoch(self, epoch: int):
+        self.epoch = epoch
+
+    def units(self) -> List:
+        units = self.source.units()
+        if self.shuffle:
+            random.Random(self.seed * 1000003 + self.epoch).shuffle(units)
+        rank, world_size = worker_shard(self.rank, self.world_size)
+        return units[rank::world_size]
+
+    def items(self) -> Iterator:
+        rng = random.Random((self.seed * 1000003 + self.epoch) * 7919 + 1)
+        buffer = []
+        for unit in self.units():
+            for item in self.source.items(unit):
+                if not self.shuffle or self.shuffle_buffer <= 1:
+                    yield item
+                    continue
+                if len(buffer) < self.shuffle_buffer:
+                    buffer.append(item)
+                    continue
+                k = rng.randrange(len(buffer))
+                yield buffer[k]
+                buffer[k] = item
+        rng.shuffle(buffer)
+        yield from buffer
+
+    def load(self, item) -> Dict[str, Any]:
+        content, obj = self.source.load(item)
+        image, (width, height) = decode_image(content, size=self.size)
+        scale = (1., 1.) if self.size is None else (self.size[0] / width, self.size[1] / height)
+        sample = annotations_to_arrays(obj.get('annotations', []), width, height,
+                                       class_ids=self.class_ids,
+                                       scale=scale)
+        sample["image"] = image
+        sample["image_url"] = obj.get('image_url')
+        return sample
+
+    def collate(self, samples: List[Dict[str, Any]]) -> Dict[str, Any]:
+        images = [sample["image"] for sample in samples]
+        if self.size is not None:
+            images = np.stack(images)
+        return {key: images if key == "image" else [sample[key] for sample in samples]
+                for key in samples[0]}
+
+    def samples(self) -> Iterator[Dict[str, Any]]:
+        if self.workers <= 0:
+            for item in self.items():
+                try:
+                    yield self.load(item)
+                except Exception:
+                    self.errors += 1
+            return
+        for _, sample, error in imap_bounded(self.load, self.items(),
+                                             workers=self.workers,
+                                             max_in_flight=self.prefetch):
+            if error is not None:
+                self.errors += 1
+                continue
+            yield sample
+
+    def __iter__(self) -> Iterator[Dict[str, Any]]:
+        if self.batch_size is None:
+            yield from self.samples()
+            return
+        batch = []
+        for sample in self.samples():
+            batch.append(sample)
+            if len(batch) == self.batch_size:
+                yield self.collate(batch)
+                batch = []
+        if batch and not self.drop_last:
+            yield self.collate(batch)
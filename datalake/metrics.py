@@ -0,0 +1,214 @@
+import os
+import json
+import threading
+from bisect import bisect_left
+from pathlib import Path
+from time import time
+from typing import Dict, Any, List, Optional
+
+
+# Upper bounds in seconds, Prometheus-style (a value v lands in the first
+# bucket with v <= le; the last, implicit bucket is +Inf)
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1., 2.5, 5., 10., 30., 60., 300.)
+COUNTERS = ("requests", "retries", "payload_bytes", "request_bytes", "response_bytes",
+            "encode_time", "decode_time", "rate_limit_wait")
+
+
+class Histogram(object):
+    def __init__(self, buckets=LATENCY_BUCKETS):
+        super(Histogram, self).__init__()
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0.
+        self.count = 0
+
+    def observe(self, value: float):
+        self.counts[bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    def quantile(self, q: float) -> float:
+        # Upper bound of the bucket holding the q-th value
+        if self.count == 0:
+            return 0.
+        rank = q * self.count
+        seen = 0
+        for bound, count in zip(self.buckets, self.counts):
+            seen += count
+            if seen >= rank:
+                return bound
+        return float("inf")
+
+    def to_dict(self) -> Dict[str, Any]:
+        return {"buckets": list(self.buckets),
+                "counts": list(self.counts),
+                "sum": self.sum,
+                "count": self.count}
+
+
+class JsonLogSink(object):
+    # One JSON line per event, to a file (appended) or an open stream
+    def __init__(self, path=None,
+                 stream=None):
+        super(JsonLogSink, self).__init__()
+        if (path is None) == (stream is None):
+            raise RuntimeError("JsonLogSink needs exactly one of path or stream")
+        self.stream = stream if path is None else open(path, "a", buffering=1)
+        self.owned = path is not None
+        self.lock = threading.Lock()
+
+    def emit(self, event: Dict[str, Any]):
+        line = json.dumps(event, separators=(",", ":")) + "\n"
+        with self.lock:
+            self.stream.write(line)
+
+    def close(self):
+        if self.owned:
+            self.stream.close()
+
+
+def prometheus_labels(**labels) -> str:
+    return ",".join('{}="{}"'.format(key, str(value).replace("\\", "\\\\").replace('"', '\\"'))
+                    for key, value in labels.items())
+
+
+class Metrics(object):
+    # Per-endpoint request counters, error counts and latency histograms, plus
+    # named timings (e.g. DataRequest time_to_complete). Aggregation is a few
+    # dict updates under one lock per request; sinks (anything with
+    # emit(event)) additionally receive every event as a dict.
+    def __init__(self, sinks: Optional[List[Any]] = None,
+                 buckets=LATENCY_BUCKETS):
+        super(Metrics, self).__init__()
+        self.sinks = list(sinks or [])
+        self.buckets = buckets
+        self.lock = threading.Lock()
+        self.endpoints = {}
+        self.timings = {}
+
+    def add_sink(self, sink):
+        self.sinks.append(sink)
+
+    def emit(self, event: Dict[str, Any]):
+        for sink in self.sinks:
+            sink.emit(event)
+
+    def record(self, endpoint: str, latency: float,
+               error: Optional[str] = None,
+               **values):
+        with self.lock:
+            stats = self.endpoints.get(endpoint)
+            if stats is None:
+                stats = self.endpoints[endpoint] = {"counters": dict.fromkeys(COUNTERS, 0),
+                                                    "errors": {},
+                                                    "latency": Histogram(self.buckets)}
+            counters = stats["counters"]
+            counters["requests"] += 1
+            for key, value in values.items():
+                counters[key] += value
+            if error is not None:
+                stats["errors"][error] = stats["errors"].get(error, 0) + 1
+            stats["latency"].observe(latency)
+        if self.sinks:
+            self.emit({"event": "request", "time": time(), "endpoint": endpoint,
+                       "latency": latency, "error": error, **values})
+
+    def observe(self, name: str, value: float, **fields):
+        with self.lock:
+            histogram = self.timings.get(name)
+            if histogram is None:
+                histogram = self.timings[name] = Histogram(self.buckets)
+            histogram.observe(value)
+        if self.sinks:
+            self.emit({"event": name, "time": time(), "value": value, **fields})
+
+    def snapshot(self) -> Dict[str, Any]:
+        with self.lock:
+            return {"endpoints": {endpoint: {"counters": dict(stats["counters"]),
+                                             "errors": dict(stats["errors"]),
+                                             "latency": stats["latency"].to_dict()}
+                                  for endpoint, stats in self.endpoints.items()},
+                    "timings": {name: histogram.to_dict() for name, histogram in self.timings.items()}}
+
+    def reset(self):
+        with self.lock:
+            self.endpoints.clear()
+            self.timings.clear()
+
+    def summary(self) -> str:
+        lines = []
+        with self.lock:
+            endpoints = sorted(self.endpoints.items(), key=lambda item: -item[1]["latency"].sum)
+            for endpoint, stats in endpoints:
+                counters, latency = stats["counters"], stats["latency"]
+                line = (f"{endpoint}: {counters['requests']} requests, "
+                        f"mean {1000 * latency.sum / latency.count:.0f}ms, "
+                        f"p50 <= {1000 * latency.quantile(0.5):.0f}ms, "
+                        f"p95 <= {1000 * latency.quantile(0.95):.0f}ms, "
+                        f"{counters['retries']} retries, "
+                        f"{sum(stats['errors'].values())} errors, "
+                        f"sent {counters['request_bytes'] / 1024:.1f}KB")
+                if counters["payload_bytes"] > counters["request_bytes"]:
+                    line += f" ({counters['payload_bytes'] / 1024:.1f}KB before compression)"
+                line += (f", received {counters['response_bytes'] / 1024:.1f}KB, "
+                         f"codec {1000 * (counters['encode_time'] + counters['decode_time']):.1f}ms")
+                if counters["rate_limit_wait"]:
+                    line += f", rate limited {counters['rate_limit_wait']:.1f}s"
+                lines.append(line)
+            for name, histogram in sorted(self.timings.items()):
+                lines.append(f"{name}: {histogram.count} requests, "
+                             f"mean {histogram.sum / histogram.count:.2f}s, "
+                             f"p95 <= {histogram.quantile(0.95):g}s")
+        return "\n".join(lines)
+
+    def prometheus(self, prefix="datalake") -> str:
+        # Prometheus text exposition format
+        snapshot = self.snapshot()
+        endpoints = sorted(snapshot["endpoints"].items())
+        lines = []
+
+        def histogram_lines(name, histogram, **labels):
+            cumulative = 0
+            for bound, count in zip(histogram["buckets"] + ["+Inf"], histogram["counts"]):
+                cumulative += count
+                lines.append(f"{name}_bucket{{{prometheus_labels(**labels, le=bound)}}} {cumulative}")
+            lines.append(f"{name}_sum{{{prometheus_labels(**labels)}}} {histogram['sum']}")
+            lines.append(f"{name}_count{{{prometheus_labels(**labels)}}} {histogram['count']}")
+
+        counters = [("requests_total", "requests", "Requests by endpoint"),
+                    ("request_retries_total", "retries", "Retries by endpoint"),
+                    ("request_payload_bytes_total", "payload_bytes", "Payload bytes before compression"),
+                    ("request_bytes_total", "request_bytes", "Request body bytes"),
+                    ("response_bytes_total", "response_bytes", "Response body bytes"),
+                    ("encode_seconds_total", "encode_time", "Payload serialisation time"),
+                    ("decode_seconds_total", "decode_time", "Response parsing time"),
+                    ("rate_limit_wait_seconds_total", "rate_limit_wait", "Time spent waiting for rate limits")]
+        for name, key, help_text in counters:
+            lines.append(f"# HELP {prefix}_{name} {help_text}")
+            lines.append(f"# TYPE {prefix}_{name} counter")
+            for endpoint, stats in endpoints:
+                lines.append(f"{prefix}_{name}{{{prometheus_labels(endpoint=endpoint)}}} {stats['counters'][key]}")
+
+        lines.append(f"# HELP {prefix}_request_errors_total Failed requests by endpoint and kind")
+        lines.append(f"# TYPE {prefix}_request_errors_total counter")
+        for endpoint, stats in endpoints:
+            for kind, count in sorted(stats["errors"].items()):
+                lines.append(f"{prefix}_request_errors_total{{{prometheus_labels(endpoint=endpoint, kind=kind)}}} "
+                             f"{count}")
+
+        lines.append(f"# HELP {prefix}_request_latency_seconds Request latency by endpoint")
+        lines.append(f"# TYPE {prefix}_request_latency_seconds histogram")
+        for endpoint, stats in endpoints:
+            histogram_lines(f"{prefix}_request_latency_seconds", stats["latency"], endpoint=endpoint)
+
+        for name, histogram in sorted(snapshot["timings"].items()):
+            lines.append(f"# TYPE {prefix}_{name}_seconds histogram")
+            histogram_lines(f"{prefix}_{name}_seconds", histogram)
+        return "\n".join(lines) + "\n"
+
+    def write_prometheus(self, path, prefix="datalake"):
+        # Atomic, for node_exporter's textfile collector
+        path = Path(path)
+        tmp_path = path.with_name(f".{path.name}.{os.getpid()}.tmp")
+        tmp_path.write_text(self.prometheus(prefix=prefix))
+        os.replace(str(tmp_path), str(path))
@@ -0,0 +1,133 @@
+import threading
+from queue import Queue, Empty, Full
+from time import time
+from typing import Callable, Iterable, Iterator, List, Tuple, Any, Optional
+
+
+class Stage(object):
+    def __init__(self, name: str,
+                 fn: Callable[[Any], Any],
+                 workers=1):
+        super(Stage, self).__init__()
+        self.name = name
+        self.fn = fn
+        self.workers = max(workers, 1)
+
+
+class Pipeline(object):
+    STOP = object()
+
+    def __init__(self, stages: List[Stage],
+                 queue_size=32):
+        super(Pipeline, self).__init__()
+        self.stages = stages
+        self.queue_size = queue_size
+        self.timings = {stage.name: 0. for stage in stages}
+        self.counts = {stage.name: 0 for stage in stages}
+        self.lock = threading.Lock()
+        self.stopped = threading.Event()
+
+    def put(self, queue: Queue, item) -> bool:
+        while not self.stopped.is_set():
+            try:
+                queue.put(item, timeout=0.1)
+                return True
+            except Full:
+                continue
+        return False
+
+    def get(self, queue: Queue):
+        while not self.stopped.is_set():
+            try:
+                return queue.get(timeout=0.1)
+            except Empty:
+                continue
+        return self.STOP
+
+    def run(self, items: Iterable,
+            progress=None) -> Iterator[Tuple[int, Any, Optional[BaseException]]]:
+        # Yields (index, result, error) in completion order. Each stage reads
+        # from a bounded queue, so at most ~queue_size items wait per stage.
+        self.stopped.clear()
+        queues = [Queue(maxsize=self.queue_size) for _ in self.stages]
+        output = Queue()
+        source_error = []
+        alive = [stage.workers for stage in self.stages]
+
+        def feed():
+            try:
+                for index, item in enumerate(items):
+                    if not self.put(queues[0], (index, item)):
+                        return
+            except BaseException as e:
+                source_error.append(e)
+            finally:
+                for _ in range(self.stages[0].workers):
+                    self.put(queues[0], self.STOP)
+
+        def work(k):
+            stage = self.stages[k]
+            while True:
+                item = self.get(queues[k])
+                if item is self.STOP:
+                    break
+                index, value = item
+                t_start = time()
+                try:
+                    value = stage.fn(value)
+                    error = None
+                except BaseException as e:
+                    error = e
+                with self.lock:
+                    self.timings[stage.name] += time() - t_start
+                    self.counts[stage.name] += 1
+                if error is not None or k + 1 == len(self.stages):
+                    output.put((index, value if error is None else None, error))
+                else:
+                    self.put(queues[k + 1], (index, value))
+
+            with self.lock:
+                alive[k] -= 1
+                last = alive[k] == 0
+            if last:
+                if k + 1 == len(self.stages):
+                    output.put(self.STOP)
+                else:
+                    for _ in range(self.stages[k + 1].workers):
+                        self.put(queues[k + 1], self.STOP)
+
+        threads = [threading.Thread(target=feed, daemon=True)]
+        for k, stage in enumerate(self.stages):
+            threads.extend(threading.Thread(target=work, args=(k, ), daemon=True)
+                           for _ in range(stage.workers))
+        for thread in threads:
+            thread.start()
+
+        try:
+            while True:
+                item = output.get()
+                if item is self.STOP:
+                    break
+                if progress is not None:
+                    progress.update(1)
+                yield item
+            if source_error:
+                raise source_error[0]
+        finally:
+            self.stopped.set()
+            for thread in threads:
+                thread.join()
+
+    def summary(self, elapsed=None) -> str:
+        lines = []
+        for stage in self.stages:
+            count = self.counts[stage.name]
+            busy = self.timings[stage.name]
+            line = f"{stage.name}: {count} items, {busy:.1f}s busy over {stage.workers} workers"
+            if count:
+                line += f", {1000 * busy / count:.1f}ms/item"
+            lines.append(line)
+        if elapsed is not None:
+            count = self.counts[self.stages[-1].name]
+            lines.append(f"total: {count} items in {elapsed:.1f}s ({count / max(elapsed, 1e-9):.1f} items/s)")
+        return "\n".join(lines)
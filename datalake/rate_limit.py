@@ -0,0 +1,261 @@
+import os
+import sqlite3
+import threading
+from contextlib import contextmanager
+from email.utils import parsedate_to_datetime
+from pathlib import Path
+from time import sleep, time
+from typing import Dict, Optional, Any
+
+
+# Endpoint -> budget class; everything else is "default" (unlimited unless
+# a budget is given for it)
+ENDPOINT_CLASSES = {
+    "/search": "search",
+    "/search_similar": "search",
+    "/deepsearch": "search",
+    "/deepsearch_batch": "search",
+    "/retrieve_from_dataset": "download",
+    "/get_embeddings": "download",
+}
+QUOTE_KEYS = {"search": "searches_quote", "download": "download_quote"}
+LANES = ("interactive", "batch")
+
+
+class RateLimited(RuntimeError):
+    pass
+
+
+def request_cost(endpoint, data) -> float:
+    # /deepsearch_batch submits one search per embedding
+    if endpoint == "/deepsearch_batch":
+        return float(data.get("shape", [1])[0])
+    return 1.
+
+
+def parse_retry_after(value) -> Optional[float]:
+    if not value:
+        return None
+    try:
+        return max(float(value), 0.)
+    except ValueError:
+        pass
+    try:
+        return max(parsedate_to_datetime(value).timestamp() - time(), 0.)
+    except (TypeError, ValueError):
+        return None
+
+
+class MemoryStore(object):
+    # Bucket state for one process
+    def __init__(self):
+        super(MemoryStore, self).__init__()
+        self.lock = threading.Lock()
+        self.buckets = {}
+
+    def blocked_until(self, name) -> float:
+        with self.lock:
+            return self.buckets.get(name, {}).get("blocked_until", 0.)
+
+    @contextmanager
+    def transaction(self):
+        with self.lock:
+            yield self.buckets
+
+
+class SharedStore(object):
+    # Bucket state in a sqlite file, shared by every process on the host that
+    # uses the same key; BEGIN IMMEDIATE serialises the read-modify-write
+    def __init__(self, path):
+        super(SharedStore, self).__init__()
+        self.path = Path(path)
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        self.local = threading.local()
+        self.connect().execute("CREATE TABLE IF NOT EXISTS buckets ("
+                               "name TEXT PRIMARY KEY, "
+                               "tokens REAL NOT NULL, "
+                               "updated REAL NOT NULL, "
+                               "blocked_until REAL NOT NULL)")
+
+    def connect(self) -> sqlite3.Connection:
+        # sqlite connections are neither thread- nor fork-safe: one per thread per process
+        conn = getattr(self.local, "conn", None)
+        if conn is None or self.local.pid != os.getpid():
+            conn = sqlite3.connect(str(self.path),
+                                   timeout=30,
+                                   isolation_level=None)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            self.local.conn = conn
+            self.local.pid = os.getpid()
+        return conn
+
+    def blocked_until(self, name) -> float:
+        row = self.connect().execute("SELECT blocked_until FROM buckets WHERE name = ?", (name, )).fetchone()
+        return 0. if row is None else row[0]
+
+    @contextmanager
+    def transaction(self):
+        conn = self.connect()
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            buckets = {name: {"tokens": tokens, "updated": updated, "blocked_until": blocked_until}
+                       for name, tokens, updated, blocked_until
+                       in conn.execute("SELECT name, tokens, updated, blocked_until FROM buckets")}
+            yield buckets
+            conn.executemany("INSERT OR REPLACE INTO buckets (name, tokens, updated, blocked_until) "
+                             "VALUES (?, ?, ?, ?)",
+                             [(name, state["tokens"], state["updated"], state["blocked_until"])
+                              for name, state in buckets.items()])
+            conn.execute("COMMIT")
+        except BaseException:
+            conn.execute("ROLLBACK")
+            raise
+
+
+class RateLimiter(object):
+    # Token buckets per endpoint class, refilled continuously from per-hour
+    # budgets (Searcher.limits(), or explicit `budgets`). A bucket holds
+    # `burst` of the hourly budget and refills at the rest, so no hour window
+    # goes over the quota. The batch lane can't take the last `reserve` of a
+    # bucket, which stays available to interactive calls. 429 responses block
+    # the class for Retry-After seconds (exponential backoff without one).
+    def __init__(self, store=None,
+                 budgets: Optional[Dict[str, Optional[float]]] = None,
+                 classes: Optional[Dict[str, str]] = None,
+                 lane="interactive",
+                 burst=0.1,
+                 reserve=0.5,
+                 max_backoff=300.):
+        super(RateLimiter, self).__init__()
+        if lane not in LANES:
+            raise NotImplementedError(f"Unknown lane {lane}")
+        self.store = MemoryStore() if store is None else store
+        self.overrides = dict(budgets or {})
+        self.budgets = dict(self.overrides)
+        self.classes = dict(ENDPOINT_CLASSES if classes is None else classes)
+        self.default_lane = lane
+        self.burst = burst
+        self.reserve = reserve
+        self.max_backoff = max_backoff
+        self.configured = False
+        self.strikes = {}
+        self.local = threading.local()
+        self.lock = threading.Lock()
+
+    def configure(self, limits):
+        # Seeds budgets from a Limits; explicit budgets win, -1 is unlimited
+        with self.lock:
+            for name, key in QUOTE_KEYS.items():
+                quote = limits.data.get(key, -1)
+                self.budgets[name] = None if quote is None or quote < 0 else float(quote)
+            self.budgets.update(self.overrides)
+            self.configured = True
+
+    def endpoint_class(self, endpoint) -> str:
+        return self.classes.get(endpoint, "default")
+
+    def current_lane(self, default=None) -> str:
+        return getattr(self.local, "lane", None) or default or self.default_lane
+
+    @contextmanager
+    def lane(self, name):
+        if name not in LANES:
+            raise NotImplementedError(f"Unknown lane {name}")
+        previous = getattr(self.local, "lane", None)
+        self.local.lane = name
+        try:
+            yield self
+        finally:
+            self.local.lane = previous
+
+    def bind(self, fn, default=None):
+        # Runs fn in the calling thread's lane (e.g. inside imap_bounded workers)
+        lane = self.current_lane(default)
+
+        def wrapper(*args, **kwargs):
+            with self.lane(lane):
+                return fn(*args, **kwargs)
+
+        return wrapper
+
+    def bucket_size(self, budget) -> float:
+        return max(budget * self.burst, 1.)
+
+    def try_acquire(self, name, cost, lane) -> float:
+        # 0 when the call may go now, otherwise seconds to wait
+        budget = self.budgets.get(name)
+        if budget is None:
+            # Unlimited: only a server backoff can hold the call, no write needed
+            return max(self.store.blocked_until(name) - time(), 0.)
+        with self.store.transaction() as buckets:
+            now = time()
+            state = buckets.get(name)
+            if state is None:
+                state = buckets[name] = {"tokens": self.bucket_size(budget), "updated": now, "blocked_until": 0.}
+            if state["blocked_until"] > now:
+                return state["blocked_until"] - now
+            if budget == 0:
+                raise RateLimited(f"No {name} quota left")
+            size = self.bucket_size(budget)
+            rate = budget * (1 - self.burst) / 3600
+            tokens = min(size, state["tokens"] + (now - state["updated"]) * rate)
+            floor = size * self.reserve if lane == "batch" else 0.
+            # Calls costing more than a bucket go when it is full, into debt
+            need = min(cost, size - floor)
+            state["updated"] = now
+            if tokens - floor >= need:
+                state["tokens"] = tokens - cost
+                return 0.
+            state["tokens"] = tokens
+            return (floor + need - tokens) / rate
+
+    def acquire(self, endpoint, data=None) -> float:
+        # Blocks until the call may go; returns the seconds waited
+        name = self.endpoint_class(endpoint)
+        cost = request_cost(endpoint, data or {})
+        lane = self.current_lane()
+        waited = 0.
+        while True:
+            wait = self.try_acquire(name, cost, lane)
+            if wait <= 0:
+                return waited
+            # Re-check periodically: other processes may back off or refill
+            wait = min(wait, 5.)
+            sleep(wait)
+            waited += wait
+
+    def backoff(self, endpoint, retry_after=None) -> float:
+        # Called on a 429; blocks the endpoint class for every thread and process
+        name = self.endpoint_class(endpoint)
+        with self.lock:
+            strikes = self.strikes[name] = self.strikes.get(name, 0) + 1
+        delay = retry_after
+        if delay is None:
+            delay = min(2. ** strikes, self.max_backoff)
+        with self.store.transaction() as buckets:
+            now = time()
+            state = buckets.setdefault(name, {"tokens": 0., "updated": now, "blocked_until": 0.})
+            state["blocked_until"] = max(state["blocked_until"], now + delay)
+        return delay
+
+    def success(self, endpoint):
+        name = self.endpoint_class(endpoint)
+        if self.strikes.get(name):
+            with self.lock:
+                self.strikes[name] = 0
+
+    def snapshot(self) -> Dict[str, Dict[str, Any]]:
+        with self.store.transaction() as buckets:
+            now = time()
+            result = {}
+            for name, state in buckets.items():
+                budget = self.budgets.get(name)
+                tokens = state["tokens"]
+                if budget:
+                    rate = budget * (1 - self.burst) / 3600
+                    tokens = min(self.bucket_size(budget), tokens + (now - state["updated"]) * rate)
+                result[name] = {"budget": budget,
+                                "tokens": tokens,
+                                "blocked_for": max(state["blocked_until"] - now, 0.)}
+            return result
@@ -4,55 +4,188 @@ from requests.adapters import HTTPAdapter
 from requests.packages.urllib3.util import Retry
 
 import json
+import hashlib
+import threading
+from time import perf_counter
+from pathlib import Path
 from PIL import Image
 from typing import List
 import numpy as np
+from .cache import LRUCache, DiskCache
+from .codec import Codec, WireStats, timed
+from .errors import UnsupportedEndpoint, OPTIONAL_ENDPOINTS, UNKNOWN_ENDPOINT_STATUS, is_unknown_endpoint
 from .limits import Limits
+from .metrics import Metrics
+from .rate_limit import RateLimiter, RateLimited, SharedStore, parse_retry_after
 from .annotations import AnnotationSearch
 from .data_request import DataRequest
 from .dataset import Dataset
-from .settings import FEATURE_DIMENSION, FREEMIUM_SEARCH_LIMIT
-from .utils import to_base64, from_url
+from .settings import FEATURE_DIMENSION, FREEMIUM_SEARCH_LIMIT, PROXY_URL, PROJECT_ID, RETRY_STATUS_CODES, CACHE_DIR
+from .utils import to_base64, from_url, imap_bounded, encode_embeddings, decode_embeddings
 
 
 class Searcher(object):
     def __init__(self, email, api_key,
-                 max_retries=3):
+                 max_retries=3,
+                 pool_maxsize=32,
+                 info_cache_ttl=5,
+                 cache=False,
+                 cache_dir=CACHE_DIR,
+                 cache_max_bytes=1 << 30,
+                 codec: Codec = None,
+                 rate_limit=False,
+                 budgets=None,
+                 lane="interactive",
+                 metrics: Metrics = None):
         self.email = email
         self.api_key = api_key
         self.max_retries = max_retries
+        self.pool_maxsize = pool_maxsize
+        self.info_cache = LRUCache(maxsize=1024,
+                                   ttl=info_cache_ttl)
+        self.codec = Codec() if codec is None else codec
+        self.metrics = Metrics() if metrics is None else metrics
+        self.wire_stats = WireStats(self.metrics)
+        # rate_limit=True: budgets from limits(), bucket state shared with
+        # every process on this host using the same key. 429 backoff is always on.
+        store = None
+        if rate_limit:
+            key = hashlib.sha256(f"{email}:{api_key}".encode('utf-8')).hexdigest()[:16]
+            store = SharedStore(Path(cache_dir) / f"ratelimit-{key}.sqlite")
+        self.rate_limit = rate_limit
+        self.rate_limiter = RateLimiter(store,
+                                        budgets=budgets,
+                                        lane=lane)
+        self.limits_lock = threading.Lock()
+        # Server capabilities, unknown until first used
+        self.retrieve_offset = None
+        self.endpoint_support = {}
+        self.result_cache = None
+        if cache:
+            # Request ids and results belong to an account: key them by it
+            account = hashlib.sha256(f"{email}:{api_key}".encode('utf-8')).hexdigest()[:16]
+            self.result_cache = DiskCache(Path(cache_dir) / "results.sqlite",
+                                          max_bytes=cache_max_bytes,
+                                          namespace=f"{account}:")
 
         retries = Retry(
             total=self.max_retries,
             backoff_factor=1,
-            status_forcelist=[500, 502, 503, 504, 521],
+            status_forcelist=RETRY_STATUS_CODES,
             allowed_methods=["POST"],
         )
         self.session = Session()
         self.session.mount("https://",
-                           HTTPAdapter(max_retries=retries))
+                           HTTPAdapter(max_retries=retries,
+                                       pool_maxsize=self.pool_maxsize))
+
+    def lane(self, name):
+        # with searcher.lane("batch"): calls from this thread yield to interactive ones
+        return self.rate_limiter.lane(name)
+
+    def configure_rate_limit(self):
+        with self.limits_lock:
+            if not self.rate_limiter.configured:
+                self.limits()
+
+    def post(self, endpoint, field, data, attempt_stats):
+        # attempt_stats["retries"] and ["waited"] (seconds spent in the rate
+        # limiter) are updated as it goes, so they are known on failure too
+        for attempt in range(self.max_retries + 1):
+            attempt_stats["waited"] += self.rate_limiter.acquire(endpoint, data)
+            response = self.session.post(PROXY_URL,
+                                         headers=self.codec.request_headers(),
+                                         files={
+                                             "piedemo__proxy": (None, json.dumps({
+                                                 "project_id": PROJECT_ID,
+                                                 "direct": endpoint,
+                                                 "method": "post",
+                                             })),
+                                             "__pie_json_data": field,
+                                         })
+            # Retries urllib3 did inside this call (5xx, connection errors)
+            history = getattr(getattr(response.raw, "retries", None), "history", None)
+            attempt_stats["retries"] += len(history or ())
+            if response.status_code != 429:
+                self.rate_limiter.success(endpoint)
+                return response
+            # Too many requests: every thread and process on this key waits
+            delay = self.rate_limiter.backoff(endpoint, parse_retry_after(response.headers.get("Retry-After")))
+            if attempt == self.max_retries:
+                raise RateLimited(f"{endpoint} is rate limited, retry in {delay:.0f}s")
+            attempt_stats["retries"] += 1
 
     def pierequest(self, endpoint, **data):
-        return self.session.post("https://console.piedata.ai/api/process/proxy",
-                                 files={
-                                     "piedemo__proxy": (None, json.dumps({
-                                         "project_id": "64b61f572e9765980a0640d3",
-                                         "direct": endpoint,
-                                         "method": "post",
-                                     })),
-                                     "__pie_json_data": (None, json.dumps({
-                                         "email": self.email,
-                                         "api_key": self.api_key,
-                                         **data
-                                     })),
-                                 }).json()
+        if self.rate_limit and not self.rate_limiter.configured and endpoint != "/limits":
+            self.configure_rate_limit()
+        (field, payload_bytes), encode_time = timed(self.codec.encode_field, {
+            "email": self.email,
+            "api_key": self.api_key,
+            **data
+        })
+        attempt_stats = {"retries": 0, "waited": 0.}
+        t_start = perf_counter()
+        try:
+            response = self.post(endpoint, field, data, attempt_stats)
+        except Exception as e:
+            self.metrics.record(endpoint, perf_counter() - t_start - attempt_stats["waited"],
+                                error=type(e).__name__,
+                                retries=attempt_stats["retries"],
+                                payload_bytes=payload_bytes,
+                                encode_time=encode_time,
+                                rate_limit_wait=attempt_stats["waited"])
+            raise
+        retries, waited = attempt_stats["retries"], attempt_stats["waited"]
+        latency = perf_counter() - t_start - waited
+        values = dict(retries=retries,
+                      payload_bytes=payload_bytes,
+                      request_bytes=len(response.request.body or b""),
+                      response_bytes=int(response.headers.get("Content-Length") or len(response.content)),
+                      encode_time=encode_time,
+                      rate_limit_wait=waited)
+        error = f"http_{response.status_code}" if response.status_code >= 400 else None
+        try:
+            result, decode_time = timed(self.codec.decode_response, response)
+        except Exception as e:
+            self.metrics.record(endpoint, latency, error=error or type(e).__name__, **values)
+            if endpoint in OPTIONAL_ENDPOINTS and response.status_code in UNKNOWN_ENDPOINT_STATUS:
+                self.endpoint_support[endpoint] = False
+                raise UnsupportedEndpoint(f"{endpoint} is not supported by the server "
+                                          f"(HTTP {response.status_code})") from e
+            raise
+        if error is None and isinstance(result, dict) and result.get("status", "ok") != "ok":
+            error = "status"
+        self.metrics.record(endpoint, latency, error=error, decode_time=decode_time, **values)
+        if response.status_code in UNKNOWN_ENDPOINT_STATUS and not isinstance(result, dict):
+            raise RuntimeError(f"{endpoint} failed (HTTP {response.status_code})")
+        return result
+
+    def check_response(self, endpoint, response):
+        # RuntimeError for a failed call; for OPTIONAL_ENDPOINTS, UnsupportedEndpoint
+        # when the server says it doesn't know the endpoint
+        optional = endpoint in OPTIONAL_ENDPOINTS
+        if response.get("status") == "ok":
+            if optional:
+                self.endpoint_support[endpoint] = True
+            return response
+        if optional and is_unknown_endpoint(response):
+            self.endpoint_support[endpoint] = False
+            raise UnsupportedEndpoint(response.get("message"))
+        raise RuntimeError(response.get("message"))
+
+    def supports(self, endpoint):
+        # True / False once the server has answered, None while unknown
+        return self.endpoint_support.get(endpoint)
 
     def limits(self):
         response = self.pierequest("/limits")
         if response.get("status") != "ok":
             raise RuntimeError(response.get("message"))
 
-        return Limits(response.get("limits", {}))
+        limits = Limits(response.get("limits", {}))
+        if self.rate_limit:
+            self.rate_limiter.configure(limits)
+        return limits
 
     def recent_searches(self):
         response = self.pierequest("/recent_searches")
@@ -62,10 +195,16 @@ class Searcher(object):
         return response.get("recent_searches", [])
 
     def view_search(self, request_id):
-        response = self.pierequest("/view_search",
-                                   request_id=request_id)
-        if response.get("status") != "ok":
-            raise RuntimeError(response.get("message"))
+        response = None
+        if self.result_cache is not None:
+            response = self.result_cache.get_json(f"view_search:{request_id}")
+        if response is None:
+            response = self.pierequest("/view_search",
+                                       request_id=request_id)
+            if response.get("status") != "ok":
+                raise RuntimeError(response.get("message"))
+            if self.result_cache is not None:
+                self.result_cache.put_json(f"view_search:{request_id}", response)
 
         response.pop('status')
         return {
@@ -76,12 +215,74 @@ class Searcher(object):
                             for ann in response.get('annotations', [])]
         }
 
-    def retrieve_data(self, request_id):
+    def store_results(self, request_id, data):
+        if self.result_cache is None:
+            return
+        key = f"results:{request_id}"
+        if key not in self.result_cache:
+            self.result_cache.put_json(key, data)
+
+    def submit_search(self, endpoint, result_key="request_id", **data):
+        key = None
+        if self.result_cache is not None:
+            key = "submit:" + hashlib.sha256(json.dumps({"endpoint": endpoint, **data},
+                                                        sort_keys=True).encode('utf-8')).hexdigest()
+            request_id = self.result_cache.get_json(key)
+            if request_id is not None:
+                return request_id
+
+        response = self.check_response(endpoint, self.pierequest(endpoint, **data))
+
+        request_id = response.get(result_key)
+        if key is not None and request_id is not None:
+            self.result_cache.put_json(key, request_id)
+        return request_id
+
+    def retrieve_page(self, request_id, offset=0):
+        # (results from offset on, whether the server reports the search finished)
+        if self.result_cache is not None:
+            data = self.result_cache.get_json(f"results:{request_id}")
+            if data is not None:
+                return data[offset:], True
+
+        if offset and self.retrieve_offset is None:
+            return self.probe_retrieve_offset(request_id, offset)
         response = self.pierequest("/retrieve",
-                                   request_id=request_id)
+                                   request_id=request_id,
+                                   **(dict(offset=offset) if offset and self.retrieve_offset else {}))
         if response.get("status") != "ok":
             raise RuntimeError(response.get("message"))
-        return response.get("data", [])
+        data = response.get("data", [])
+        if offset and not self.retrieve_offset:
+            data = data[offset:]
+        return data, bool(response.get("finished", response.get("done", False)))
+
+    def probe_retrieve_offset(self, request_id, offset):
+        # Decides once per Searcher whether /retrieve honours offset: the
+        # server says so by echoing it, otherwise the offset page is compared
+        # with the full list (a server ignoring offset repeats its head)
+        response = self.pierequest("/retrieve",
+                                   request_id=request_id,
+                                   offset=offset)
+        if response.get("status") != "ok":
+            raise RuntimeError(response.get("message"))
+        data = response.get("data", [])
+        if response.get("offset") == offset:
+            supported = True
+        else:
+            head = self.pierequest("/retrieve",
+                                   request_id=request_id)
+            if head.get("status") != "ok":
+                raise RuntimeError(head.get("message"))
+            head = head.get("data", [])[:offset]
+            supported = data[:len(head)] != head
+        self.retrieve_offset = supported
+        if not supported:
+            data = data[offset:]
+        return data, bool(response.get("finished", response.get("done", False)))
+
+    def retrieve_data(self, request_id, offset=0):
+        return self.retrieve_page(request_id, offset=offset)[0]
 
     def search(self, query,
                images: List[Image.Image] = None,
@@ -95,21 +296,20 @@ class Searcher(object):
         if search_limit > FREEMIUM_SEARCH_LIMIT:
             raise NotImplementedError(f"Now free search limit is {FREEMIUM_SEARCH_LIMIT} photos")
 
-        response = self.pierequest("/search",
-                                   query=query,
-                                   images=[to_base64(im)
-                                           for im in images
-                                           if isinstance(im, Image.Image)],
-                                   image_urls=[im
-                                               for im in images
-                                               if isinstance(im, str)],
-                                   annotations=[ann.to_dict()
-                                                for ann in annotations],
-                                   knum=search_limit)
-        if response.get("status") != "ok":
-            raise RuntimeError(response.get("message"))
-
-        return DataRequest(self, response.get("request_id"))
+        request_id = self.submit_search("/search",
+                                        query=query,
+                                        images=[to_base64(im)
+                                                for im in images
+                                                if isinstance(im, Image.Image)],
+                                        image_urls=[im
+                                                    for im in images
+                                                    if isinstance(im, str)],
+                                        annotations=[ann.to_dict()
+                                                     for ann in annotations],
+                                        knum=search_limit)
+
+        return DataRequest(self, request_id,
+                           search_limit=search_limit)
 
     def search_similar(self,
                        request_id,
@@ -123,15 +323,14 @@ class Searcher(object):
         if dataset_id is None and search_limit > FREEMIUM_SEARCH_LIMIT:
             raise NotImplementedError(f"Now free search limit is {FREEMIUM_SEARCH_LIMIT} photos")
 
-        response = self.pierequest("/search_similar",
-                                   request_id=request_id,
-                                   data_ids=data_ids,
-                                   dataset_id=dataset_id,
-                                   knum=search_limit)
-        if response.get("status") != "ok":
-            raise RuntimeError(response.get("message"))
+        similar_request_id = self.submit_search("/search_similar",
+                                                request_id=request_id,
+                                                data_ids=data_ids,
+                                                dataset_id=dataset_id,
+                                                knum=search_limit)
 
-        return DataRequest(self, response.get("request_id"))
+        return DataRequest(self, similar_request_id,
+                           search_limit=search_limit)
 
     def deepsearch(self, embedding: np.ndarray,
                    annotations: List[AnnotationSearch] = None,
@@ -146,15 +345,85 @@ class Searcher(object):
         if search_limit > FREEMIUM_SEARCH_LIMIT:
             raise NotImplementedError(f"Now free search limit is {FREEMIUM_SEARCH_LIMIT} photos")
 
-        response = self.pierequest("/deepsearch",
-                                   embedding=embedding.tolist(),
-                                   annotations=[ann.to_dict()
-                                                for ann in annotations],
-                                   knum=search_limit)
-        if response.get("status") != "ok":
-            raise RuntimeError(response.get("message"))
+        request_id = self.submit_search("/deepsearch",
+                                        embedding=embedding.tolist(),
+                                        annotations=[ann.to_dict()
+                                                     for ann in annotations],
+                                        knum=search_limit)
+
+        return DataRequest(self, request_id,
+                           search_limit=search_limit)
+
+    def deepsearch_batch(self, embeddings: np.ndarray,
+                         annotations: List[AnnotationSearch] = None,
+                         search_limit=FREEMIUM_SEARCH_LIMIT,
+                         dataset_id=None,
+                         dtype="float16",
+                         batch_size=64,
+                         workers=8) -> List[DataRequest]:
+        # One DataRequest per row of embeddings [N, FEATURE_DIMENSION], in
+        # order; wait on them together with DataRequest.gather. Up to
+        # batch_size queries go per round trip as one base64 buffer. If the
+        # server doesn't know /deepsearch_batch, queries go to /deepsearch one by one.
+        if annotations is None:
+            annotations = []
 
-        return DataRequest(self, response.get("request_id"))
+        embeddings = np.asarray(embeddings)
+        if embeddings.ndim != 2 or embeddings.shape[1] != FEATURE_DIMENSION:
+            raise RuntimeError("Bad embeddings shape")
+
+        if dataset_id is None and search_limit > FREEMIUM_SEARCH_LIMIT:
+            raise NotImplementedError(f"Now free search limit is {FREEMIUM_SEARCH_LIMIT} photos")
+
+        annotations = [ann.to_dict() for ann in annotations]
+        extra = {} if dataset_id is None else dict(dataset_id=dataset_id)
+
+        def submit_batch(batch):
+            request_ids = self.submit_search("/deepsearch_batch",
+                                             result_key="request_ids",
+                                             embeddings=encode_embeddings(batch, dtype=dtype),
+                                             dtype=dtype,
+                                             shape=list(batch.shape),
+                                             annotations=annotations,
+                                             knum=search_limit,
+                                             **extra)
+            if request_ids is None or len(request_ids) != len(batch):
+                raise RuntimeError("Bad /deepsearch_batch response")
+            return request_ids
+
+        def submit_one(embedding):
+            return [self.submit_search("/deepsearch",
+                                       embedding=embedding.tolist(),
+                                       annotations=annotations,
+                                       knum=search_limit,
+                                       **extra)]
+
+        batches = [embeddings[start:start + batch_size]
+                   for start in range(0, len(embeddings), batch_size)]
+        request_ids = []
+        if batches and self.supports("/deepsearch_batch") is not False:
+            # Only a server that doesn't know the endpoint sends queries one
+            # by one; every other failure is raised
+            try:
+                request_ids.extend(self.rate_limiter.bind(submit_batch, default="batch")(batches[0]))
+            except UnsupportedEndpoint:
+                pass
+
+        if self.supports("/deepsearch_batch"):
+            fn, items = submit_batch, batches[1:]
+        else:
+            fn, items = submit_one, list(embeddings)
+        results = [None] * len(items)
+        for index, result, error in imap_bounded(self.rate_limiter.bind(fn, default="batch"), items,
+                                                 workers=workers):
+            if error is not None:
+                raise error
+            results[index] = result
+        request_ids.extend(request_id for result in results for request_id in result)
+
+        return [DataRequest(self, request_id,
+                            search_limit=search_limit)
+                for request_id in request_ids]
 
     def dataset_list(self, prefix=""):
         response = self.pierequest("/dataset_list",
@@ -175,12 +444,17 @@ class Searcher(object):
                 for dataset_id in response.get("datasets", [])]
 
     def dataset_info(self, dataset_id):
-        response = self.pierequest("/dataset_info",
-                                   dataset_id=dataset_id)
-        if response.get("status") != "ok":
-            raise RuntimeError(response.get("message"))
+        def load():
+            response = self.pierequest("/dataset_info",
+                                       dataset_id=dataset_id)
+            if response.get("status") != "ok":
+                raise RuntimeError(response.get("message"))
+            return response
 
-        return response
+        return dict(self.info_cache.get_or_load(dataset_id, load))
+
+    def invalidate_dataset_info(self, dataset_id=None):
+        self.info_cache.invalidate(dataset_id)
 
     def dataset_add(self, dataset_id: str,
                     request_id: str,
@@ -189,6 +463,7 @@ class Searcher(object):
                                    dataset_id=dataset_id,
                                    request_id=request_id,
                                    data_ids=data_ids)
+        self.invalidate_dataset_info(dataset_id)
 
         if response.get("status") != "ok":
             raise RuntimeError(response.get("message"))
@@ -207,6 +482,7 @@ class Searcher(object):
     def dataset_drop(self, dataset_id: str):
         response = self.pierequest("/drop_dataset",
                                    dataset_id=dataset_id)
+        self.invalidate_dataset_info(dataset_id)
 
         if response.get("status") != "ok":
             raise RuntimeError(response.get("message"))
@@ -216,6 +492,7 @@ class Searcher(object):
     def dataset_make_public(self, dataset_id: str):
         response = self.pierequest("/make_public",
                                    dataset_id=dataset_id)
+        self.invalidate_dataset_info(dataset_id)
 
         if response.get("status") != "ok":
             raise RuntimeError(response.get("message"))
@@ -225,6 +502,7 @@ class Searcher(object):
     def dataset_make_private(self, dataset_id: str):
         response = self.pierequest("/make_private",
                                    dataset_id=dataset_id)
+        self.invalidate_dataset_info(dataset_id)
 
         if response.get("status") != "ok":
             raise RuntimeError(response.get("message"))
@@ -238,11 +516,59 @@ class Searcher(object):
                                    dataset_id=dataset_id,
                                    request_id=request_id,
                                    data_ids=data_ids)
+        self.invalidate_dataset_info(dataset_id)
 
         if response.get("status") != "ok":
             raise RuntimeError(response.get("message"))
 
         return response
 
-    def get_embedding(self, image_url):
-        raise NotImplementedError()
+    def get_embeddings(self, image_urls: List[str],
+                       batch_size=100,
+                       workers=8) -> np.ndarray:
+        # [len(image_urls), FEATURE_DIMENSION] float32, NaN rows for images
+        # the server has no embedding for. Batches are requested concurrently
+        # and, with cache=True, kept in the result cache. Raises
+        # UnsupportedEndpoint when the server has no /get_embeddings.
+        image_urls = list(image_urls)
+        embeddings = np.full((len(image_urls), FEATURE_DIMENSION), np.nan, dtype=np.float32)
+        missing = []
+        for i, image_url in enumerate(image_urls):
+            cached = None
+            if self.result_cache is not None:
+                cached = self.result_cache.get(f"embedding:{image_url}")
+            if cached is None:
+                missing.append(i)
+            else:
+                embeddings[i] = np.frombuffer(cached, dtype=np.float32)
+
+        if missing and self.supports("/get_embeddings") is False:
+            raise UnsupportedEndpoint("/get_embeddings is not supported by the server")
+
+        def load(batch):
+            response = self.check_response("/get_embeddings",
+                                           self.pierequest("/get_embeddings",
+                                                           image_urls=[image_urls[i] for i in batch]))
+            return batch, response.get("embeddings", [])
+
+        batches = [missing[k:k + batch_size] for k in range(0, len(missing), batch_size)]
+        for _, result, error in imap_bounded(self.rate_limiter.bind(load, default="batch"), batches,
+                                             workers=workers):
+            if error is not None:
+                raise error
+            batch, batch_embeddings = result
+            for i, embedding in zip(batch, batch_embeddings):
+                if embedding is None:
+                    continue
+                if isinstance(embedding, str):
+                    embedding = decode_embeddings(embedding)[0]
+                embeddings[i] = embedding
+                if self.result_cache is not None:
+                    self.result_cache.put(f"embedding:{image_urls[i]}", embeddings[i].tobytes())
+        return embeddings
+
+    def get_embedding(self, image_url) -> np.ndarray:
+        embedding = self.get_embeddings([image_url])[0]
+        if np.isnan(embedding).any():
+            raise RuntimeError(f"No embedding for {image_url}")
+        return embedding
@@ -1,6 +1,11 @@
+import os
 
 
 FEATURE_DIMENSION = 512
 MODEL_NAME = "ViT-B/32"
 FREEMIUM_SEARCH_LIMIT = 16
 PAGE_SIZE = 100
+PROXY_URL = "https://console.piedata.ai/api/process/proxy"
+PROJECT_ID = "64b61f572e9765980a0640d3"
+RETRY_STATUS_CODES = [500, 502, 503, 504, 521]
+CACHE_DIR = os.path.join(os.path.expanduser("~"), ".pielake", "cache")
@@ -1,21 +1,227 @@
+import os
 import base64
+import hashlib
 import io
 import requests
+from time import time
+from pathlib import Path
+from requests.adapters import HTTPAdapter
+from concurrent.futures import Executor, ThreadPoolExecutor, wait, FIRST_COMPLETED
 from PIL import Image
-from typing import Optional
+import numpy as np
+from typing import Optional, Callable, Iterable, Iterator, Tuple, Any, List, Union
+from .cache import DiskCache, LRUCache
+from .settings import CACHE_DIR, FEATURE_DIMENSION
 
 
-def to_base64(im: Image.Image) -> str:
-    file_object = io.BytesIO()
-    im.save(file_object, 'JPEG')
-    file_object.seek(0)
-    b64 = base64.b64encode(file_object.read()).decode('utf-8')
+def is_jpeg(content: bytes) -> bool:
+    return content[:3] == b"\xff\xd8\xff"
+
+
+def to_base64(im: Union[Image.Image, bytes]) -> str:
+    if isinstance(im, bytes):
+        if not is_jpeg(im):
+            raise RuntimeError("Only JPEG encoded bytes can be uploaded as is")
+        content = im
+    else:
+        file_object = io.BytesIO()
+        im.save(file_object, 'JPEG')
+        content = file_object.getvalue()
+    b64 = base64.b64encode(content).decode('utf-8')
     src = f"data:image/jpeg;charset=utf-8;base64, {b64}"
     return src
 
 
-def from_url(image_url: str) -> Optional[Image.Image]:
+def encode_embeddings(embeddings: np.ndarray,
+                      dtype="float32") -> str:
+    # Little-endian row-major buffer, base64: ~4x smaller than JSON decimals
+    # for float32 and ~8x for float16
+    buffer = np.ascontiguousarray(embeddings, dtype=np.dtype(dtype).newbyteorder("<"))
+    return base64.b64encode(buffer.tobytes()).decode('ascii')
+
+
+def decode_embeddings(data: str,
+                      dtype="float32",
+                      dim=FEATURE_DIMENSION) -> np.ndarray:
+    buffer = np.frombuffer(base64.b64decode(data), dtype=np.dtype(dtype).newbyteorder("<"))
+    return buffer.astype(np.float32).reshape((-1, dim))
+
+
+SESSIONS = {}
+
+
+def get_session(pool_maxsize=32) -> requests.Session:
+    # Pooled connections can't be shared with forked children
+    session = SESSIONS.get(os.getpid())
+    if session is None:
+        session = requests.Session()
+        adapter = HTTPAdapter(pool_maxsize=pool_maxsize)
+        session.mount("https://", adapter)
+        session.mount("http://", adapter)
+        SESSIONS.clear()
+        SESSIONS[os.getpid()] = session
+    return session
+
+
+class ImageCache(object):
+    def __init__(self, cache_dir=CACHE_DIR,
+                 max_bytes=4 << 30,
+                 max_age=None):
+        super(ImageCache, self).__init__()
+        self.store = DiskCache(Path(cache_dir) / "images.sqlite",
+                               max_bytes=max_bytes)
+        self.max_age = max_age
+        # Stores nothing, only coalesces concurrent downloads of one url
+        self.inflight = LRUCache(maxsize=0)
+
+    def fetch(self, image_url: str,
+              revalidate=False,
+              timeout=None,
+              raise_for_status=False) -> Optional[bytes]:
+        return self.inflight.get_or_load((image_url, revalidate, raise_for_status),
+                                         lambda: self.load(image_url,
+                                                           revalidate=revalidate,
+                                                           timeout=timeout,
+                                                           raise_for_status=raise_for_status))
+
+    def load(self, image_url: str,
+             revalidate=False,
+             timeout=None,
+             raise_for_status=False) -> Optional[bytes]:
+        entry = self.store.get_json(f"url:{image_url}")
+        content = None
+        if entry is not None:
+            content = self.store.get(f"blob:{entry['sha256']}")
+        if content is not None:
+            fresh = self.max_age is None or time() - entry["fetched"] < self.max_age
+            if fresh and not revalidate:
+                return content
+
+        headers = {}
+        if content is not None:
+            if entry.get("etag"):
+                headers["If-None-Match"] = entry["etag"]
+            if entry.get("last_modified"):
+                headers["If-Modified-Since"] = entry["last_modified"]
+
+        r = get_session().get(image_url, headers=headers, timeout=timeout)
+        if r.status_code == 304 and content is not None:
+            entry["fetched"] = time()
+            self.store.put_json(f"url:{image_url}", entry)
+            return content
+        if r.status_code != 200:
+            if raise_for_status:
+                r.raise_for_status()
+            return None
+
+        content = r.content
+        sha256 = hashlib.sha256(content).hexdigest()
+        self.store.put(f"blob:{sha256}", content)
+        self.store.put_json(f"url:{image_url}", {
+            "sha256": sha256,
+            "etag": r.headers.get("ETag"),
+            "last_modified": r.headers.get("Last-Modified"),
+            "fetched": time(),
+        })
+        return content
+
+
+IMAGE_CACHE = None
+
+
+def enable_image_cache(cache_dir=CACHE_DIR,
+                       max_bytes=4 << 30,
+                       max_age=None) -> ImageCache:
+    global IMAGE_CACHE
+    IMAGE_CACHE = ImageCache(cache_dir,
+                             max_bytes=max_bytes,
+                             max_age=max_age)
+    return IMAGE_CACHE
+
+
+def disable_image_cache():
+    global IMAGE_CACHE
+    IMAGE_CACHE = None
+
+
+def fetch_bytes(image_url: str,
+                revalidate=False,
+                timeout=None,
+                raise_for_status=False) -> Optional[bytes]:
+    # None on a non-200 response, or requests.HTTPError for 4xx/5xx with raise_for_status
     image_url = image_url.split('?')[0]
-    r = requests.get(image_url, stream=True)
+    if IMAGE_CACHE is not None:
+        return IMAGE_CACHE.fetch(image_url,
+                                 revalidate=revalidate,
+                                 timeout=timeout,
+                                 raise_for_status=raise_for_status)
+    r = get_session().get(image_url, timeout=timeout)
     if r.status_code == 200:
-        return Image.open(io.BytesIO(r.content)).convert("RGB")
+        return r.content
+    if raise_for_status:
+        r.raise_for_status()
+
+
+def from_url(image_url: str,
+             raw=False,
+             revalidate=False,
+             timeout=None) -> Optional[Union[Image.Image, bytes]]:
+    content = fetch_bytes(image_url,
+                          revalidate=revalidate,
+                          timeout=timeout)
+    if content is None or raw:
+        return content
+    return Image.open(io.BytesIO(content)).convert("RGB")
+
+
+def from_urls(image_urls: Iterable[str],
+              workers=8,
+              raw=False,
+              revalidate=False,
+              timeout=None) -> List[Optional[Union[Image.Image, bytes]]]:
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        return list(executor.map(lambda image_url: from_url(image_url,
+                                                            raw=raw,
+                                                            revalidate=revalidate,
+                                                            timeout=timeout),
+                                 image_urls))
+
+
+def imap_bounded(fn: Callable[[Any], Any],
+                 iterable: Iterable,
+                 workers=8,
+                 max_in_flight=None,
+                 executor: Optional[Executor] = None) -> Iterator[Tuple[int, Any, Optional[BaseException]]]:
+    # Yields (index, result, error) in completion order, pulling at most
+    # max_in_flight items from the iterable ahead of the consumer.
+    if max_in_flight is None:
+        max_in_flight = 2 * workers
+    max_in_flight = max(max_in_flight, 1)
+
+    items = enumerate(iterable)
+    exhausted = False
+    pending = {}
+    owns_executor = executor is None
+    if owns_executor:
+        executor = ThreadPoolExecutor(max_workers=workers)
+    try:
+        while True:
+            while not exhausted and len(pending) < max_in_flight:
+                try:
+                    index, item = next(items)
+                except StopIteration:
+                    exhausted = True
+                    break
+                pending[executor.submit(fn, item)] = index
+            if not pending:
+                break
+            done, _ = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                index = pending.pop(future)
+                error = future.exception()
+                yield index, None if error is not None else future.result(), error
+    finally:
+        for future in pending:
+            future.cancel()
+        if owns_executor:
+            executor.shutdown(wait=True)
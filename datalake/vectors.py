@@ -0,0 +1,123 @@
+from typing import Optional, Tuple
+import numpy as np
+
+
+def normalize(x: np.ndarray) -> np.ndarray:
+    x = np.asarray(x, dtype=np.float32)
+    norms = np.linalg.norm(x, axis=-1, keepdims=True)
+    return x / np.maximum(norms, 1e-12)
+
+
+def merge_topk(scores: np.ndarray, indices: np.ndarray,
+               new_scores: np.ndarray, new_indices: np.ndarray,
+               k: int) -> Tuple[np.ndarray, np.ndarray]:
+    # Running per-row top-k (unsorted) over column blocks
+    scores = np.concatenate([scores, new_scores], axis=1)
+    indices = np.concatenate([indices, new_indices], axis=1)
+    if scores.shape[1] <= k:
+        return scores, indices
+    top = np.argpartition(-scores, k - 1, axis=1)[:, :k]
+    return np.take_along_axis(scores, top, axis=1), np.take_along_axis(indices, top, axis=1)
+
+
+def sort_topk(scores: np.ndarray, indices: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+    order = np.argsort(-scores, axis=1, kind="stable")
+    return np.take_along_axis(scores, order, axis=1), np.take_along_axis(indices, order, axis=1)
+
+
+def blocked_topk(queries: np.ndarray, base: np.ndarray,
+                 k: int,
+                 block_size=4096,
+                 upper=False,
+                 offset=0,
+                 threshold: Optional[float] = None,
+                 normalized=False) -> Tuple[np.ndarray, np.ndarray]:
+    # Exact top-k inner products of queries against base, computed in
+    # (len(queries), block_size) tiles so memory stays bounded. base may be a
+    # memory-mapped array; each block is normalised on the fly unless the base
+    # is already unit-norm (normalized=True). With upper=True
+    # query i (at global position offset + i) only sees base rows after itself.
+    # With a threshold only scores > threshold are kept. Missing neighbours
+    # have score -inf and index -1.
+    queries = normalize(queries)
+    n_queries = len(queries)
+    scores = np.full((n_queries, 0), -np.inf, dtype=np.float32)
+    indices = np.full((n_queries, 0), -1, dtype=np.int64)
+    start = offset if upper else 0
+    for col in range(start, len(base), block_size):
+        block = base[col:col + block_size]
+        block = np.asarray(block, dtype=np.float32) if normalized else normalize(block)
+        block_scores = queries @ block.T
+        if upper and col < offset + n_queries:
+            rows = np.arange(n_queries)[:, None] + offset
+            cols = np.arange(col, col + len(block))[None, :]
+            block_scores[cols <= rows] = -np.inf
+        if threshold is not None:
+            below = block_scores <= threshold
+            if below.all():
+                continue
+            block_scores[below] = -np.inf
+        block_indices = np.broadcast_to(np.arange(col, col + len(block)), block_scores.shape)
+        scores, indices = merge_topk(scores, indices, block_scores, block_indices, k)
+    if scores.shape[1] < k:
+        pad = k - scores.shape[1]
+        scores = np.pad(scores, ((0, 0), (0, pad)), constant_values=-np.inf)
+        indices = np.pad(indices, ((0, 0), (0, pad)), constant_values=-1)
+    indices = np.where(np.isinf(scores), -1, indices)
+    return sort_topk(scores, indices)
+
+
+def kmeans(x: np.ndarray,
+           n_clusters: int,
+           n_iter=10,
+           sample_size=None,
+           block_size=65536,
+           spherical=True,
+           seed=0) -> np.ndarray:
+    # Lloyd's k-means on a sample. Spherical: cosine assignment and unit-norm
+    # centroids; otherwise Euclidean (e.g. product quantizer codebooks).
+    rng = np.random.default_rng(seed)
+    if sample_size is None:
+        sample_size = 64 * n_clusters
+    sample_size = min(sample_size, len(x))
+    sample = np.asarray(x[np.sort(rng.choice(len(x), sample_size, replace=False))], dtype=np.float32)
+    if spherical:
+        sample = normalize(sample)
+    n_clusters = min(n_clusters, sample_size)
+    centroids = sample[rng.choice(sample_size, n_clusters, replace=False)]
+    for _ in range(n_iter):
+        assignment = assign(sample, centroids, block_size=block_size, spherical=spherical)[:, 0]
+        order = np.argsort(assignment, kind="stable")
+        counts = np.bincount(assignment, minlength=n_clusters)
+        sums = np.zeros_like(centroids)
+        nonempty = np.flatnonzero(counts)
+        sums[nonempty] = np.add.reduceat(sample[order], np.cumsum(counts)[nonempty] - counts[nonempty])
+        empty = counts == 0
+        # Re-seed empty clusters with random points
+        sums[empty] = sample[rng.choice(sample_size, int(empty.sum()))]
+        counts[empty] = 1
+        centroids = normalize(sums) if spherical else sums / counts[:, None]
+    return centroids
+
+
+def assign(x: np.ndarray, centroids: np.ndarray,
+           nprobe=1,
+           block_size=65536,
+           spherical=True) -> np.ndarray:
+    # Indices of the nprobe nearest centroids for every row of x
+    result = np.empty((len(x), nprobe), dtype=np.int64)
+    half_norms = None if spherical else 0.5 * (centroids ** 2).sum(axis=1)
+    for start in range(0, len(x), block_size):
+        block = np.asarray(x[start:start + block_size], dtype=np.float32)
+        if spherical:
+            scores = normalize(block) @ centroids.T
+        else:
+            # argmin |x - c|^2 == argmax x.c - |c|^2 / 2
+            scores = block @ centroids.T - half_norms
+        if nprobe == 1:
+            result[start:start + len(scores), 0] = scores.argmax(axis=1)
+        else:
+            top = np.argpartition(-scores, nprobe - 1, axis=1)[:, :nprobe]
+            order = np.argsort(-np.take_along_axis(scores, top, axis=1), axis=1)
+            result[start:start + len(scores)] = np.take_along_axis(top, order, axis=1)
+    return result
@@ -0,0 +1,24 @@
+import asyncio
+from datalake.async_searcher import AsyncSearcher
+from datalake.credentials import load_credentials
+from datalake.annotations import TagSearch
+
+
+async def main():
+    async with AsyncSearcher(**load_credentials(), max_concurrency=16) as searcher:
+        data_requests = await asyncio.gather(*[searcher.search(query,
+                                                               annotations=[TagSearch(query.lower())],
+                                                               search_limit=4)
+                                               for query in ["Rabbits", "Cats", "Dogs"]])
+        print(data_requests)
+        print(await asyncio.gather(*[data_request.wait(4, timeout=120)
+                                     for data_request in data_requests]))
+
+        ds = (await searcher.dataset_list())[0]
+        n = 0
+        async for obj in ds.iter(prefetch=4):
+            n += 1
+        print(ds, n)
+
+
+asyncio.run(main())
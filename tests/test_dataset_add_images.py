@@ -0,0 +1,14 @@
+from datalake.searcher import Searcher
+from datalake.credentials import load_credentials
+
+
+credentials = load_credentials()
+searcher = Searcher(**credentials)
+
+ds = searcher.dataset_list()[0]
+new_ds = searcher.dataset_list()[-1]
+print(ds, new_ds)
+
+report = new_ds.add_images((obj for obj in ds.iter(progress=False)),
+                           workers=16)
+print(f"Failed: {[r for r in report if r['status'] != 'ok']}")
@@ -0,0 +1,16 @@
+import numpy as np
+from time import time
+from datalake.searcher import Searcher
+from datalake.data_request import DataRequest
+from datalake.credentials import load_credentials
+
+
+credentials = load_credentials()
+searcher = Searcher(**credentials)
+
+t1 = time()
+data_requests = searcher.deepsearch_batch(np.random.randn(32, 512).astype(np.float32),
+                                          search_limit=1)
+print([len(data) for data in DataRequest.gather(data_requests, timeout=120)])
+print(f"Batch timing: {time() - t1}")
+print(f"Batch endpoint supported: {searcher.supports('/deepsearch_batch')}")
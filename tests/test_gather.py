@@ -0,0 +1,17 @@
+from time import time
+from datalake.searcher import Searcher
+from datalake.data_request import DataRequest
+from datalake.credentials import load_credentials
+
+
+credentials = load_credentials()
+searcher = Searcher(**credentials)
+
+t1 = time()
+data_requests = [searcher.search(query, search_limit=4)
+                 for query in ["Rabbits", "Cats", "Dogs", "Horses"]]
+for data_request, data in DataRequest.as_completed(data_requests, timeout=120):
+    print(data_request, len(data), data_request.time_to_first_result)
+print(f"Timing: {time() - t1}")
+
+print([len(data) for data in DataRequest.gather(data_requests, n=4, timeout=120)])
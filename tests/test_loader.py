@@ -0,0 +1,17 @@
+from time import time
+from datalake.searcher import Searcher
+from datalake.loader import Loader
+from datalake.credentials import load_credentials
+
+
+credentials = load_credentials()
+searcher = Searcher(**credentials)
+
+ds = searcher.dataset_list()[0]
+ds.export("shards", format="shards", shard_count=1000)
+
+for source in [ds, "shards"]:
+    loader = Loader(source, batch_size=32, size=(224, 224), workers=16)
+    t1 = time()
+    n = sum(len(batch["image"]) for batch in loader)
+    print(f"{source}: {n} images, {n / (time() - t1):.1f} images/s, {loader.errors} errors")
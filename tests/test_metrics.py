@@ -0,0 +1,17 @@
+import sys
+from datalake.searcher import Searcher
+from datalake.data_request import DataRequest
+from datalake.metrics import Metrics, JsonLogSink
+from datalake.credentials import load_credentials
+
+
+credentials = load_credentials()
+searcher = Searcher(**credentials,
+                    metrics=Metrics(sinks=[JsonLogSink(stream=sys.stdout)]))
+
+data_requests = [searcher.search(query, search_limit=4)
+                 for query in ["Rabbits", "Cats"]]
+DataRequest.gather(data_requests, timeout=120)
+print([data_request.time_to_complete for data_request in data_requests])
+print(searcher.metrics.summary())
+print(searcher.metrics.prometheus())
@@ -0,0 +1,30 @@
+import threading
+from time import time
+from datalake.searcher import Searcher
+from datalake.credentials import load_credentials
+
+
+credentials = load_credentials()
+# Two clients on one key share the bucket state in ~/.pielake/cache:
+# a bulk job in the batch lane and an interactive user
+batch_searcher = Searcher(**credentials, rate_limit=True, lane="batch", budgets={"search": 360})
+interactive_searcher = Searcher(**credentials, rate_limit=True, budgets={"search": 360})
+print(batch_searcher.limits())
+
+
+def bulk():
+    for i in range(40):
+        batch_searcher.search(f"Cats {i}", search_limit=1)
+
+
+t1 = time()
+thread = threading.Thread(target=bulk)
+thread.start()
+for query in ["Rabbits", "Dogs", "Horses"]:
+    t2 = time()
+    interactive_searcher.search(query, search_limit=1)
+    print(f"interactive {query}: {time() - t2:.2f}s")
+thread.join()
+print(f"bulk: {time() - t1:.1f}s")
+print(batch_searcher.rate_limiter.snapshot())
+print(batch_searcher.metrics.summary())